@@ -95,7 +95,7 @@ class BoundsError(Exception):
 # Private utility functions
 #=============================================================================================
 
-def logsum(a_n):
+def logsum(a_n, axis=None):
   """
   Compute the log of a sum of exponentiated terms exp(a_n) in a numerically-stable manner:
 
@@ -107,9 +107,12 @@ def logsum(a_n):
 
   ARGUMENTS
     a_n (numpy array) - a_n[n] is the nth exponential argument
+
+  OPTIONAL ARGUMENTS
+    axis (int) - if given, sum along this axis only (default: sum over all elements)
   
   RETURNS
-    log_sum (float) - the log of the sum of exponentiated a_n, log (\sum_n exp(a_n))
+    log_sum (float or numpy array) - the log of the sum of exponentiated a_n, log (\sum_n exp(a_n))
 
   EXAMPLE  
 
@@ -119,14 +122,18 @@ def logsum(a_n):
     
   """
 
+  if axis is None:
+    a_n = numpy.ravel(a_n)
+    axis = 0
+
   # Compute the maximum argument.
-  max_log_term = numpy.max(a_n)
+  max_log_term = numpy.max(a_n, axis=axis)
 
   # Compute the reduced terms.
-  terms = numpy.exp(a_n - max_log_term)
+  terms = numpy.exp(a_n - numpy.expand_dims(max_log_term, axis))
 
   # Compute the log sum.
-  log_sum = numpy.log(sum(terms)) + max_log_term
+  log_sum = numpy.log(numpy.sum(terms, axis=axis)) + max_log_term
         
   return log_sum
 
@@ -677,13 +684,12 @@ class MBAR:
       print 'Skipping check of whether the states have the same potential energy,'
       print 'as the number of states is greater than 100'
     else:
+      # find the nonzero sets of data: 
+      u_jln = self.u_kln[self.N_k > 0]
       for k in range(K):
         for l in range(k):
-          diffsum = 0
-          for j in range(K): # find the nonzero sets of data: 
-            if (self.N_k[j] > 0):
-              uzero = u_kln[j,k,:] - u_kln[j,l,:]
-              diffsum += numpy.dot(uzero,uzero);
+          uzero = u_jln[:,k,:] - u_jln[:,l,:]
+          diffsum = numpy.sum(uzero*uzero)
           if (diffsum < relative_tolerance):
             self.samestates.append([k,l])
             self.samestates.append([l,k])
@@ -700,6 +706,7 @@ class MBAR:
       mask_kn[k,0:N_k[k]] = True
     # Create a list from this mask.
     self.indices = numpy.where(mask_kn)
+    self.mask_kn = mask_kn
 
     # Determine list of k indices for which N_k != 0
     self.nonzero_N_k_indices = numpy.where(self.N_k != 0)[0]
@@ -724,7 +731,7 @@ class MBAR:
     self.f_k = numpy.zeros([self.K], dtype=numpy.float64)
 
     # If an initial guess of the relative dimensionless free energies is specified, start with that.
-    if initial_f_k != None:
+    if initial_f_k is not None:
       if self.verbose: print "Initializing f_k with provided initial guess."
       # Cast to numpy array.
       initial_f_k = numpy.array(initial_f_k, dtype=numpy.float64)
@@ -1709,23 +1716,22 @@ class MBAR:
     if (recalc_denom):
       self.log_weight_denom = self._computeUnnormalizedLogWeights(numpy.zeros([self.K,self.N_max],dtype=numpy.float64))
 
-    for l in range(K):
-      # Compute log weights.
-      if (include_nonzero):
-        index = l
-      else:
-        index = self.nonzero_N_k_indices[l]
-      log_w_kn = -self.u_kln[:,index,:]+ self.log_weight_denom + f_k[l]
+    # Compute log weights for all of the states at once; log_w_nk[n,l] is the log weight of sample n in state l.
+    if (include_nonzero):
+      index = numpy.arange(K)
+    else:
+      index = self.nonzero_N_k_indices
+    log_w_nk = (-self.u_kln[:,index,:] + self.log_weight_denom[:,numpy.newaxis,:]).transpose(0,2,1)[self.indices] + f_k
 
-      if (return_f_k):
-        f_k_out[l] = f_k[l] - logsum( log_w_kn[self.indices] )
-        if (include_nonzero):
-          log_w_kn[self.indices] += (f_k_out[l]-f_k[l])  # renormalize the weights, needed for nonzero states. 
+    if (return_f_k):
+      f_k_out[:] = f_k - logsum(log_w_nk, axis=0)
+      if (include_nonzero):
+        log_w_nk += (f_k_out-f_k)  # renormalize the weights, needed for nonzero states. 
 
-      if (logform):
-        Warray_nk[:,l] = log_w_kn[self.indices]        
-      else:
-        Warray_nk[:,l] = numpy.exp(log_w_kn[self.indices])        
+    if (logform):
+      Warray_nk[:,:] = log_w_nk
+    else:
+      Warray_nk[:,:] = numpy.exp(log_w_nk)
 
     # Return weights (or log weights)
     if (return_f_k):
@@ -2078,54 +2084,12 @@ class MBAR:
       u_kn = numpy.array(u_kn, dtype=numpy.float64) # necessary for helper code to interpret type of u_kn
       log_w_kn = _pymbar.computeUnnormalizedLogWeightsCpp(self.K, self.N_max, self.K_nonzero, self.nonzero_N_k_indices, self.N_k, self.f_k, self.u_kln, u_kn);
     else:
-      try:
-        #z= 1/0
-        #pass
-        from scipy import weave
-        # Allocate storage for return values.
-        log_w_kn = numpy.zeros([self.K,self.N_max], dtype=numpy.float64)
-        # Copy useful class members to local variables.
-        K = self.K
-        f_k = self.f_k
-        N_k = self.N_k
-        u_kln = self.u_kln
-        # Weave inline C++ code.
-        code = """
-        double log_terms[%(K)d]; // temporary storage for log terms
-        for (int k = 0; k < K; k++) {
-          for (int n = 0; n < N_K1(k); n++) {
-            double max_log_term = 0.0;
-            bool first_nonzero = true;
-            for (int j = 0; j < K; j++) {
-              // skip empty states
-              if (N_K1(j) == 0) continue;
-              double log_term = log(N_K1(j)) + F_K1(j) - U_KLN3(k,j,n) + U_KN2(k,n);
-              log_terms[j] = log_term;
-              if (first_nonzero || (log_term > max_log_term)) {
-                max_log_term = log_term;
-                first_nonzero = false;
-              }
-            }
-
-            double term_sum = 0.0;
-            for (int j = 0; j < K; j++) {
-              // skip empty states
-              if (N_K1(j) == 0) continue;
-              term_sum += exp(log_terms[j] - max_log_term);
-            }
-            double log_term_sum = log(term_sum) + max_log_term;
-            LOG_W_KN2(k,n) = - log_term_sum;
-          }
-        }
-        """ % vars()
-        # Execute inline C code with weave.
-        info = weave.inline(code, ['K', 'N_k', 'u_kn', 'u_kln', 'f_k', 'log_w_kn'], headers=['<math.h>', '<stdlib.h>'], verbose=2)
-      except:
-        # Compute unnormalized log weights in pure Python.
-        log_w_kn = numpy.zeros([self.K,self.N_max], dtype=numpy.float64)
-        for k in range(0,self.K):
-          for n in range(0,self.N_k[k]):
-            log_w_kn[k,n] = - logsum(numpy.log(self.N_k[self.nonzero_N_k_indices]) + self.f_k[self.nonzero_N_k_indices] - (self.u_kln[k,self.nonzero_N_k_indices,n] - u_kn[k,n]) )        
+      # Compute unnormalized log weights with numpy, as a log-sum-exp over the states with samples
+      # of log_terms[k,j,n] = log(N_j) + f_j - (u_kln[k,j,n] - u_kn[k,n]).
+      nonzero = self.nonzero_N_k_indices
+      log_terms = (numpy.log(self.N_k[nonzero]) + self.f_k[nonzero])[numpy.newaxis,:,numpy.newaxis] - \
+          (self.u_kln[:,nonzero,:] - numpy.array(u_kn, dtype=numpy.float64)[:,numpy.newaxis,:])
+      log_w_kn = numpy.where(self.mask_kn, -logsum(log_terms, axis=1), 0.0)
 
     return log_w_kn
 
@@ -2494,10 +2458,8 @@ class MBAR:
 
     W_nk = self._computeWeights(recalc_denom=True)
 
-    g = numpy.array(numpy.zeros([K], dtype=numpy.float64)) # gradient  
-
-    for i in range(1,K):    
-      g[i] = N_k[i] - N_k[i] * W_nk[:,i].sum()      
+    g = N_k - N_k * W_nk.sum(axis=0) # gradient  
+    g[0] = 0.0
 
     return g
 
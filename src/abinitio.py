@@ -5,7 +5,10 @@
 """
 
 import os
+import time
 import shutil
+import hashlib
+import tempfile
 from forcebalance.nifty import col, eqcgmx, flat, floatornan, fqcgmx, invert_svd, kb, printcool, bohrang, warn_press_key, warn_once, pvec1d, commadash, uncommadash, isint
 import numpy as np
 from forcebalance.target import Target
@@ -22,6 +25,95 @@ import itertools
 from forcebalance.output import getLogger
 logger = getLogger(__name__)
 
+## Keywords for the reference data in qdata.txt files.
+qdata_keys = ['ENERGY', 'FORCES', 'ESPXYZ', 'ESPVAL']
+
+def parse_qdata(fnm):
+    """
+    Read the reference data from a qdata.txt file.  The numbers for
+    each keyword are converted to floats in a single call to NumPy,
+    instead of one call to float() per number.
+
+    Parameters
+    ----------
+    fnm : str
+        Name of the qdata.txt file
+
+    Returns
+    -------
+    OrderedDict
+        For each keyword in qdata_keys, a tuple containing an array of
+        all the numbers on the lines with the keyword, and an array
+        with the number of values on each line
+    """
+    lines = OrderedDict([(key, []) for key in qdata_keys])
+    for line in open(fnm):
+        sline = line.split(None, 1)
+        if len(sline) == 2 and sline[0] in lines:
+            lines[sline[0]].append(sline[1])
+    Answer = OrderedDict()
+    for key, klines in lines.items():
+        counts = np.array([len(l.split()) for l in klines], dtype=int)
+        vals = np.fromstring(' '.join(klines), sep=' ') if len(klines) > 0 else np.zeros(0)
+        if len(vals) != np.sum(counts):
+            logger.error("Failed to read numbers from %s lines in %s\n" % (key, fnm))
+            raise RuntimeError
+        Answer[key] = (vals, counts)
+    return Answer
+
+def read_qdata(fnm, cache=True):
+    """
+    Read the reference data from a qdata.txt file, using a binary
+    cache file (e.g. qdata.cache.npz) when possible.  The cache file is
+    written the first time the qdata.txt file is parsed, and it is used
+    as long as the MD5 checksum of qdata.txt stays the same.
+
+    Parameters
+    ----------
+    fnm : str
+        Name of the qdata.txt file
+    cache : bool, default=True
+        Read and write the cache file
+
+    Returns
+    -------
+    OrderedDict
+        For each keyword in qdata_keys, the values on each line.
+        This is a 2-D array if all lines have the same number of values,
+        otherwise a list of 1-D arrays.  Missing keywords give an empty list.
+    """
+    cfnm = os.path.splitext(fnm)[0] + '.cache.npz'
+    data = None
+    if cache:
+        md5 = hashlib.md5(open(fnm, 'rb').read()).hexdigest()
+        if os.path.exists(cfnm):
+            try:
+                with np.load(cfnm) as npz:
+                    if str(npz['md5']) == md5:
+                        data = OrderedDict([(key, (npz[key+'_vals'], npz[key+'_counts'])) for key in qdata_keys])
+            except Exception:
+                warn_once("Unable to read %s, parsing %s instead" % (cfnm, fnm))
+    if data is None:
+        data = parse_qdata(fnm)
+        if cache:
+            arrays = {'md5' : np.array(md5)}
+            for key, (vals, counts) in data.items():
+                arrays[key+'_vals'] = vals
+                arrays[key+'_counts'] = counts
+            try:
+                np.savez(cfnm, **arrays)
+            except (IOError, OSError):
+                warn_once("Unable to write the qdata cache file %s" % cfnm)
+    Answer = OrderedDict()
+    for key, (vals, counts) in data.items():
+        if len(counts) == 0:
+            Answer[key] = []
+        elif (counts == counts[0]).all():
+            Answer[key] = vals.reshape(len(counts), counts[0])
+        else:
+            Answer[key] = np.split(vals, np.cumsum(counts)[:-1])
+    return Answer
+
 def norm2(arr, a=0, n=None, step=3):
     """
     Given a one-dimensional array, return the norm-squared of
@@ -54,6 +146,28 @@ def norm2(arr, a=0, n=None, step=3):
         answer.append(np.dot(d,d))
     return np.array(answer)
 
+def esp_invdist(espxyz, xyz, dtype=np.float64):
+    """
+    Inverse distances between ESP grid points and particles, computed
+    by broadcasting over all pairs.
+
+    Parameters
+    ----------
+    espxyz : np.ndarray
+        ESP grid point coordinates in Angstrom, shape (..., nesp, 3)
+    xyz : np.ndarray
+        Particle coordinates in Angstrom, shape (..., nparticles, 3)
+    dtype : np.dtype, default=np.float64
+        Data type of the returned array
+
+    Returns
+    -------
+    np.ndarray
+        Inverse distances in atomic units (1/bohr), shape (..., nesp, nparticles)
+    """
+    dx = np.asarray(espxyz)[..., :, np.newaxis, :] - np.asarray(xyz)[..., np.newaxis, :, :]
+    return (bohrang / np.sqrt(np.sum(dx*dx, axis=-1))).astype(dtype)
+
 class AbInitio(Target):
 
     """ Subclass of Target for fitting force fields to ab initio data.
@@ -77,6 +191,9 @@ class AbInitio(Target):
     read output is still required).  The 'get' method can be overridden
     by subclasses like AbInitio_GMX."""
 
+    ## The ESP inverse distance matrix and its cache can be very large.
+    async_nosync = ['invdists', 'invdist_cache', 'buildx', 'save_vmvals']
+
     def __init__(self,options,tgt_opts,forcefield):
         """
         Initialization; define a few core concepts.
@@ -128,6 +245,14 @@ class AbInitio(Target):
         self.set_option(options,'have_vsite','have_vsite')
         ## Attenuate the weights as a function of energy
         self.set_option(tgt_opts,'attenuate','attenuate')
+        ## Cache the data from qdata.txt in a binary file
+        self.set_option(tgt_opts,'qdata_cache','qdata_cache')
+        ## Number of snapshots to sum over at once when building the objective function
+        self.set_option(tgt_opts,'snapshot_chunk','snapshot_chunk')
+        ## Store the finite difference derivatives in a scratch file instead of memory
+        self.set_option(tgt_opts,'dm_scratch','dm_scratch')
+        ## Store the ESP inverse distance matrix in single precision
+        self.set_option(tgt_opts,'resp_float32','resp_float32')
         ## What is the energy denominator? (Valid for 'attenuate')
         self.set_option(tgt_opts,'energy_denom','energy_denom')
         ## Set upper cutoff energy
@@ -192,9 +317,21 @@ class AbInitio(Target):
         self.buildx = True
         ## Save the mvals from the last time we updated the vsites.
         self.save_vmvals = {}
+        ## Particle positions and inverse distance matrix from the last time it was built.
+        self.invdist_cache = None
         self.set_option(None, 'shots', val=self.ns)
 
     def build_invdist(self, mvals):
+        """
+        Build the (ns, nesp, nparticles) tensor of inverse distances
+        between the ESP grid points and the particles.
+
+        The tensor is built in chunks of snapshot_chunk snapshots to
+        bound the temporary memory, and it is stored in single
+        precision if resp_float32 is set.  When virtual site parameters
+        change, only the columns of particles whose positions moved are
+        recomputed.
+        """
         for i in self.pgrad:
             if 'VSITE' in self.FF.plist[i]:
                 if i in self.save_vmvals and mvals[i] != self.save_vmvals[i]:
@@ -205,30 +342,74 @@ class AbInitio(Target):
             logger.info("\rGenerating virtual site positions.%s" % (" "*30))
             pvals = self.FF.make(mvals)
             self.mol.xyzs = self.engine.generate_positions()
+        dtype = np.float32 if self.resp_float32 else np.float64
+        xyzs = np.array(self.mol.xyzs)
         # prepare the distance matrix for esp computations
-        if len(self.espxyz) > 0:
-            invdists = []
-            logger.info("\rPreparing the distance matrix... it will have %i * %i * %i = %i elements" % (self.ns, self.nesp, self.nparticles, self.ns * self.nesp * self.nparticles))
-            sn = 0
-            for espset, xyz in zip(self.espxyz, self.mol.xyzs):
-                logger.info("\rGenerating ESP distances for snapshot %i%s\r" % (sn, " "*50))
-                esparr = np.array(espset).reshape(-1,3)
-                # Create a matrix with Nesp rows and Natoms columns.
-                DistMat = np.array([[np.linalg.norm(i - j) for j in xyz] for i in esparr])
-                invdists.append(1. / (DistMat / bohrang))
-                sn += 1
+        if len(self.espxyz) == 0:
+            invdists = np.zeros((self.ns, 0, self.nparticles), dtype=dtype)
+        else:
+            espxyz = np.array(self.espxyz).reshape(self.ns, -1, 3)
+            if self.invdist_cache is not None and self.invdist_cache[0].shape == xyzs.shape:
+                # Only recompute the columns of particles that have moved (i.e. virtual sites).
+                xyzs0, invdists0 = self.invdist_cache
+                cols = np.nonzero(np.any(np.any(xyzs != xyzs0, axis=2), axis=0))[0]
+                logger.info("\rUpdating the distance matrix for %i particles%s" % (len(cols), " "*30))
+                # Copy because the previous matrix may still be in use (e.g. in finite difference).
+                invdists = invdists0.copy()
+            else:
+                cols = np.arange(self.nparticles)
+                logger.info("\rPreparing the distance matrix... it will have %i * %i * %i = %i elements" % (self.ns, self.nesp, self.nparticles, self.ns * self.nesp * self.nparticles))
+                invdists = np.empty((self.ns, self.nesp, self.nparticles), dtype=dtype)
+            if len(cols) > 0:
+                chunk = self.snapshot_chunk if self.snapshot_chunk > 0 else self.ns
+                for sn in range(0, self.ns, chunk):
+                    logger.info("\rGenerating ESP distances for snapshot %i%s\r" % (sn, " "*50))
+                    invdists[sn:sn+chunk, :, cols] = esp_invdist(espxyz[sn:sn+chunk], xyzs[sn:sn+chunk][:, cols], dtype=dtype)
+            self.invdist_cache = (xyzs, invdists)
         for i in self.pgrad:
             if 'VSITE' in self.FF.plist[i]:
                 self.save_vmvals[i] = mvals[i]
         self.buildx = False
-        return np.array(invdists)
+        return invdists
 
-    def compute_netforce_torque(self, xyz, force, QM=False):
-        # Convert an array of (3 * n_atoms) atomistic forces
-        # to an array of (3 * (n_forces + n_torques)) net forces and torques.
-        # This code is rather slow.  It requires the system to have a list
-        # of masses and blocking numbers.
+    def vsite_invdist_derivatives(self, mvals, p):
+        """
+        First and second derivatives of the inverse distance tensor with
+        respect to a virtual site parameter, by central difference.
+
+        Only the columns of the particles that the parameter moves are
+        computed, and they are always computed in double precision; the
+        finite difference amplifies rounding errors by 1/h and 1/h^2,
+        which would destroy the derivatives if they were computed from
+        the single precision tensor (see resp_float32).
 
+        @param[in] mvals Mathematical parameter values
+        @param[in] p Index of the virtual site parameter
+        @return cols Indices of the particles that move
+        @return dV First derivatives, shape (ns, nesp, len(cols))
+        @return d2V Second derivatives, shape (ns, nesp, len(cols))
+        """
+        espxyz = np.array(self.espxyz).reshape(self.ns, -1, 3)
+        xyzs = OrderedDict()
+        for d in [-1, 0, 1]:
+            mvals_ = np.array(mvals, dtype=float)
+            mvals_[p] += d*self.h
+            self.FF.make(mvals_)
+            xyzs[d] = np.array(self.engine.generate_positions())
+        cols = np.nonzero(np.any(np.any((xyzs[1] != xyzs[0]) | (xyzs[-1] != xyzs[0]), axis=2), axis=0))[0]
+        V = dict([(d, esp_invdist(espxyz, xyz[:, cols])) for d, xyz in xyzs.items()])
+        return cols, (V[1] - V[-1]) / (2*self.h), (V[1] - 2*V[0] + V[-1]) / self.h**2
+
+    def build_nft_projector(self):
+        """
+        Build the mapping from atoms to the blocks (molecules, residues
+        or charge groups) used for net forces and torques.  This only
+        depends on self.AtomLists, so it is done once per target.
+
+        The fitting atoms are sorted by block, so that sums over the
+        atoms in each block can be done for many frames at once with
+        np.add.reduceat.
+        """
         kwds = {"MoleculeNumber" : "molecule",
                 "ResidueNumber" : "residue",
                 "ChargeGroupNumber" : "chargegroup"}
@@ -241,61 +422,84 @@ class AbInitio(Target):
         else:
             logger.error('force_map keyword "%s" is invalid. Please choose from: %s\n' % (self.force_map, ', '.join(['"%s"' % kwds[k] for k in self.AtomLists.keys() if k in kwds])))
             raise RuntimeError
-
         nft = len(self.fitatoms)
+        # Indices of the true atoms among the particles
+        mask = np.nonzero(np.array(self.AtomMask))[0]
+        Block = np.array(Block)[mask][:nft]
+        Mass = np.array(self.AtomLists['Mass'], dtype=float)[mask][:nft]
+        # Block index of each atom; the blocks are in sorted order of their labels.
+        blocks, bidx = np.unique(Block, return_inverse=True)
+        order = np.argsort(bidx, kind='mergesort')
+        count = np.bincount(bidx, minlength=len(blocks))
+        Proj = {'mask' : mask,
+                'order' : order,
+                # Position of the first atom of each block in the sorted order
+                'starts' : np.append(0, np.cumsum(count)[:-1]),
+                # Block index of each atom in the sorted order
+                'bidx' : bidx[order],
+                # Mass fraction of each atom in its block, for the center of mass
+                'mfrac' : (Mass / np.bincount(bidx, weights=Mass)[bidx])[order],
+                # Torques are only included for blocks with more than one atom
+                'tqblk' : np.nonzero(count > 1)[0]}
+        return Proj
+
+    def compute_netforce_torque(self, xyz, force, QM=False):
+        """
+        Convert atomistic forces to net forces and torques on blocks of atoms.
+
+        Parameters
+        ----------
+        xyz : np.ndarray
+            Coordinates of the particles or true atoms, shape (natoms, 3)
+            or (nframes, natoms, 3)
+        force : np.ndarray
+            Forces on the particles or true atoms, shape (3*natoms)
+            or (nframes, 3*natoms)
+
+        Returns
+        -------
+        np.ndarray
+            Net forces followed by torques, shape (3*(nnf+ntq)) or
+            (nframes, 3*(nnf+ntq))
+        """
+        if getattr(self, 'nft_proj', None) is None:
+            self.nft_proj = self.build_nft_projector()
+        Proj = self.nft_proj
+        force = np.asarray(force)
+        single = (force.ndim == 1)
         # Number of particles that the force is acting on
-        nfp = force.reshape(-1,3).shape[0]
+        frc = force.reshape(1 if single else force.shape[0], -1, 3)
+        nfp = frc.shape[1]
+        xyz = np.asarray(xyz).reshape(frc.shape[0], -1, 3)
         # Number of particles in the XYZ coordinates
-        nxp = xyz.shape[0]
+        nxp = xyz.shape[1]
+        nft = len(self.fitatoms)
         # Number of particles in self.AtomLists
         npr = len(self.AtomMask)
         # Number of true atoms
         nat = sum(self.AtomMask)
 
-        mask = np.array([i for i in range(npr) if self.AtomMask[i]])
-
         if nfp not in [npr, nat]:
             logger.error('Force contains %i particles but expected %i or %i\n' % (nfp, npr, nat))
             raise RuntimeError
-        elif nfp == nat:
-            frc1 = force.reshape(-1,3)[:nft].flatten()
         elif nfp == npr:
-            frc1 = force.reshape(-1,3)[mask][:nft].flatten()
-
+            frc = frc[:, Proj['mask']]
         if nxp not in [npr, nat]:
-            logger.error('Coordinates contains %i particles but expected %i or %i\n' % (nfp, npr, nat))
+            logger.error('Coordinates contains %i particles but expected %i or %i\n' % (nxp, npr, nat))
             raise RuntimeError
-        elif nxp == nat:
-            xyz1 = xyz[:nft]
         elif nxp == npr:
-            xyz1 = xyz[mask][:nft]
-
-        Block = list(np.array(Block)[mask])[:nft]
-        Mass = np.array(self.AtomLists['Mass'])[mask][:nft]
-
-        NetForces = []
-        Torques = []
-        for b in sorted(set(Block)):
-            AtomBlock = np.array([i for i in range(len(Block)) if Block[i] == b])
-            CrdBlock = np.array(list(itertools.chain(*[range(3*i, 3*i+3) for i in AtomBlock])))
-            com = np.sum(xyz1[AtomBlock]*np.outer(Mass[AtomBlock],np.ones(3)), axis=0) / np.sum(Mass[AtomBlock])
-            frc = frc1[CrdBlock].reshape(-1,3)
-            NetForce = np.sum(frc, axis=0)
-            xyzb = xyz1[AtomBlock]
-            Torque = np.zeros(3)
-            for a in range(len(xyzb)):
-                R = xyzb[a] - com
-                F = frc[a]
-                # I think the unit of torque is in nm x kJ / nm.
-                Torque += np.cross(R, F) / 10
-            NetForces += [i for i in NetForce]
-            # Increment the torques only if we have more than one atom in our block.
-            if len(xyzb) > 1:
-                Torques += [i for i in Torque]
-        netfrc_torque = np.array(NetForces + Torques)
-        self.nnf = len(NetForces)/3
-        self.ntq = len(Torques)/3
-        return netfrc_torque
+            xyz = xyz[:, Proj['mask']]
+        # Sort the fitting atoms by block.
+        frc = frc[:, :nft][:, Proj['order']]
+        xyz = xyz[:, :nft][:, Proj['order']]
+        NetForces = np.add.reduceat(frc, Proj['starts'], axis=1)
+        com = np.add.reduceat(xyz * Proj['mfrac'][np.newaxis, :, np.newaxis], Proj['starts'], axis=1)
+        # I think the unit of torque is in nm x kJ / nm.
+        Torques = np.add.reduceat(np.cross(xyz - com[:, Proj['bidx']], frc), Proj['starts'], axis=1)[:, Proj['tqblk']] / 10
+        netfrc_torque = np.hstack((NetForces.reshape(frc.shape[0], -1), Torques.reshape(frc.shape[0], -1)))
+        self.nnf = NetForces.shape[1]
+        self.ntq = Torques.shape[1]
+        return netfrc_torque[0] if single else netfrc_torque
 
     def read_reference_data(self):
 
@@ -339,18 +543,12 @@ class AbInitio(Target):
         with horrible weights, InfoContent is closer to one.
 
         """
-        # Parse the qdata.txt file
-        for line in open(os.path.join(self.root,self.qfnm)):
-            sline = line.split()
-            if len(sline) == 0: continue
-            elif sline[0] == 'ENERGY':
-                self.eqm.append(float(sline[1]))
-            elif sline[0] == 'FORCES':
-                self.fqm.append([float(i) for i in sline[1:]])
-            elif sline[0] == 'ESPXYZ':
-                self.espxyz.append([float(i) for i in sline[1:]])
-            elif sline[0] == 'ESPVAL':
-                self.espval.append([float(i) for i in sline[1:]])
+        # Parse the qdata.txt file (or read the cached data if the file hasn't changed)
+        qdata = read_qdata(os.path.join(self.root,self.qfnm), cache=self.qdata_cache)
+        self.eqm = [e[0] for e in qdata['ENERGY']]
+        self.fqm = qdata['FORCES']
+        self.espxyz = qdata['ESPXYZ']
+        self.espval = qdata['ESPVAL']
 
         # Ensure that all lists are of length self.ns
         self.eqm = self.eqm[:self.ns]
@@ -401,7 +599,7 @@ class AbInitio(Target):
                     else:
                         logger.info("Fitting the forces on atoms %s\n" % commadash(self.fitatoms))
                         logger.info("Pruning the quantum force matrix...\n")
-                selct = list(itertools.chain(*[[3*i+j for j in range(3)] for i in self.fitatoms]))
+                selct = (3*np.array(self.fitatoms, dtype=int)[:, np.newaxis] + np.arange(3)).flatten()
                 self.fqm  = self.fqm[:, selct]
         else:
             self.fitatoms = []
@@ -428,10 +626,7 @@ class AbInitio(Target):
         # At this point, self.fqm is a (number of snapshots) x (3 x number of atoms) array.
         # Now we can transform it into a (number of snapshots) x (3 x number of residues + 3 x number of residues) array.
         if self.use_nft:
-            self.nftqm = []
-            for i in range(len(self.fqm)):
-                self.nftqm.append(self.compute_netforce_torque(self.mol.xyzs[i], self.fqm[i]))
-            self.nftqm = np.array(self.nftqm)
+            self.nftqm = self.compute_netforce_torque(np.array(self.mol.xyzs[:len(self.fqm)]), self.fqm)
             self.fref = np.hstack((self.fqm, self.nftqm))
         else:
             self.fref = self.fqm
@@ -479,6 +674,8 @@ class AbInitio(Target):
                                        "%.3f" % self.w_resp,
                                        "%8.4f" % self.esp_ctr]
         self.printcool_table(data=Data, headings=Headings, color=0)
+        if self.resp and hasattr(self, 'resp_timing'):
+            logger.info("RESP timings: %s\n" % ', '.join(["%s %.3f s" % (k, v) for k, v in self.resp_timing.items()]))
         if self.force:
             logger.info("Maximum force difference on atom %i (%s), frame %i, %8.4f kJ/mol/A\n" % (self.maxfatom, self.mol.elem[self.fitatoms[self.maxfatom]], self.maxfshot, self.maxdf/10))
 
@@ -502,12 +699,7 @@ class AbInitio(Target):
             selct = [0] + list(itertools.chain(*[[1+3*i+j for j in range(3)] for i in self.fitatoms]))
             M = M[:, selct]
             if self.use_nft:
-                Nfts = []
-                for i in range(len(M)):
-                    Fm  = M[i][1:]
-                    Nft = self.compute_netforce_torque(self.mol.xyzs[i], Fm)
-                    Nfts.append(Nft)
-                Nfts = np.array(Nfts)
+                Nfts = self.compute_netforce_torque(np.array(self.mol.xyzs[:len(M)]), M[:, 1:])
                 return np.hstack((M, Nfts))
             else:
                 return M
@@ -664,8 +856,14 @@ class AbInitio(Target):
         # once per snapshot, but requires memory.
         M_all = np.zeros((NS,NCP1))
         if AGrad and self.all_at_once:
-            dM_all = np.zeros((NS,NP,NCP1))
-            ddM_all = np.zeros((NS,NP,NCP1))
+            # Derivatives of the MM-quantities for the parameters in self.pgrad.
+            # These take up the most memory, so they may be stored in a scratch file
+            # (deleted when it is closed) instead.
+            if self.dm_scratch:
+                dM_file = tempfile.TemporaryFile(dir=os.getcwd())
+                dM_pg = np.memmap(dM_file, dtype=float, mode='w+', shape=(len(self.pgrad),NS,NCP1))
+            else:
+                dM_pg = np.zeros((len(self.pgrad),NS,NCP1))
         #==============================================================#
         #             STEP 2: Loop through the snapshots.              #
         #==============================================================#
@@ -674,103 +872,132 @@ class AbInitio(Target):
             M_all = self.energy_force_transform()
             if self.asym:
                 M_all[:, 0] -= M_all[self.smin, 0]
-            if AGrad or AHess:
+            if AGrad:
                 def callM(mvals_):
                     logger.debug("\r")
                     pvals = self.FF.make(mvals_)
                     return self.energy_force_transform()
-                for p in self.pgrad:
-                    dM_all[:,p,:], ddM_all[:,p,:] = f12d3p(fdwrap(callM, mvals, p), h = self.h, f0 = M_all)
-                    if self.asym:
-                        dM_all[:, p, 0] -= dM_all[self.smin, p, 0]
-                        ddM_all[:, p, 0] -= ddM_all[self.smin, p, 0]
+                # The second derivatives are not used (Gauss-Newton Hessian), so they aren't stored.
+                self.fd_pool(callM, mvals, f0 = M_all, out = (dM_pg, None))
+                if self.asym:
+                    dM_pg[:, :, 0] -= dM_pg[:, self.smin, 0][:, np.newaxis]
         if self.force and not in_fd():
             self.maxfatom = -1
             self.maxfshot = -1
             self.maxdf = 0.0
-        for i in range(NS):
-            if i % 100 == 0:
-                logger.debug("\rIncrementing quantities for snapshot %i\r" % i)
-            # Build Boltzmann weights and increment partition function.
-            P   = self.boltz_wts[i]
-            Z  += P
-            # Load reference (QM) data
-            Q[0] = self.eqm[i]
+        if self.all_at_once:
+            #==============================================================#
+            #      STEP 2a: Sum over all snapshots at once, including      #
+            #               the gradients and Hessian.                     #
+            #==============================================================#
+            logger.debug("\rIncrementing quantities for all snapshots\r")
+            Q_all = np.zeros((NS,NCP1))
+            Q_all[:,0] = self.eqm
             if self.force:
-                Q[1:] = self.fref[i,:].copy()
-            QQ     = Q*Q
-            # Call the simulation software to get the MM quantities
-            # (or load from M_all array)
-            if self.all_at_once:
-                M = M_all[i]
-            else:
-                if i % 100 == 0:
-                    logger.debug("Shot %i\r" % i)
-                M = self.energy_force_transform_one(i)
-                M_all[i,:] = M.copy()
-            # MM - QM difference
-            X     = M-Q
-            boost   = 1.0
+                Q_all[:,1:] = self.fref
             # For asymmetric fit, MM energies lower than QM are given a boost factor
-            if self.asym and X[0] < 0.0:
-                boost = self.energy_asymmetry
+            boost = np.ones(NS)
+            if self.asym:
+                boost[M_all[:,0] < Q_all[:,0]] = self.energy_asymmetry
             # Save information about forces
-            if self.force:
+            if self.force and not in_fd():
                 # Norm-squared of force differences for each atom
-                dfrc2 = norm2(M-Q, 1, nat)
-                if not in_fd() and np.max(dfrc2) > self.maxdf:
+                dfrc2 = np.sum(((M_all-Q_all)[:,1:3*nat+1].reshape(NS,nat,3))**2, axis=2)
+                if np.max(dfrc2) > 0.0:
+                    self.maxfshot, self.maxfatom = np.unravel_index(np.argmax(dfrc2), dfrc2.shape)
                     self.maxdf = np.sqrt(np.max(dfrc2))
-                    self.maxfatom = np.argmax(dfrc2)
-                    self.maxfshot = i
-            # Increment the average quantities
-            # The [0] indicates that we are fitting the RMS force and not the RMSD
-            # (without the covariance, subtracting a mean force doesn't make sense.)
-            # The rest of the array is empty.
-            M0[0] += P*M[0]
-            Q0[0] += P*Q[0]
-            X0[0] += P*X[0]
-            # We store all elements of the mean-squared QM quantities.
-            QQ0 += P*QQ
-            # Increment the objective function.
-            Xi     = X**2
-            Xi[0] *= boost
-            # SPX contains the sum over snapshots
-            SPX += P * Xi
-            #==============================================================#
-            #      STEP 2a: Increment gradients and mean quantities.       #
-            #==============================================================#
-            for p in self.pgrad:
-                if not AGrad: continue
-                if self.all_at_once:
-                    M_p[p] = dM_all[i, p]
-                    M_pp[p] = ddM_all[i, p]
-                else:
+            Sums = accumulate_snapshots(M_all, Q_all, self.boltz_wts, boost,
+                                        dM=(np.swapaxes(dM_pg, 0, 1) if AGrad else None), hess=(AGrad and AHess),
+                                        chunk=self.snapshot_chunk)
+            Z = Sums['Z']
+            M0 = Sums['M0']
+            Q0 = Sums['Q0']
+            X0 = Sums['X0']
+            QQ0 = Sums['QQ0']
+            SPX = Sums['SPX']
+            if AGrad:
+                M0_p[self.pgrad] = Sums['M0_p']
+                SPX_p[self.pgrad] = Sums['SPX_p']
+            if AGrad and AHess:
+                SPX_pq[np.ix_(self.pgrad,self.pgrad)] = Sums['SPX_pq']
+            if AGrad:
+                del dM_pg
+                if self.dm_scratch:
+                    dM_file.close()
+        else:
+            for i in range(NS):
+                if i % 100 == 0:
+                    logger.debug("\rIncrementing quantities for snapshot %i\r" % i)
+                # Build Boltzmann weights and increment partition function.
+                P   = self.boltz_wts[i]
+                Z  += P
+                # Load reference (QM) data
+                Q[0] = self.eqm[i]
+                if self.force:
+                    Q[1:] = self.fref[i,:].copy()
+                QQ     = Q*Q
+                # Call the simulation software to get the MM quantities
+                if i % 100 == 0:
+                    logger.debug("Shot %i\r" % i)
+                M = self.energy_force_transform_one(i)
+                M_all[i,:] = M.copy()
+                # MM - QM difference
+                X     = M-Q
+                boost   = 1.0
+                # For asymmetric fit, MM energies lower than QM are given a boost factor
+                if self.asym and X[0] < 0.0:
+                    boost = self.energy_asymmetry
+                # Save information about forces
+                if self.force:
+                    # Norm-squared of force differences for each atom
+                    dfrc2 = norm2(M-Q, 1, nat)
+                    if not in_fd() and np.max(dfrc2) > self.maxdf**2:
+                        self.maxdf = np.sqrt(np.max(dfrc2))
+                        self.maxfatom = np.argmax(dfrc2)
+                        self.maxfshot = i
+                # Increment the average quantities
+                # The [0] indicates that we are fitting the RMS force and not the RMSD
+                # (without the covariance, subtracting a mean force doesn't make sense.)
+                # The rest of the array is empty.
+                M0[0] += P*M[0]
+                Q0[0] += P*Q[0]
+                X0[0] += P*X[0]
+                # We store all elements of the mean-squared QM quantities.
+                QQ0 += P*QQ
+                # Increment the objective function.
+                Xi     = X**2
+                Xi[0] *= boost
+                # SPX contains the sum over snapshots
+                SPX += P * Xi
+                #==============================================================#
+                #      STEP 2a: Increment gradients and mean quantities.       #
+                #==============================================================#
+                for p in self.pgrad:
+                    if not AGrad: continue
                     def callM(mvals_):
                         if i % 100 == 0:
                             logger.debug("\r")
                         pvals = self.FF.make(mvals_)
                         return self.energy_force_transform_one(i)
                     M_p[p],M_pp[p] = f12d3p(fdwrap(callM, mvals, p), h = self.h, f0 = M)
-                if all(M_p[p] == 0): continue
-                M0_p[p][0]  += P * M_p[p][0]
-                Xi_p        = 2 * X * M_p[p]
-                Xi_p[0]    *= boost
-                SPX_p[p] += P * Xi_p
-                if not AHess: continue
-                if self.all_at_once:
-                    M_pp[p] = ddM_all[i, p]
-                # This formula is more correct, but perhapsively convergence is slower.
-                #Xi_pq       = 2 * (M_p[p] * M_p[p] + X * M_pp[p])
-                # Gauss-Newton formula for approximate Hessian
-                Xi_pq       = 2 * (M_p[p] * M_p[p])
-                Xi_pq[0]   *= boost
-                SPX_pq[p,p] += P * Xi_pq
-                for q in range(p):
-                    if all(M_p[q] == 0): continue
-                    if q not in self.pgrad: continue
-                    Xi_pq          = 2 * M_p[p] * M_p[q]
-                    Xi_pq[0]      *= boost
-                    SPX_pq[p,q] += P * Xi_pq
+                    if all(M_p[p] == 0): continue
+                    M0_p[p][0]  += P * M_p[p][0]
+                    Xi_p        = 2 * X * M_p[p]
+                    Xi_p[0]    *= boost
+                    SPX_p[p] += P * Xi_p
+                    if not AHess: continue
+                    # This formula is more correct, but perhapsively convergence is slower.
+                    #Xi_pq       = 2 * (M_p[p] * M_p[p] + X * M_pp[p])
+                    # Gauss-Newton formula for approximate Hessian
+                    Xi_pq       = 2 * (M_p[p] * M_p[p])
+                    Xi_pq[0]   *= boost
+                    SPX_pq[p,p] += P * Xi_pq
+                    for q in range(p):
+                        if all(M_p[q] == 0): continue
+                        if q not in self.pgrad: continue
+                        Xi_pq          = 2 * M_p[p] * M_p[q]
+                        Xi_pq[0]      *= boost
+                        SPX_pq[p,q] += P * Xi_pq
 
         #==============================================================#
         #         STEP 2b: Write energies and forces to disk.          #
@@ -934,111 +1161,114 @@ class AbInitio(Target):
         Answer = {'X':X2, 'G':G, 'H':H}
         return Answer
 
-    def get_resp(self, mvals, AGrad=False, AHess=False):
-        """ Electrostatic potential fitting.  Implements the RESP objective function.  (In Python so obviously not optimized.) """
-        if (self.w_resp == 0.0):
-            AGrad = False
-            AHess = False
-        Answer = {}
-        pvals = self.FF.make(mvals)
-
-        # Build the distance matrix for ESP fitting.
-        self.invdists = self.build_invdist(mvals)
-
-        NS = self.ns
+    def charge_derivatives(self, mvals, charge0):
+        """
+        Derivatives of the charges with respect to the mathematical
+        parameters in self.pgrad, shape (len(self.pgrad), nparticles).
+
+        Charges are linear in the physical charge parameters, so their
+        derivatives are obtained from one unit displacement of each
+        physical parameter and mapped onto the mathematical parameters
+        using the transformation matrix.  Finite difference is used for
+        the other parameters, if the mapping is not linear, or if the
+        parameter affects an evaluated parameter field (which may be
+        a nonlinear function of it).
+        """
         NP = self.FF.np
-        Z = 0
-        Y = 0
+        dq = np.zeros((len(self.pgrad), len(charge0)))
+        concern = ['COUL','c0','charge']
+        linear = not (self.FF.logarithmic_map or self.FF.use_pvals or len(self.FF.redirect) > 0)
+        if linear:
+            tmI = np.array(self.FF.tmI)
+            isq = np.array([any([j in self.FF.plist[k] for j in concern]) for k in range(NP)])
+            pvals = self.FF.create_pvals(mvals)
+            # Parameters that change the value of any evaluated parameter field.
+            iscmd = np.array([cmd is not None for pid, fnm, ln, fld, mult, cmd in self.FF.pfields], dtype=bool)
+            dW = self.FF.field_derivatives(mvals, self.pgrad, self.h)
+            evaluated = np.any((dW != 0.0) & iscmd[np.newaxis, :], axis=1)
         def new_charges(mvals_):
             """ Return the charges acting on the system. """
             logger.debug("\r")
-            pvals = self.FF.make(mvals_)
+            self.FF.make(mvals_)
             return self.engine.get_charges()
+        dqdp = {}
+        for ip, i in enumerate(self.pgrad):
+            kidx = np.nonzero(tmI[:,i])[0] if linear else []
+            if linear and np.all(isq[kidx]) and not evaluated[ip]:
+                for k in kidx:
+                    if k not in dqdp:
+                        dp = np.zeros(NP)
+                        dp[k] = 1.0
+                        self.FF.make(pvals + dp, use_pvals=True)
+                        dqdp[k] = self.engine.get_charges() - charge0
+                    dq[ip] += dqdp[k] * tmI[k, i]
+            else:
+                dq[ip] = f12d3p(fdwrap(new_charges,mvals,i), h = self.h, f0 = charge0)[0]
+        self.FF.make(mvals)
+        return dq
 
-            # Need to update the positions of atoms, if there are virtual sites.
-            # qvals = [pvals[i] for i in self.FF.qmap]
-            # # All of a sudden I need the number of virtual sites.
-            # qatoms = np.zeros(self.nparticles)
-            # for i, jj in enumerate(self.FF.qid):
-            #     for j in jj:
-            #         qatoms[j] = qvals[i]
-            # return qatoms
-
-        # Obtain a derivative matrix the stupid way
-        charge0 = new_charges(mvals)
-        if AGrad:
-            # dqPdqM = []
-            # for i in range(NP):
-            #     print "Now working on parameter number", i
-            #     dqPdqM.append(f12d3p(fdwrap(new_charges,mvals,i), h = self.h)[0])
-            # dqPdqM = mat(dqPdqM).T
-            dqPdqM = np.matrix([(f12d3p(fdwrap(new_charges,mvals,i), h = self.h, f0 = charge0)[0] if i in self.pgrad else np.zeros_like(charge0)) for i in range(NP)]).T
-        xyzs = np.array(self.mol.xyzs)
-        espqvals = np.array(self.espval)
-        espxyz   = np.array(self.espxyz)
-
+    def get_resp(self, mvals, AGrad=False, AHess=False):
+        """ Electrostatic potential fitting.  Implements the RESP objective function using array operations over all snapshots. """
+        if (self.w_resp == 0.0):
+            AGrad = False
+            AHess = False
+        NP = self.FF.np
+        t0 = time.time()
+        # Build the distance matrix for ESP fitting.
+        self.invdists = self.build_invdist(mvals)
+        t1 = time.time()
+        # The charges are only computed once for this set of parameters.
+        pvals = self.FF.make(mvals)
+        charge0 = self.engine.get_charges()
+        dqPdqM = None
+        # First and second derivatives of the inverse distance matrix with respect to the virtual site parameters
         ddVdqPdVS = {}
-        # Second derivative of the inverse distance matrix with respect to the virtual site position
         dddVdqPdVS2 = {}
+        # The particles (columns of the inverse distance matrix) that each virtual site parameter moves
+        dVcols = {}
         if AGrad:
-            for p in self.pgrad:
+            dqPdqM = self.charge_derivatives(mvals, charge0)
+            for ip, p in enumerate(self.pgrad):
                 if 'VSITE' in self.FF.plist[p]:
-                    ddVdqPdVS[p], dddVdqPdVS2[p] = f12d3p(fdwrap(self.build_invdist,mvals,p), h = self.h, f0 = self.invdists)
-        X = 0
-        Q = 0
-        D = 0
+                    dVcols[ip], ddVdqPdVS[ip], dddVdqPdVS2[ip] = self.vsite_invdist_derivatives(mvals, p)
+            if len(ddVdqPdVS) > 0:
+                self.FF.make(mvals)
+        t2 = time.time()
+        Sums = resp_objective(self.invdists, charge0, np.array(self.espval), np.array(self.boltz_wts), dq=dqPdqM,
+                              dV=ddVdqPdVS, d2V=dddVdqPdVS2, dVcols=dVcols, hess=AHess, chunk=self.snapshot_chunk)
+        t3 = time.time()
+        # Redundant but we keep it anyway
+        Z = np.sum(self.boltz_wts)
+        D = Sums['D'] / Z
+        X = Sums['X'] / Z / D
+        Q = Sums['Q'] / Z / D
         G = np.zeros(NP)
         H = np.zeros((NP, NP))
-        for i in range(self.ns):
-            P   = self.boltz_wts[i]
-            Z  += P
-            dVdqP   = np.matrix(self.invdists[i])
-            espqval = espqvals[i]
-            espmval = dVdqP * col(new_charges(mvals))
-            desp    = flat(espmval) - espqval
-            X      += P * np.dot(desp, desp) / self.nesp
-            Q      += P * np.dot(espqval, espqval) / self.nesp
-            D      += P * (np.dot(espqval, espqval) / self.nesp - (np.sum(espqval) / self.nesp)**2)
-            if AGrad:
-                dVdqM   = (dVdqP * dqPdqM).T
-                for p, vsd in ddVdqPdVS.items():
-                    dVdqM[p,:] += flat(vsd[i] * col(new_charges(mvals)))
-                G      += flat(P * 2 * dVdqM * col(desp)) / self.nesp
-                if AHess:
-                    d2VdqM2 = np.zeros(dVdqM.shape)
-                    for p, vsd in dddVdqPdVS2.items():
-                        d2VdqM2[p,:] += flat(vsd[i] * col(new_charges(mvals)))
-                    H      += np.array(P * 2 * (dVdqM * dVdqM.T + d2VdqM2 * col(desp))) / self.nesp
-        # Redundant but we keep it anyway
-        D /= Z
-        X /= Z
-        X /= D
-        G /= Z
-        G /= D
-        H /= Z
-        H /= D
-        Q /= Z
-        Q /= D
+        if AGrad:
+            G[self.pgrad] = Sums['G'] / Z / D
+            if AHess:
+                H[np.ix_(self.pgrad, self.pgrad)] = Sums['H'] / Z / D
         if not in_fd():
             self.esp_err = np.sqrt(X)
             self.esp_ref = np.sqrt(Q)
             self.esp_err_pct = self.esp_err / self.esp_ref
+            self.resp_timing = OrderedDict([('distances', t1-t0), ('charges', t2-t1), ('objective', t3-t2)])
 
         # Following is the restraint part
         # RESP hyperbola "strength" parameter; 0.0005 is weak, 0.001 is strong
         # RESP hyperbola "tightness" parameter; don't need to change this
         a = self.resp_a
         b = self.resp_b
-        q = new_charges(mvals)
+        q = charge0
         R   = a*np.sum((q**2 + b**2)**0.5 - b)
         dR  = a*q*(q**2 + b**2)**-0.5
         ddR = a*b**2*(q**2 + b**2)**-1.5
         self.respterm = R
         X += R
         if AGrad:
-            G += flat(dqPdqM.T * col(dR))
+            G[self.pgrad] += np.dot(dqPdqM, dR)
             if AHess:
-                H += np.diag(flat(dqPdqM.T * col(ddR)))
+                H[self.pgrad, self.pgrad] += np.dot(dqPdqM, ddR)
 
         if not in_fd():
             self.esp_trm = X
@@ -1104,6 +1334,152 @@ def compute_objective_part(SPX,QQ0,Q0,Z,a,n,energy=False,subtract_mean=False,div
         raise RuntimeError('Please pass either 0, 1, 2 to divide')
     return X2
 
+def accumulate_snapshots(M_all, Q_all, wts, boost, dM=None, hess=False, chunk=0):
+    """
+    Compute the weighted sums over snapshots that go into the energy and
+    force objective function, using array operations over all snapshots
+    at once instead of a loop over snapshots and parameters.
+
+    Parameters
+    ----------
+    M_all : np.ndarray
+        MM quantities for each snapshot, shape (NS, NCP1)
+    Q_all : np.ndarray
+        QM quantities for each snapshot, shape (NS, NCP1)
+    wts : np.ndarray
+        Boltzmann weights of the snapshots, shape (NS)
+    boost : np.ndarray
+        Factor multiplying the squared energy difference of each snapshot
+        (used for asymmetric fits), shape (NS)
+    dM : np.ndarray, optional
+        Derivatives of the MM quantities with respect to the parameters being
+        differentiated, shape (NS, NPG, NCP1)
+    hess : bool, default=False
+        Also compute the Gauss-Newton second derivatives (requires dM)
+    chunk : int, default=0
+        If nonzero, sum over this many snapshots at a time, so that the
+        temporary arrays (and the part of dM that is read from disk, if it
+        is memory-mapped) scale with the chunk size and not the number of snapshots
+
+    Returns
+    -------
+    dict
+        Z : sum of the weights;
+        M0, Q0, X0 : weighted sums of the MM energies, QM energies and their differences (first element only);
+        QQ0 : weighted sums of the squared QM quantities;
+        SPX : weighted sums of the squared differences;
+        M0_p, SPX_p : derivatives of M0 and SPX, shape (NPG, NCP1) (if dM is provided);
+        SPX_pq : second derivatives of SPX, shape (NPG, NPG, NCP1) (if hess is True)
+    """
+    NS, NCP1 = M_all.shape
+    wts = np.asarray(wts, dtype=float)
+    boost = np.asarray(boost, dtype=float)
+    if chunk > 0 and chunk < NS:
+        Answer = None
+        for i in range(0, NS, chunk):
+            Part = accumulate_snapshots(M_all[i:i+chunk], Q_all[i:i+chunk], wts[i:i+chunk], boost[i:i+chunk],
+                                        dM=(dM[i:i+chunk] if dM is not None else None), hess=hess)
+            if Answer is None:
+                Answer = Part
+            else:
+                for key in Answer:
+                    Answer[key] += Part[key]
+        return Answer
+    X_all = M_all - Q_all
+    Answer = OrderedDict()
+    Answer['Z'] = np.sum(wts)
+    for key, arr in [('M0', M_all), ('Q0', Q_all), ('X0', X_all)]:
+        Answer[key] = np.zeros(NCP1)
+        Answer[key][0] = np.dot(wts, arr[:, 0])
+    Answer['QQ0'] = np.dot(wts, Q_all**2)
+    # Weight of each element in the sums over snapshots; the energy is multiplied by the boost factor.
+    W = np.repeat(wts[:, np.newaxis], NCP1, axis=1)
+    W[:, 0] *= boost
+    Answer['SPX'] = np.sum(W * X_all**2, axis=0)
+    if dM is not None:
+        NPG = dM.shape[1]
+        Answer['M0_p'] = np.zeros((NPG, NCP1))
+        Answer['M0_p'][:, 0] = np.dot(wts, dM[:, :, 0])
+        Answer['SPX_p'] = 2 * np.einsum('ic,ipc->pc', W * X_all, dM)
+        if hess:
+            # Gauss-Newton formula for approximate Hessian; the matrix is symmetric
+            # so only the lower triangle is computed.
+            SPX_pq = np.zeros((NPG, NPG, NCP1))
+            for k in range(NPG):
+                SPX_pq[k, :k+1] = 2 * np.einsum('ic,iqc->qc', W * dM[:, k, :], dM[:, :k+1, :])
+                SPX_pq[:k, k] = SPX_pq[k, :k]
+            Answer['SPX_pq'] = SPX_pq
+    return Answer
+
+def resp_objective(invdists, charges, espvals, wts, dq=None, dV={}, d2V={}, dVcols={}, hess=False, chunk=0):
+    """
+    Compute the weighted sums over snapshots that go into the RESP
+    objective function, using contractions over the inverse distance
+    tensor instead of a loop over snapshots.
+
+    Parameters
+    ----------
+    invdists : np.ndarray
+        Inverse distances between ESP points and particles, shape (NS, NESP, NA)
+    charges : np.ndarray
+        Charges of the particles, shape (NA)
+    espvals : np.ndarray
+        Reference electrostatic potential, shape (NS, NESP)
+    wts : np.ndarray
+        Boltzmann weights of the snapshots, shape (NS)
+    dq : np.ndarray, optional
+        Derivatives of the charges with respect to the parameters being
+        differentiated, shape (NPG, NA)
+    dV : dict, optional
+        First derivatives of invdists with respect to parameter k (index into dq)
+        for parameters that move the particles (i.e. virtual sites)
+    d2V : dict, optional
+        Second derivatives of invdists, same keys as dV
+    dVcols : dict, optional
+        If a key of dV is present, its derivatives only contain these
+        columns (particles) of invdists; the other columns are zero
+    hess : bool, default=False
+        Also compute the Gauss-Newton second derivatives (requires dq)
+    chunk : int, default=0
+        If nonzero, sum over this many snapshots at a time
+
+    Returns
+    -------
+    dict
+        'X', 'Q', 'D' are the weighted sums of the squared ESP difference,
+        the squared reference ESP and its variance, each divided by NESP;
+        'G' and 'H' are the derivatives of 'X', shapes (NPG) and (NPG, NPG)
+    """
+    NS, NESP = espvals.shape
+    NPG = dq.shape[0] if dq is not None else 0
+    if chunk <= 0: chunk = NS
+    X = 0.0
+    Q = 0.0
+    D = 0.0
+    G = np.zeros(NPG)
+    H = np.zeros((NPG, NPG))
+    for i0 in range(0, NS, chunk):
+        i1 = min(i0+chunk, NS)
+        P = wts[i0:i1]
+        V = invdists[i0:i1]
+        espq = espvals[i0:i1]
+        desp = np.dot(V, charges) - espq
+        X += np.dot(P, np.sum(desp**2, axis=1)) / NESP
+        Q += np.dot(P, np.sum(espq**2, axis=1)) / NESP
+        D += np.dot(P, np.sum(espq**2, axis=1) / NESP - (np.sum(espq, axis=1) / NESP)**2)
+        if dq is None: continue
+        # Derivatives of the MM potential, shape (chunk, NESP, NPG)
+        J = np.dot(V, dq.T)
+        for k, dVk in dV.items():
+            J[:, :, k] += np.dot(dVk[i0:i1], charges[dVcols[k]] if k in dVcols else charges)
+        PJ = J * P[:, np.newaxis, np.newaxis]
+        G += 2 * np.einsum('nep,ne->p', PJ, desp) / NESP
+        if hess:
+            H += 2 * np.dot(PJ.reshape(-1, NPG).T, J.reshape(-1, NPG)) / NESP
+            for k, d2Vk in d2V.items():
+                H[k, k] += 2 * np.dot(P, np.sum(np.dot(d2Vk[i0:i1], charges[dVcols[k]] if k in dVcols else charges) * desp, axis=1)) / NESP
+    return {'X':X, 'Q':Q, 'D':D, 'G':G, 'H':H}
+
 def plot_mm_vs_qm(M, Q, title=''):
     import matplotlib.pyplot as plt
     qm_min_dx = np.argmin(Q)
@@ -238,8 +238,7 @@ class BindingEnergy(Target):
 
         dV = np.zeros((self.FF.np,len(V)))
         if AGrad or AHess:
-            for p in self.pgrad:
-                dV[p,:], _ = f12d3p(fdwrap(compute, mvals, p), h = self.h, f0 = V)
+            dV[self.pgrad,:], _ = self.fd_pool(compute, mvals, f0 = V)
 
         Answer['X'] = np.dot(V,V)
         for p in self.pgrad:
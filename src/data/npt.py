@@ -61,7 +61,7 @@ from copy import deepcopy
 from collections import namedtuple, OrderedDict
 from forcebalance.forcefield import FF
 from forcebalance.nifty import col, flat, lp_dump, lp_load, printcool, printcool_dictionary, statisticalInefficiency, which, _exec, isint, wopen, click
-from forcebalance.finite_difference import fdwrap, f1d2p, f12d3p, f1d7p, in_fd
+from forcebalance.finite_difference import fdwrap, f1d2p, f12d3p, f12d3p_pool, f12d3p_sweep, f1d7p, in_fd
 from forcebalance.molecule import Molecule
 from forcebalance.output import getLogger
 logger = getLogger(__name__)
@@ -140,20 +140,24 @@ def PrintEDA(EDA, N):
 #|            and properties                 |#
 #=============================================#
 
-def energy_derivatives(engine, FF, mvals, h, pgrad, length, AGrad=True, dipole=False):
+def energy_derivatives(engine, FF, mvals, h, pgrad, length, AGrad=True, dipole=False, nproc=1):
 
     """
     Compute the first and second derivatives of a set of snapshot
     energies with respect to the force field parameters.
 
     This basically calls the finite difference subroutine on the
-    energy_driver subroutine also in this script.
+    energy_driver subroutine also in this script.  When running in
+    serial, all of the displacements are evaluated in one call to the
+    engine's energy_sweep method.  Parameters that the energy depends
+    on linearly are differentiated analytically by the engine.
 
     @param[in] mvals Mathematical parameter values
     @param[in] h Finite difference step size
     @param[in] phase The phase (liquid, gas) to perform the calculation on
     @param[in] AGrad Switch to turn derivatives on or off; if off, return all zeros
     @param[in] dipole Switch for dipole derivatives.
+    @param[in] nproc Number of worker processes for the finite difference displacements
     @return G First derivative of the energies in a N_param x N_coord array
     @return GDx First derivative of the box dipole moment x-component in a N_param x N_coord array
     @return GDy First derivative of the box dipole moment y-component in a N_param x N_coord array
@@ -173,10 +177,21 @@ def energy_derivatives(engine, FF, mvals, h, pgrad, length, AGrad=True, dipole=F
         else:
             return engine.energy()
 
-    ED0      = energy_driver(mvals)
-    for i in pgrad:
-        logger.info("%i %s\r" % (i, (FF.plist[i] + " "*30)))
-        EDG, _   = f12d3p(fdwrap(energy_driver,mvals,i),h,f0=ED0)
+    # Parameters that the energy depends on linearly are differentiated
+    # analytically (they don't affect the dipole moment); the rest use finite difference.
+    AGs, pfd = engine.analytic_energy_derivatives(mvals, pgrad, h)
+    for i, AG in AGs.items():
+        G[i,:]   = AG
+    if len(pfd) == 0:
+        return G, GDx, GDy, GDz
+    if nproc > 1:
+        ED0      = energy_driver(mvals)
+        EDGs, _  = f12d3p_pool(energy_driver,mvals,pfd,h,f0=ED0,nproc=nproc,exclude=FF.fnms)
+    else:
+        # Evaluate all of the displacements in one pass over the trajectory;
+        # the central point is evaluated last so the force field ends up at mvals.
+        EDGs, _  = f12d3p_sweep(lambda mvals_list: engine.energy_sweep(mvals_list, dipole=dipole),mvals,pfd,h)
+    for EDG, i in zip(EDGs, pfd):
         if dipole:
             G[i,:]   = EDG[:,0]
             GDx[i,:] = EDG[:,1]
@@ -297,6 +312,8 @@ def main():
     # Finite difference step size
     h = TgtOptions['h']
     pgrad = TgtOptions['pgrad']
+    # Number of worker processes for finite difference displacements
+    fd_workers = TgtOptions.get('fd_workers', 1)
     # MD options; time step (fs), production steps, equilibration steps, interval for saving data (ps)
     liquid_timestep = TgtOptions['liquid_timestep']
     liquid_nsteps = TgtOptions['liquid_md_steps']
@@ -405,6 +422,14 @@ def main():
                                  ("nequil", gas_nequil), ("minimize", minimize), ("threads", 1), ("mts", mts),
                                  ("rpmd_beads", rpmd_beads), ("faststep", faststep)])
 
+    if engname == "openmm":
+        # Write checkpoints during the condensed phase simulation, so a restarted job resumes from the last one.
+        if TgtOptions.get('md_checkpoint', 0):
+            MDOpts["liquid"]["checkpoint"] = "liquid-md"
+        # Keep the condensed phase trajectory on disk instead of in memory.
+        if TgtOptions.get('md_stream', 0):
+            MDOpts["liquid"]["stream"] = "liquid-md"
+
     # Energy components analysis disabled for OpenMM MTS because it uses force groups
     if (engname == "openmm" and mts): logger.warn("OpenMM with MTS integrator; energy components analysis will be disabled.\n")
 
@@ -489,11 +514,11 @@ def main():
     # Compute the energy and dipole derivatives.
     printcool("Condensed phase energy and dipole derivatives\nInitializing array to length %i" % len(Energies), color=4, bold=True)
     click()
-    G, GDx, GDy, GDz = energy_derivatives(Liquid, FF, mvals, h, pgrad, len(Energies), AGrad, dipole=True)
+    G, GDx, GDy, GDz = energy_derivatives(Liquid, FF, mvals, h, pgrad, len(Energies), AGrad, dipole=True, nproc=fd_workers)
     logger.info("Condensed phase energy derivatives took %.3f seconds\n" % click())
     click()
     printcool("Gas phase energy derivatives", color=4, bold=True)
-    mG, _, __, ___ = energy_derivatives(Gas, FF, mvals, h, pgrad, len(mEnergies), AGrad, dipole=False)
+    mG, _, __, ___ = energy_derivatives(Gas, FF, mvals, h, pgrad, len(mEnergies), AGrad, dipole=False, nproc=fd_workers)
     logger.info("Gas phase energy derivatives took %.3f seconds\n" % click())
 
     #==============================================#
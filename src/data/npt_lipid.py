@@ -61,7 +61,7 @@ from copy import deepcopy
 from collections import namedtuple, OrderedDict
 from forcebalance.forcefield import FF
 from forcebalance.nifty import col, flat, lp_dump, lp_load, printcool, printcool_dictionary, statisticalInefficiency, which, _exec, isint, wopen
-from forcebalance.finite_difference import fdwrap, f1d2p, f12d3p, f1d7p, in_fd
+from forcebalance.finite_difference import fdwrap, f1d2p, f12d3p, f12d3p_pool, f12d3p_sweep, f1d7p, in_fd
 from forcebalance.molecule import Molecule
 from forcebalance.output import getLogger
 logger = getLogger(__name__)
@@ -143,19 +143,23 @@ def PrintEDA(EDA, N):
 #|            and properties                 |#
 #=============================================#
 
-def energy_derivatives(engine, FF, mvals, h, pgrad, length, AGrad=True, dipole=False):
+def energy_derivatives(engine, FF, mvals, h, pgrad, length, AGrad=True, dipole=False, nproc=1):
 
     """
     Compute the first and second derivatives of a set of snapshot
     energies with respect to the force field parameters.
 
     This basically calls the finite difference subroutine on the
-    energy_driver subroutine also in this script.
+    energy_driver subroutine also in this script.  When running in
+    serial, all of the displacements are evaluated in one call to the
+    engine's energy_sweep method.  Parameters that the energy depends
+    on linearly are differentiated analytically by the engine.
 
     @param[in] mvals Mathematical parameter values
     @param[in] h Finite difference step size
     @param[in] AGrad Switch to turn derivatives on or off; if off, return all zeros
     @param[in] dipole Switch for dipole derivatives.
+    @param[in] nproc Number of worker processes for the finite difference displacements
     @return G First derivative of the energies in a N_param x N_coord array
     @return GDx First derivative of the box dipole moment x-component in a N_param x N_coord array
     @return GDy First derivative of the box dipole moment y-component in a N_param x N_coord array
@@ -175,10 +179,21 @@ def energy_derivatives(engine, FF, mvals, h, pgrad, length, AGrad=True, dipole=F
         else:
             return engine.energy()
 
-    ED0      = energy_driver(mvals)
-    for i in pgrad:
-        logger.info("%i %s\r" % (i, (FF.plist[i] + " "*30)))
-        EDG, _   = f12d3p(fdwrap(energy_driver,mvals,i),h,f0=ED0)
+    # Parameters that the energy depends on linearly are differentiated
+    # analytically (they don't affect the dipole moment); the rest use finite difference.
+    AGs, pfd = engine.analytic_energy_derivatives(mvals, pgrad, h)
+    for i, AG in AGs.items():
+        G[i,:]   = AG
+    if len(pfd) == 0:
+        return G, GDx, GDy, GDz
+    if nproc > 1:
+        ED0      = energy_driver(mvals)
+        EDGs, _  = f12d3p_pool(energy_driver,mvals,pfd,h,f0=ED0,nproc=nproc,exclude=FF.fnms)
+    else:
+        # Evaluate all of the displacements in one pass over the trajectory;
+        # the central point is evaluated last so the force field ends up at mvals.
+        EDGs, _  = f12d3p_sweep(lambda mvals_list: engine.energy_sweep(mvals_list, dipole=dipole),mvals,pfd,h)
+    for EDG, i in zip(EDGs, pfd):
         if dipole:
             G[i,:]   = EDG[:,0]
             GDx[i,:] = EDG[:,1]
@@ -298,6 +313,8 @@ def main():
     # Finite difference step size
     h = TgtOptions['h']
     pgrad = TgtOptions['pgrad']
+    # Number of worker processes for finite difference displacements
+    fd_workers = TgtOptions.get('fd_workers', 1)
     # MD options; time step (fs), production steps, equilibration steps, interval for saving data (ps)
     lipid_timestep = TgtOptions['lipid_timestep']
     lipid_nsteps = TgtOptions['lipid_md_steps']
@@ -442,7 +459,7 @@ def main():
 
     # Compute the energy and dipole derivatives.
     printcool("Condensed phase energy and dipole derivatives\nInitializing array to length %i" % len(Energies), color=4, bold=True)
-    G, GDx, GDy, GDz = energy_derivatives(Lipid, FF, mvals, h, pgrad, len(Energies), AGrad, dipole=True)
+    G, GDx, GDy, GDz = energy_derivatives(Lipid, FF, mvals, h, pgrad, len(Energies), AGrad, dipole=True, nproc=fd_workers)
 
     #==============================================#
     #  Condensed phase properties and derivatives. #
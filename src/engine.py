@@ -92,3 +92,88 @@ class Engine(forcebalance.BaseClass):
 
     def prepare(self, **kwargs):
         return
+
+    def energy_sweep(self, mvals_list, dipole=False):
+
+        """
+        Compute the energies (and optionally dipoles) of the stored
+        trajectory for a list of parameter displacements.  This is the
+        generic implementation, which calls FF.make() and evaluates the
+        whole trajectory once for each set of parameters; engines that
+        can switch parameters in place should override it.
+
+        The force field is left in the state of the last displacement,
+        so the caller should call FF.make() again if needed.
+
+        @param[in] mvals_list List of mathematical parameter values
+        @param[in] dipole Switch for computing the dipole moments
+        @return ED Array of energies with shape (len(mvals_list), nframes),
+        or (len(mvals_list), nframes, 4) containing the energy and dipole moment if dipole is True.
+        """
+        ED = None
+        for k, mvals in enumerate(mvals_list):
+            self.FF.make(mvals)
+            ed = self.energy_dipole() if dipole else self.energy()
+            if ED is None:
+                ED = np.zeros((len(mvals_list),) + np.shape(ed))
+            ED[k] = ed
+        return ED
+
+    def linear_energy_derivatives(self):
+
+        """
+        Compute the derivatives of the energies of the stored
+        trajectory with respect to the force field parameter fields
+        that the energy depends on linearly (for example, harmonic
+        force constants), using the parameters from the last call to
+        FF.make().  These fields must not affect the dipole moment,
+        so that its derivative with respect to them is zero.  Engines that can decompose the energy in this way
+        should override this; the base class doesn't know of any.
+
+        @return dE OrderedDict mapping parameter field locations (file name, line number, field)
+        to the derivative of the energy of each frame
+        """
+        return OrderedDict()
+
+    def analytic_energy_derivatives(self, mvals, pgrad, h):
+
+        """
+        Compute the first derivatives of the energies of the stored
+        trajectory with respect to the parameters that the energy
+        depends on linearly, so they don't need to be computed by
+        finite difference.
+
+        A parameter qualifies if every parameter field that it
+        affects is one of the fields returned by
+        linear_energy_derivatives().  The derivatives of the field
+        values themselves (rescaling, evaluated parameters, etc.) come
+        from FF.field_derivatives, which doesn't require any energy
+        evaluations.
+
+        @param[in] mvals Mathematical parameter values
+        @param[in] pgrad List of active parameters for differentiation
+        @param[in] h Finite difference step size for the field values
+        @return G OrderedDict mapping parameter indices to the derivative of the energy of each frame
+        @return pfd List of parameters in pgrad that need to be differentiated by finite difference
+        """
+        pgrad = list(pgrad)
+        self.FF.make(mvals)
+        dE = self.linear_energy_derivatives()
+        G = OrderedDict()
+        if len(dE) == 0 or len(pgrad) == 0:
+            return G, pgrad
+        # If a field location appears more than once, the last value printed into it wins.
+        last = OrderedDict()
+        for j, (pid, fnm, ln, fld, mult, cmd) in enumerate(self.FF.pfields):
+            last[(fnm, ln, fld)] = j
+        dW = self.FF.field_derivatives(mvals, pgrad, h)
+        pfd = []
+        for n, i in enumerate(pgrad):
+            locs = [loc for loc, j in last.items() if dW[n, j] != 0.0]
+            if not all([loc in dE for loc in locs]):
+                pfd.append(i)
+                continue
+            G[i] = np.zeros_like(dE.values()[0])
+            for loc in locs:
+                G[i] += dW[n, last[loc]]*dE[loc]
+        return G, pfd
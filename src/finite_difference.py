@@ -1,6 +1,10 @@
 """ Finite difference module. """
 
+import os
+import shutil
 import traceback
+import multiprocessing
+import numpy as np
 from numpy import dot
 from forcebalance.output import getLogger
 logger = getLogger(__name__)
@@ -119,13 +123,13 @@ def in_fd():
     """ Invoking this function from anywhere will tell us whether we're being called by a finite-difference function.
     This is mainly useful for deciding when to update the 'qualitative indicators' and when not to. """
 
-    return any([i in [j[2] for j in traceback.extract_stack()] for i in ['f1d2p','f12d3p','f1d5p','f12d7p','f1d7p']])
+    return any([i in [j[2] for j in traceback.extract_stack()] for i in ['f1d2p','f12d3p','f1d5p','f12d7p','f1d7p','fd_worker']])
 
 def in_fd_srch():
     """ Invoking this function from anywhere will tell us whether we're being called by a finite-difference function.
     This is mainly useful for deciding when to update the 'qualitative indicators' and when not to. """
 
-    return any([i in [j[2] for j in traceback.extract_stack()] for i in ['f1d2p','f12d3p','f1d5p','f12d7p','f1d7p','search_fun']])
+    return any([i in [j[2] for j in traceback.extract_stack()] for i in ['f1d2p','f12d3p','f1d5p','f12d7p','f1d7p','fd_worker','search_fun']])
 
 def fdwrap(func,mvals0,pidx,key=None,**kwargs):
     """
@@ -179,5 +183,149 @@ def fdwrap_H(tgt,mvals0,pidx):
     """
     return fdwrap(tgt.get_G,mvals0,pidx,'G')
 
+## The job that is currently being differentiated by f12d3p_pool.
+## It is stored at the module level (rather than passed to the pool) because
+## the forked worker processes inherit it, which allows closures to be used.
+fd_job = {}
+
+def fd_worker(task):
+    """
+    Evaluate one finite difference displacement inside of a worker process.
+
+    Each worker process is a fork of the parent, so it holds its own copy of
+    the force field and engine objects.  The first time a worker is used, it
+    creates a scratch directory (named after its process ID) containing links
+    to the files in the parent's working directory, and all of its force field
+    files are written and read there.
+
+    Inputs:
+    task   = Tuple of (parameter index, displacement)
+
+    Outputs:
+    answer = Tuple of (parameter index, displacement, function value)
+    """
+    pidx, arg = task
+    wdir = os.path.join(fd_job['scratch'], 'worker_%i' % os.getpid())
+    if not os.path.exists(wdir):
+        os.makedirs(wdir)
+        for fnm in os.listdir(fd_job['cwd']):
+            srcfnm = os.path.join(fd_job['cwd'], fnm)
+            if os.path.isfile(srcfnm) and fnm not in fd_job['exclude']:
+                os.symlink(srcfnm, os.path.join(wdir, fnm))
+    os.chdir(wdir)
+    return pidx, arg, fdwrap(fd_job['func'], fd_job['mvals0'], pidx)(arg)
+
+def f12d3p_pool(func, mvals0, pidxs, h, f0=None, nproc=1, scratch=None, exclude=[], out=None):
+    """
+    Parameter-parallel version of the three-point stencil f12d3p.
+
+    This is meant for the 'callM' type closures in the targets, which
+    call FF.make and then run the engine, so that each parameter
+    displacement costs a full evaluation of the target.  The 2 x
+    len(pidxs) displacements are distributed over a pool of 'nproc'
+    worker processes; with nproc = 1, the serial f12d3p loop is used.
+
+    The worker processes are created by forking, so the engine must be
+    safe to use after a fork (external programs and the OpenMM
+    Reference platform are fine, GPU contexts are not.)
+
+    Inputs:
+    func    = Function of the mathematical parameters (e.g. callM), returns a float or an array
+    mvals0  = The 'central' values of the mathematical parameters
+    pidxs   = The indices of the parameters that we're differentiating
+    h       = The finite difference step size
+    f0      = Function value at mvals0 (computed here if not provided)
+    nproc   = Number of worker processes
+    scratch = Directory containing the worker scratch directories (default: fd_scratch in the current directory)
+    exclude = File names that are not linked into the worker scratch directories (i.e. force field files)
+    out     = Tuple of preallocated arrays (fp, fpp) for storing the derivatives (for example memory-mapped arrays);
+              fpp may be None if the second derivatives are not needed
+
+    Outputs:
+    fp      = First derivatives stacked in the order of pidxs, with shape (len(pidxs),) + shape(f0)
+    fpp     = Second derivatives (diagonal only) in the same shape as fp
+    """
+    pidxs = list(pidxs)
+    if f0 is None:
+        f0 = func(list(mvals0))
+    f0 = np.array(f0)
+    if out is None:
+        fp = np.zeros((len(pidxs),) + f0.shape)
+        fpp = np.zeros((len(pidxs),) + f0.shape)
+    else:
+        fp, fpp = out
+    if nproc <= 1 or len(pidxs) == 0:
+        for k, p in enumerate(pidxs):
+            fp[k], fpp_k = f12d3p(fdwrap(func, mvals0, p), h, f0 = f0)
+            if fpp is not None:
+                fpp[k] = fpp_k
+        return fp, fpp
+    cwd = os.getcwd()
+    if scratch is None:
+        scratch = os.path.join(cwd, 'fd_scratch')
+    fd_job.update({'func':func, 'mvals0':list(mvals0), 'cwd':cwd, 'scratch':scratch, 'exclude':set(exclude)})
+    tasks = [(p, i*h) for p in pidxs for i in [-1, 1]]
+    pool = multiprocessing.Pool(min(nproc, len(tasks)))
+    try:
+        # The results come back in the order of the tasks, so the derivatives are stored as soon as
+        # both displacements of a parameter are done, rather than holding on to all of the results.
+        fm1 = None
+        for p, arg, val in pool.imap(fd_worker, tasks, chunksize=1):
+            if arg < 0:
+                fm1 = np.array(val)
+                continue
+            f1 = np.array(val)
+            k = pidxs.index(p)
+            fp[k] = (f1-fm1)/(2*h)
+            if fpp is not None:
+                fpp[k] = (fm1-2*f0+f1)/(h*h)
+    finally:
+        pool.terminate()
+        fd_job.clear()
+        shutil.rmtree(scratch, ignore_errors=True)
+    return fp, fpp
+
+def f12d3p_sweep(sweep, mvals0, pidxs, h, f0=None):
+    """
+    Batched version of the three-point stencil f12d3p.
+
+    Instead of a function of one set of parameters, this takes a
+    'sweep' function that evaluates a list of parameter sets in one
+    call (for example Engine.energy_sweep), so that the engine can
+    reuse its setup across all of the displacements.
+
+    Inputs:
+    sweep   = Function of a list of mathematical parameter values, returns an array stacked along the first axis
+    mvals0  = The 'central' values of the mathematical parameters
+    pidxs   = The indices of the parameters that we're differentiating
+    h       = The finite difference step size
+    f0      = Function value at mvals0 (computed in the same sweep if not provided)
+
+    Outputs:
+    fp      = First derivatives stacked in the order of pidxs, with shape (len(pidxs),) + shape(f0)
+    fpp     = Second derivatives (diagonal only) in the same shape as fp
+    """
+    pidxs = list(pidxs)
+    if len(pidxs) == 0 and f0 is not None:
+        return np.zeros((0,) + np.shape(f0)), np.zeros((0,) + np.shape(f0))
+    mvals0 = np.array(mvals0, dtype=float)
+    displacements = []
+    for p in pidxs:
+        for i in [-1, 1]:
+            mvals = mvals0.copy()
+            mvals[p] += i*h
+            displacements.append(mvals)
+    if f0 is None:
+        displacements.append(mvals0.copy())
+    F = np.array(sweep(displacements))
+    if f0 is None:
+        f0 = F[-1]
+    f0 = np.array(f0)
+    fm1 = F[0:2*len(pidxs):2]
+    f1 = F[1:2*len(pidxs):2]
+    fp = (f1-fm1)/(2*h)
+    fpp = (fm1-2*f0+f1)/(h*h)
+    return fp, fpp
+
 #method resolution order
 #type.mro(type(a))
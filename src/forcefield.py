@@ -229,6 +229,8 @@ class FF(forcebalance.BaseClass):
         self.set_option(options, 'use_pvals')
         ## Allow duplicate parameter names (internally construct unique names)
         self.set_option(options, 'duplicate_pnames')
+        ## Keep the force field created by make() in memory instead of writing files
+        self.set_option(options, 'ff_inmemory')
 
         #======================================#
         #     Variables which are set here     #
@@ -265,6 +267,8 @@ class FF(forcebalance.BaseClass):
         self.Readers           = OrderedDict()
         ## A list of atom names (this is new, for ESP fitting)
         self.atomnames   = []
+        ## Rendering buffers used by make(), compiled on first use (see make_template)
+        self.fftemplate  = None
 
         # Read the force fields into memory.
         for fnm in self.fnms:
@@ -709,6 +713,11 @@ class FF(forcebalance.BaseClass):
         @param[in] use_pvals Switch for whether to bypass the coordinate transformation
         and use physical parameters directly.
 
+        The force field is printed into buffers that persist between
+        calls (see make_template).  If the ff_inmemory option is set and
+        printdir is not provided, no files are written and the contents
+        are obtained using render().
+
         """
         if type(vals)==np.ndarray and vals.ndim != 1:
             logger.error('Please only pass 1-D arrays\n')
@@ -717,7 +726,10 @@ class FF(forcebalance.BaseClass):
             logger.error('Input parameter np.array (%i) not the required size (%i)\n' % (len(vals), self.np))
             raise RuntimeError
         if use_pvals or self.use_pvals:
-            logger.info("Using physical parameters directly!\r")
+            # Only announce this if it was requested for the whole run; callers that
+            # pass use_pvals (e.g. to compute charge derivatives) know what they're doing.
+            if self.use_pvals:
+                logger.info("Using physical parameters directly!\r")
             pvals = vals.copy().flatten()
         else:
             pvals = self.create_pvals(vals)
@@ -743,26 +755,154 @@ class FF(forcebalance.BaseClass):
 
         pvals = list(pvals)
         # pvec1d(vals, precision=4)
-        newffdata = deepcopy(self.ffdata)
 
-        # The dictionary that takes parameter names to physical values.
-        PRM = {i:pvals[self.map[i]] for i in self.map}
+        # Compile the rendering buffers if this hasn't been done yet.
+        if getattr(self, 'fftemplate', None) is None:
+            self.make_template()
 
         #======================================#
         #     Print the new force field.       #
         #======================================#
 
-        xml_lines = OrderedDict([(fnm, list(newffdata[fnm].iter())) for fnm in self.fnms if self.ffdata_isxml[fnm]])
+        # Values to be printed into each parameter field.
+        wvals = self.field_values(pvals)
+
+        for fnm, tmpl in self.fftemplate.items():
+            if self.ffdata_isxml[fnm]:
+                # XML force fields are easy to print.
+                # Our 'pointer' to where to replace the value
+                # is given by the position of this line in the
+                # iterable representation of the tree and the
+                # field number.
+                elements = tmpl['elements']
+                for i in tmpl['fields']:
+                    pid,fnm,ln,fld,mult,cmd = self.pfields[i]
+                    elements[ln].attrib[fld] = OMMFormat % (wvals[i])
+                continue
+            # Text force fields are a bit harder.
+            # Our pointer is given by the line and field number.
+            # We take care to preserve whitespace in the printout
+            # so that the new force field still has nicely formated
+            # columns.  Each line is rebuilt from the original line.
+            for ln, (fields, sline0, whites0) in tmpl['lines'].items():
+                line = self.ffdata[fnm][ln]
+                for n, i in enumerate(fields):
+                    fld = self.pfields[i][3]
+                    if n == 0:
+                        # The split of the original line is precomputed.
+                        sline = list(sline0)
+                        whites = list(whites0)
+                    else:
+                        # Split the string into whitespace and data fields.
+                        sline       = self.Readers[fnm].Split(line)
+                        whites      = self.Readers[fnm].Whites(line)
+                        # Align whitespaces and fields (it should go white, field, white, field)
+                        if line[0] != ' ':
+                            whites = [''] + whites
+                    # Subtract one whitespace, unless the line begins with a minus sign.
+                    if not match('^-',sline[fld]) and len(whites[fld]) > 1:
+                        whites[fld] = whites[fld][:-1]
+                    # Actually replace the field with the physical parameter value.
+                    if precision == 12:
+                        newrd  = "% 17.12e" % (wvals[i])
+                    else:
+                        newrd  = TXTFormat(wvals[i], precision)
+                    # The new word might be longer than the old word.
+                    # If this is the case, we can try to shave off some whitespace.
+                    Lold = len(sline[fld])
+                    if not match('^-',sline[fld]):
+                        Lold += 1
+                    Lnew = len(newrd)
+                    if Lnew > Lold:
+                        Shave = Lnew - Lold
+                        if Shave < (len(whites[fld+1])+2):
+                            whites[fld+1] = whites[fld+1][:-Shave]
+                    sline[fld] = newrd
+                    line = ''.join([(whites[j] if (len(whites[j]) > 0 or j == 0) else ' ')+sline[j] for j in range(len(sline))])+'\n'
+                # Replace the line in the new force field.
+                tmpl['data'][ln] = line
+
+        for fnm in self.fftemplate:
+            if 'Script.txt' in fnm:
+                # if the xml file contains a script, ForceBalance will generate
+                # a temporary .txt file containing the script and any updates.
+                # We copy the updates made in the .txt file into the text attribute
+                # of the script element (assumed to be the last element) of the
+                # corresponding xml file.
+                fnmXml = fnm.split('Script')[0]+'.xml'
+                self.fftemplate[fnmXml]['elements'][-1].text = "".join(self.fftemplate[fnm]['data'])
+
+        # In-memory mode; the engines get the force field from render().
+        if printdir is None and self.ff_inmemory:
+            return pvals
+
+        if printdir is not None:
+            absprintdir = os.path.join(self.root,printdir)
+        else:
+            absprintdir = os.getcwd()
 
+        if not os.path.exists(absprintdir):
+            logger.info('Creating the directory %s to print the force field\n' % absprintdir)
+            os.makedirs(absprintdir)
+
+        for fnm in self.fftemplate:
+            if self.ffdata_isxml[fnm]:
+                with wopen(os.path.join(absprintdir,fnm)) as f: self.fftemplate[fnm]['data'].write(f)
+            elif 'Script.txt' not in fnm:
+                with wopen(os.path.join(absprintdir,fnm)) as f: f.writelines(self.fftemplate[fnm]['data'])
+
+        return pvals
+
+    def make_template(self):
+        """ Compile the buffers that make() prints the force field into.
+
+        Each force field file gets a persistent copy of its contents
+        that is reused from one call of make() to the next, so the
+        force field doesn't have to be copied every time.  For XML
+        files we keep a copy of the tree together with its flat list
+        of elements.  For text files we keep a copy of the lines, and
+        for each line containing parameters, the indices of its fields
+        in self.pfields and the whitespace / data split of the original line.
+
+        """
+        self.fftemplate = OrderedDict()
+        for fnm in self.ffdata:
+            if self.ffdata_isxml[fnm]:
+                tree = deepcopy(self.ffdata[fnm])
+                self.fftemplate[fnm] = {'data' : tree, 'elements' : list(tree.iter()), 'fields' : []}
+            else:
+                self.fftemplate[fnm] = {'data' : list(self.ffdata[fnm]), 'lines' : OrderedDict()}
         for i in range(len(self.pfields)):
-            pfield = self.pfields[i]
-            pid,fnm,ln,fld,mult,cmd = pfield
-            # XML force fields are easy to print.
-            # Our 'pointer' to where to replace the value
-            # is given by the position of this line in the
-            # iterable representation of the tree and the
-            # field number.
-            # if type(newffdata[fnm]) is etree._ElementTree:
+            pid,fnm,ln,fld,mult,cmd = self.pfields[i]
+            tmpl = self.fftemplate[fnm]
+            if self.ffdata_isxml[fnm]:
+                tmpl['fields'].append(i)
+            elif ln in tmpl['lines']:
+                tmpl['lines'][ln][0].append(i)
+            else:
+                line = self.ffdata[fnm][ln]
+                sline = self.Readers[fnm].Split(line)
+                whites = self.Readers[fnm].Whites(line)
+                if line[0] != ' ':
+                    whites = [''] + whites
+                tmpl['lines'][ln] = ([i], sline, whites)
+
+    def field_values(self, pvals):
+        """ Compute the values to be printed into each parameter field in self.pfields.
+
+        The evaluated parameters are computed in order so that they
+        are allowed to be functions of each other.
+
+        @param[in] pvals The physical parameters
+        @return wvals List of values, one for each entry in self.pfields
+
+        """
+        pvals = list(pvals)
+        # The dictionary that takes parameter names to physical values.
+        PRM = {i:pvals[self.map[i]] for i in self.map}
+        wvals = []
+        for i in range(len(self.pfields)):
+            pid,fnm,ln,fld,mult,cmd = self.pfields[i]
             if cmd is not None:
                 try:
                     # Bobby Tables, anyone?
@@ -777,79 +917,66 @@ class FF(forcebalance.BaseClass):
                     raise RuntimeError
             else:
                 wval = mult*pvals[self.map[pid]]
-            if self.ffdata_isxml[fnm]:
-                xml_lines[fnm][ln].attrib[fld] = OMMFormat % (wval)
-                # list(newffdata[fnm].iter())[ln].attrib[fld] = OMMFormat % (wval)
-            # Text force fields are a bit harder.
-            # Our pointer is given by the line and field number.
-            # We take care to preserve whitespace in the printout
-            # so that the new force field still has nicely formated
-            # columns.
-            else:
-                # Split the string into whitespace and data fields.
-                sline       = self.Readers[fnm].Split(newffdata[fnm][ln])
-                whites      = self.Readers[fnm].Whites(newffdata[fnm][ln])
-                # Align whitespaces and fields (it should go white, field, white, field)
-                if newffdata[fnm][ln][0] != ' ':
-                    whites = [''] + whites
-                # Subtract one whitespace, unless the line begins with a minus sign.
-                if not match('^-',sline[fld]) and len(whites[fld]) > 1:
-                    whites[fld] = whites[fld][:-1]
-                # Actually replace the field with the physical parameter value.
-                if precision == 12:
-                    newrd  = "% 17.12e" % (wval)
-                else:
-                    newrd  = TXTFormat(wval, precision)
-                # The new word might be longer than the old word.
-                # If this is the case, we can try to shave off some whitespace.
-                Lold = len(sline[fld])
-                if not match('^-',sline[fld]):
-                    Lold += 1
-                Lnew = len(newrd)
-                if Lnew > Lold:
-                    Shave = Lnew - Lold
-                    if Shave < (len(whites[fld+1])+2):
-                        whites[fld+1] = whites[fld+1][:-Shave]
-                sline[fld] = newrd
-                # Replace the line in the new force field.
-                newffdata[fnm][ln] = ''.join([(whites[j] if (len(whites[j]) > 0 or j == 0) else ' ')+sline[j] for j in range(len(sline))])+'\n'
+            wvals.append(wval)
+        return wvals
 
-        if printdir is not None:
-            absprintdir = os.path.join(self.root,printdir)
+    def field_derivatives(self, mvals, pidxs, h):
+        """ Compute the derivatives of the parameter field values with respect to the mathematical parameters.
+
+        This goes through the same transformations as make() (rescaling,
+        redirection and evaluated parameters), but no force field is
+        printed, so it is very cheap compared to an energy evaluation.
+        The derivatives are computed using the three-point stencil.
+
+        @param[in] mvals The mathematical parameters
+        @param[in] pidxs The indices of the parameters that we're differentiating
+        @param[in] h The finite difference step size
+        @return dW Array with shape (len(pidxs), len(self.pfields))
+
+        """
+        dW = np.zeros((len(pidxs), len(self.pfields)))
+        for n, i in enumerate(pidxs):
+            mvals_p = np.array(mvals, dtype=float)
+            mvals_m = np.array(mvals, dtype=float)
+            mvals_p[i] += h
+            mvals_m[i] -= h
+            dW[n] = (np.array(self.field_values(self.create_pvals(mvals_p))) - np.array(self.field_values(self.create_pvals(mvals_m)))) / (2*h)
+        return dW
+
+    def render(self, fnm):
+        """ Return the contents of a force field file from the last call to make() as a string.
+
+        @param[in] fnm The force field file name.
+
+        """
+        if getattr(self, 'fftemplate', None) is None or fnm not in self.fftemplate:
+            logger.error('The force field file %s has not been created by make()\n' % fnm)
+            raise RuntimeError
+        if self.ffdata_isxml[fnm]:
+            return etree.tostring(self.fftemplate[fnm]['data'])
         else:
-            absprintdir = os.getcwd()
+            return ''.join(self.fftemplate[fnm]['data'])
 
-        if not os.path.exists(absprintdir):
-            logger.info('Creating the directory %s to print the force field\n' % absprintdir)
-            os.makedirs(absprintdir)
+    def rendered_elements(self, fnm):
+        """ Return the flat list of elements of an XML force field file from the last call to make().
 
-        for fnm in newffdata:
-            if self.ffdata_isxml[fnm]:
-                with wopen(os.path.join(absprintdir,fnm)) as f: newffdata[fnm].write(f)
-            elif 'Script.txt' in fnm:
-                # if the xml file contains a script, ForceBalance will generate
-                # a temporary .txt file containing the script and any updates.
-                # We copy the updates made in the .txt file into the xml file by:
-                #   First, find xml file corresponding to this .txt file
-                #   Second, copy context of the .txt file into the text attribute
-                #           of the script element (assumed to be the last element)
-                #   Third. open the updated xml file as in the if statement above
-                tempText = "".join(newffdata[fnm])
-                fnmXml = fnm.split('Script')[0]+'.xml'
-                Ntemp = len(list(newffdata[fnmXml].iter()))
-                list(newffdata[fnmXml].iter())[Ntemp-1].text = tempText
-                '''
-                scriptElements = [elem for elem in fflist if elem.tag=='Script']
-                if len(scriptElements) > 1:
-                logger.error('XML file'+ffname+'contains more than one script! Consolidate your scripts into one script!\n')
-                raise RuntimeError
-                else:
-                '''
-                with wopen(os.path.join(absprintdir,fnmXml)) as f: newffdata[fnmXml].write(f)
-            else:
-                with wopen(os.path.join(absprintdir,fnm)) as f: f.writelines(newffdata[fnm])
+        Parameter values may be read from here using the line and field
+        numbers in self.pfields, without printing or parsing the force field.
 
-        return pvals
+        @param[in] fnm The XML force field file name.
+
+        """
+        if getattr(self, 'fftemplate', None) is None or fnm not in self.fftemplate or not self.ffdata_isxml[fnm]:
+            logger.error('The XML force field file %s has not been created by make()\n' % fnm)
+            raise RuntimeError
+        return self.fftemplate[fnm]['elements']
+
+    def __getstate__(self):
+        # The rendering buffers contain lxml elements which can't be
+        # pickled; they are compiled again after unpickling.
+        state = self.__dict__.copy()
+        state['fftemplate'] = None
+        return state
 
     def make_redirect(self,mvals):
         Groups = defaultdict(list)
@@ -1402,6 +1529,8 @@ class FF(forcebalance.BaseClass):
 
         """
         self.pfields.append([pid,fnm,ln,pfld,mult,cmd])
+        # The rendering buffers need to be recompiled to pick up the new field.
+        self.fftemplate = None
 
     def __eq__(self, other):
         # check equality of forcefields using comparison of pfields and map
@@ -8,6 +8,7 @@
 
 import os, sys
 import re
+import hashlib
 from forcebalance.nifty import *
 from forcebalance.nifty import _exec
 from forcebalance import BaseReader
@@ -19,7 +20,7 @@ from forcebalance.lipid import Lipid
 from forcebalance.interaction import Interaction
 from forcebalance.moments import Moments
 from forcebalance.vibration import Vibration
-from forcebalance.molecule import Molecule
+from forcebalance.molecule import Molecule, read_edr, read_trr
 from forcebalance.thermo import Thermo
 from copy import deepcopy
 from forcebalance.qchemio import QChem_Dielectric_Energy
@@ -837,34 +838,36 @@ class GMX(Engine):
 
     def energy_termnames(self, edrfile=None):
 
-        """ Get a list of energy term names from the .edr file by parsing a system call to g_energy. """
+        """ Get a list of energy term names from the .edr file, numbered in the same way as g_energy. """
 
         if edrfile is None:
             edrfile = "%s.edr" % self.name
         if not os.path.exists(edrfile):
             logger.error('Cannot determine energy term names without an .edr file\n')
             raise RuntimeError
-        ## Figure out which energy terms need to be printed.
-        o = self.callgmx("g_energy -f %s -xvg no" % (edrfile), stdin="Total-Energy\n", copy_stdout=False, copy_stderr=True)
-        parsemode = 0
-        energyterms = OrderedDict()
-        for line in o:
-            s = line.split()
-            if "Select the terms you want from the following list" in line:
-                parsemode = 1
-            if parsemode == 1:
-                if len(s) > 0 and all([isint(i) for i in s[::2]]):
-                    parsemode = 2
-            if parsemode == 2:
-                if len(s) > 0:
-                    try:
-                        if all([isint(i) for i in s[::2]]):
-                            for j in range(len(s))[::2]:
-                                num = int(s[j])
-                                name = s[j+1]
-                                energyterms[name] = num
-                    except: pass
-        return energyterms
+        return OrderedDict([(name, i+1) for i, name in enumerate(read_edr(edrfile)[1].keys())])
+
+    def grompp_cached(self, mdp):
+
+        """
+        Call grompp to create the .tpr file for single point calculations,
+        unless none of the input files have changed since the last call.
+        The force field files are included in the inputs, so grompp is
+        skipped when the same parameters are evaluated more than once.
+        """
+
+        tpr = "%s.tpr" % self.name
+        fnms = ["%s.gro" % self.name, "%s.top" % self.name, mdp]
+        if hasattr(self, 'FF'):
+            fnms += [f for f in self.FF.fnms if os.path.exists(f)]
+        h = hashlib.md5()
+        for fnm in fnms:
+            h.update(open(fnm).read())
+        inputs = h.hexdigest()
+        if os.path.exists(tpr) and getattr(self, 'tpr_inputs', None) == (inputs, os.path.getmtime(tpr)):
+            return
+        self.warngmx("grompp -c %s.gro -p %s.top -f %s -o %s" % (self.name, self.name, mdp, tpr))
+        self.tpr_inputs = (inputs, os.path.getmtime(tpr))
 
     def optimize(self, shot=0, crit=1e-4, **kwargs):
         
@@ -889,9 +892,7 @@ class GMX(Engine):
         self.warngmx("grompp -c %s.gro -p %s.top -f %s-min.mdp -o %s-min.tpr" % (self.name, self.name, self.name, self.name))
         self.callgmx("mdrun -deffnm %s-min -nt 1" % self.name)
         self.callgmx("trjconv -f %s-min.trr -s %s-min.tpr -o %s-min.gro -ndec 9" % (self.name, self.name, self.name), stdin="System")
-        self.callgmx("g_energy -xvg no -f %s-min.edr -o %s-min-e.xvg" % (self.name, self.name), stdin='Potential')
-        
-        E = float(open("%s-min-e.xvg" % self.name).readlines()[-1].split()[1])
+        E = read_edr("%s-min.edr" % self.name)[1]["Potential"][-1]
         M = Molecule("%s.gro" % self.name, build_topology=False) + Molecule("%s-min.gro" % self.name, build_topology=False)
         if not self.pbc:
             M.align(center=False)
@@ -919,23 +920,20 @@ class GMX(Engine):
         shot_opts["nstfout"] = 1 if force else 0
         edit_mdp(fin="%s.mdp" % self.name, fout="%s-1.mdp" % self.name, options=shot_opts)
 
-        ## Call grompp followed by mdrun.
-        self.warngmx("grompp -c %s.gro -p %s.top -f %s-1.mdp -o %s.tpr" % (self.name, self.name, self.name, self.name))
+        ## Call grompp (if the inputs have changed) followed by mdrun.
+        self.grompp_cached("%s-1.mdp" % self.name)
         self.callgmx("mdrun -deffnm %s -nt 1 -rerunvsite %s" % (self.name, "-rerun %s" % traj if traj else ''))
 
         ## Gather information
         Result = OrderedDict()
 
-        ## Calculate and record energy
-        self.callgmx("g_energy -xvg no -f %s.edr -o %s-e.xvg" % (self.name, self.name), stdin='Potential')
-        Efile = open("%s-e.xvg" % self.name).readlines()
-        Result["Energy"] = np.array([float(Eline.split()[1]) for Eline in Efile])
+        ## Read the energy directly from the .edr file
+        Result["Energy"] = read_edr("%s.edr" % self.name)[1]["Potential"]
 
-        ## Calculate and record force
+        ## Read the force directly from the .trr file
         if force:
-            self.callgmx("g_traj -xvg no -s %s.tpr -f %s.trr -of %s-f.xvg -fp" % (self.name, self.name, self.name), stdin='System')
-            Result["Force"] = np.array([[float(j) for i, j in enumerate(line.split()[1:]) if self.AtomMask[i/3]] \
-                                            for line in open("%s-f.xvg" % self.name).readlines()])
+            mask = np.array(self.AtomMask, dtype=bool)
+            Result["Force"] = np.array([frame['f'][mask].flatten() for frame in read_trr("%s.trr" % self.name) if 'f' in frame])
         ## Calculate and record dipole
         if dipole:
             self.callgmx("g_dipoles -s %s.tpr -f %s -o %s-d.xvg -xvg no" % (self.name, traj if traj else '%s.gro' % self.name, self.name), stdin="System\n")
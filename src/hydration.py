@@ -207,7 +207,8 @@ class Hydration(Target):
             else:
                 queue_up(wq, command = cmdstr+' &> md.out', tag='%s:%s/%s' % (self.name, label, "liq" if liq else "gas"),
                          input_files = self.scripts + ['simulation.p', 'forcefield.p', os.path.basename(self.molecules[label])],
-                         output_files = ['md_result.p', 'md.out'] + self.extra_output, tgt=self, verbose=False, print_time=3600)
+                         output_files = ['md_result.p', 'md.out'] + self.extra_output, tgt=self, verbose=False, print_time=3600,
+                         cache_files = self.scripts + [os.path.basename(self.molecules[label])])
         os.chdir('..')
 
     def submit_liq_gas(self, mvals, AGrad=True):
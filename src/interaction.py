@@ -207,8 +207,7 @@ class Interaction(Target):
 
         # Do the finite difference derivative.
         if AGrad or AHess:
-            for p in self.pgrad:
-                dV[p,:], _ = f12d3p(fdwrap(callM, mvals, p), h = self.h, f0 = emm)
+            dV[self.pgrad,:], _ = self.fd_pool(callM, mvals, f0 = emm)
             # Create the force field one last time.
             pvals  = self.FF.make(mvals)
 
@@ -316,7 +316,8 @@ class Lipid(Target):
             else:
                 queue_up(wq, command = cmdstr+' &> npt.out',
                          input_files = self.nptfiles + self.scripts + ['forcebalance.p'],
-                         output_files = ['npt_result.p', 'npt.out'] + self.extra_output, tgt=self)
+                         output_files = ['npt_result.p', 'npt.out'] + self.extra_output, tgt=self,
+                         cache_files = self.nptfiles + self.scripts)
 
     def polarization_correction(self,mvals):
         d = self.gas_engine.get_multipole_moments(optimize=True)['dipole']
@@ -29,6 +29,23 @@ import copy
 from forcebalance.output import getLogger
 logger = getLogger(__name__)
 
+def reduced_potentials(E, Beta, V=None, Pres=None):
+    """
+    Reduced potential energies for MBAR, for the snapshots of each
+    simulation evaluated at the conditions of every simulation.
+
+    @param[in] E Potential energies in kJ/mol, shape (K, N) for N snapshots of K simulations
+    @param[in] Beta Inverse temperatures of the simulations in mol/kJ, shape (K)
+    @param[in] V Box volumes in nm^3, shape (K, N); if provided, the pV term is included
+    @param[in] Pres Pressures of the simulations in atm, shape (K)
+    @return U_kln Reduced potential of snapshot n from simulation k at the conditions of simulation l, shape (K, K, N)
+    """
+    U_kln = E[:,np.newaxis,:]
+    if V is not None:
+        # The pV terms are computed with the pressure of simulation l; the constant converts atm * nm**3 into kJ/mol.
+        U_kln = U_kln + Pres[np.newaxis,:,np.newaxis]*V[:,np.newaxis,:]*0.061019351687175
+    return U_kln * Beta[np.newaxis,:,np.newaxis]
+
 def weight_info(W, PT, N_k, verbose=True, PTS=None):
     C = []
     N = 0
@@ -139,6 +156,9 @@ class Liquid(Target):
         self.do_self_pol = (self.self_pol_mu0 > 0.0 and self.self_pol_alpha > 0.0)
         # Enable anisotropic periodic box
         self.set_option(tgt_opts,'anisotropic_box',forceprint=True)
+        # Write the condensed phase trajectory to disk instead of keeping it in memory
+        self.set_option(tgt_opts,'md_stream')
+        self.set_option(tgt_opts,'md_checkpoint')
         # Whether to save trajectories (0 = never, 1 = delete after good step, 2 = keep all)
         self.set_option(tgt_opts,'save_traj')
         # Set the number of molecules by hand (in case ForceBalance doesn't get the right number from the structure)
@@ -232,6 +252,8 @@ class Liquid(Target):
         ## Saved results for all iterations
         # self.SavedMVals = []
         self.AllResults = defaultdict(lambda:defaultdict(list))
+        ## MBAR free energies for each set of phase points and parameter values, used as initial guesses
+        self.MBarFreeEnergy = defaultdict(OrderedDict)
 
     def prepare_temp_directory(self):
         """ Prepare the temporary directory by copying in important files. """
@@ -365,9 +387,14 @@ class Liquid(Target):
                 logger.info("You may tail -f %s/npt.out in another terminal window\n" % os.getcwd())
                 _exec(cmdstr, copy_stderr=True, outfnm='npt.out')
             else:
+                # Checkpoint files written by npt.py (OpenMM only); if they are here from an
+                # earlier attempt, send them along so the simulation resumes from them.
+                # They are not fetched back, because they are only needed if the task fails.
+                chkfiles = ['liquid-md.chk', 'liquid-md.frames'] if (self.engname == 'openmm' and self.md_checkpoint) else []
                 queue_up(wq, command = cmdstr+' > npt.out 2>&1 ',
-                         input_files = self.nptfiles + self.scripts + ['forcebalance.p'],
-                         output_files = ['npt_result.p', 'npt.out'] + self.extra_output, tgt=self)
+                         input_files = self.nptfiles + self.scripts + ['forcebalance.p'] + [f for f in chkfiles if os.path.exists(f)],
+                         output_files = ['npt_result.p', 'npt.out'] + self.extra_output, tgt=self,
+                         cache_files = self.nptfiles + self.scripts)
 
     def nvt_simulation(self, temperature):
         """ Submit a NVT simulation to the Work Queue. """
@@ -382,7 +409,8 @@ class Liquid(Target):
             else:
                 queue_up(wq, command = cmdstr+' > nvt.out 2>&1 ',
                          input_files = self.nvtfiles + self.scripts + ['forcebalance.p'],
-                         output_files = ['nvt_result.p', 'nvt.out'] + self.extra_output, tgt=self)
+                         output_files = ['nvt_result.p', 'nvt.out'] + self.extra_output, tgt=self,
+                         cache_files = self.nvtfiles + self.scripts)
 
     def polarization_correction(self,mvals):
         self.FF.make(mvals)
@@ -658,6 +686,34 @@ class Liquid(Target):
 
         return self.get(mvals, AGrad, AHess)
 
+    def solve_mbar(self, key, astrm, u_kln, N_k, **kwargs):
+
+        """
+        Run MBAR, using the free energies from a previous call as the
+        initial guess.  The free energies are stored for each set of
+        phase points (key) and parameter values (astrm); if the same
+        parameter values have been seen before (e.g. when data sets
+        are concatenated), those free energies are used, otherwise
+        the most recent ones for these phase points.
+
+        @param[in] key Identifies the set of phase points (states) in u_kln
+        @param[in] astrm String representation of the parameter values
+        @param[in] u_kln Reduced potential energies of each snapshot from simulation k at state l
+        @param[in] N_k Number of snapshots from each simulation
+        @return mbar The MBAR object
+        """
+        cache = self.MBarFreeEnergy[key]
+        if astrm in cache:
+            f_k0 = cache[astrm]
+        elif len(cache) > 0:
+            f_k0 = cache.values()[-1]
+        else:
+            f_k0 = None
+        mbar = pymbar.MBAR(u_kln, N_k, initial_f_k=f_k0, **kwargs)
+        if astrm in cache: del cache[astrm]
+        cache[astrm] = mbar.f_k.copy()
+        return mbar
+
     def get(self, mvals, AGrad=True, AHess=True):
         """ Wrapper of self.get_normal() and self.get_pure_num_grad() """
         if self.pure_num_grad:
@@ -842,22 +898,17 @@ class Liquid(Target):
         Shots = len(E[0])
         N_k = np.ones(BSims, dtype=int)*Shots
         # Use the value of the energy for snapshot t from simulation k at potential m
-        U_kln = np.zeros([BSims,BSims,Shots])
-        for m, PT in enumerate(BPoints):
-            T = PT[0]
-            P = PT[1] / 1.01325 if PT[2] == 'bar' else PT[1]
-            beta = 1. / (kb * T)
-            for k in range(BSims):
-                # The correct Boltzmann factors include PV.
-                # Note that because the Boltzmann factors are computed from the conditions at simulation "m",
-                # the pV terms must be rescaled to the pressure at simulation "m".
-                kk = Points.index(BPoints[k])
-                U_kln[k, m, :]   = E[kk] + P*V[kk]*pvkj
-                U_kln[k, m, :]  *= beta
+        BIdx = [Points.index(PT) for PT in BPoints]
+        BBeta = np.array([1. / (kb * PT[0]) for PT in BPoints])
+        BPres = np.array([PT[1] / 1.01325 if PT[2] == 'bar' else PT[1] for PT in BPoints])
+        # The correct Boltzmann factors include PV.
+        # Note that because the Boltzmann factors are computed from the conditions at simulation "m",
+        # the pV terms must be rescaled to the pressure at simulation "m".
+        U_kln = reduced_potentials(E[BIdx], BBeta, V[BIdx], BPres)
         W1 = None
         if len(BPoints) > 1:
             logger.info("Running MBAR analysis on %i states...\n" % len(BPoints))
-            mbar = pymbar.MBAR(U_kln, N_k, verbose=mbar_verbose, relative_tolerance=5.0e-8)
+            mbar = self.solve_mbar(('liquid', tuple(BPoints)), astrm, U_kln, N_k, verbose=mbar_verbose, relative_tolerance=5.0e-8)
             W1 = mbar.getWeights()
             logger.info("Done\n")
         elif len(BPoints) == 1:
@@ -889,16 +940,11 @@ class Liquid(Target):
             if len(mBPoints) > 1:
                 mBSims = len(mBPoints)
                 mN_k = np.ones(mBSims, dtype=int)*mShots
-                mU_kln = np.zeros([mBSims,mBSims,mShots])
-                for m, PT in enumerate(mBPoints):
-                    T = PT[0]
-                    beta = 1. / (kb * T)
-                    for k in range(mBSims):
-                        kk = Points.index(mBPoints[k])
-                        mU_kln[k, m, :]  = mE[kk]
-                        mU_kln[k, m, :] *= beta
+                mBIdx = [Points.index(PT) for PT in mBPoints]
+                mBBeta = np.array([1. / (kb * PT[0]) for PT in mBPoints])
+                mU_kln = reduced_potentials(mE[mBIdx], mBBeta)
                 if np.abs(np.std(mE)) > 1e-6 and mBSims > 1:
-                    mmbar = pymbar.MBAR(mU_kln, mN_k, verbose=False, relative_tolerance=5.0e-8, method='self-consistent-iteration')
+                    mmbar = self.solve_mbar(('gas', tuple(mBPoints)), astrm, mU_kln, mN_k, verbose=False, relative_tolerance=5.0e-8, method='self-consistent-iteration')
                     mW1 = mmbar.getWeights()
             elif len(mBPoints) == 1:
                 mW1 = np.ones((mShots,1))
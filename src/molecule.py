@@ -146,6 +146,7 @@ AllVariableNames = QuantumVariableNames | AtomVariableNames | MetaVariableNames
 
 # OrderedDict requires Python 2.7 or higher
 import os, sys, re, copy
+import struct, xdrlib
 import numpy as np
 from numpy import sin, cos, arcsin, arccos
 import imp
@@ -364,6 +365,336 @@ def BuildLatticeFromVectors(v1, v2, v3):
     L3 = Mat*np.matrix([[0],[0],[1]])
     return Box(a,b,c,alpha,beta,gamma,np.array(L1).flatten(),np.array(L2).flatten(),np.array(L3).flatten(),v*a*b*c)
 
+#=========================================#
+#|  Readers for binary trajectory files  |#
+#|  (GROMACS .trr/.xtc/.edr)             |#
+#=========================================#
+
+def BuildLatticeFromGMX(box):
+    """ This function takes in a GROMACS box matrix (rows are lattice vectors in nanometers) and returns a complete box specification in Angstrom. """
+    box = np.array(box, dtype=float).reshape(3,3) * 10
+    if np.count_nonzero(box - np.diag(np.diag(box))) == 0:
+        return BuildLatticeFromLengthsAngles(box[0,0], box[1,1], box[2,2], 90.0, 90.0, 90.0)
+    return BuildLatticeFromVectors(box[0], box[1], box[2])
+
+def iter_trr(fnm, stride=1, atoms=None):
+    """
+    Iterate over the frames of a GROMACS .trr file.  Frames that are
+    not selected by the stride are skipped over without being read.
+
+    @param[in] fnm Name of the .trr file.
+    @param[in] stride Return every stride-th frame, starting from the first one.
+    @param[in] atoms List of (zero-based) atom indices to return (default is all atoms).
+    @return Generator of dictionaries with the step, time and whichever of the
+    box ('box'), virial ('vir'), pressure ('pres'), coordinates ('x'),
+    velocities ('v') and forces ('f') are present in each frame, in GROMACS units.
+    """
+    iframe = 0
+    with open(fnm, 'rb') as f:
+        while True:
+            head = f.read(8)
+            if len(head) < 8: break
+            magic, slen = struct.unpack('>2i', head)
+            if magic != 1993:
+                logger.error('%s is not a GROMACS .trr file\n' % fnm)
+                raise RuntimeError
+            # Version string
+            nchar = struct.unpack('>i', f.read(4))[0]
+            f.seek(nchar + (-nchar % 4), 1)
+            ir_size, e_size, box_size, vir_size, pres_size, top_size, sym_size, \
+                x_size, v_size, f_size, natoms, step, nre = struct.unpack('>13i', f.read(52))
+            blocks = [('box', box_size, (3, 3)), ('vir', vir_size, (3, 3)), ('pres', pres_size, (3, 3)),
+                      ('x', x_size, (natoms, 3)), ('v', v_size, (natoms, 3)), ('f', f_size, (natoms, 3))]
+            # Determine the precision from the size of the data.
+            rsize = 4
+            for key, size, shape in blocks:
+                if size > 0:
+                    rsize = size/np.prod(shape)
+                    break
+            if iframe % stride != 0:
+                f.seek(2*rsize + sum([size for key, size, shape in blocks]), 1)
+                iframe += 1
+                continue
+            t, lam = struct.unpack('>2%s' % ('f' if rsize == 4 else 'd'), f.read(2*rsize))
+            frame = OrderedDict([('step', step), ('time', t)])
+            for key, size, shape in blocks:
+                if size > 0:
+                    data = np.frombuffer(f.read(size), dtype='>f%i' % rsize).reshape(shape)
+                    if atoms is not None and key in ['x', 'v', 'f']:
+                        data = data[atoms]
+                    frame[key] = data.astype(float)
+            iframe += 1
+            yield frame
+
+def read_trr(fnm, stride=1, atoms=None):
+    """
+    Read the frames of a GROMACS .trr file directly (instead of
+    calling g_traj and parsing the .xvg output).
+
+    @param[in] fnm Name of the .trr file.
+    @param[in] stride Return every stride-th frame, starting from the first one.
+    @param[in] atoms List of (zero-based) atom indices to return (default is all atoms).
+    @return frames List of dictionaries with the step, time and whichever of the
+    box ('box'), virial ('vir'), pressure ('pres'), coordinates ('x'),
+    velocities ('v') and forces ('f') are present in each frame, in GROMACS units.
+    """
+    return list(iter_trr(fnm, stride, atoms))
+
+## Magic integers used by the .xtc coordinate compression algorithm.
+xtc_magicints = [0, 0, 0, 0, 0, 0, 0, 0, 0, 8, 10, 12, 16, 20, 25, 32, 40, 50, 64,
+                 80, 101, 128, 161, 203, 256, 322, 406, 512, 645, 812, 1024, 1290,
+                 1625, 2048, 2580, 3250, 4096, 5060, 6501, 8192, 10321, 13003,
+                 16384, 20642, 26007, 32768, 41285, 52015, 65536, 82570, 104031,
+                 131072, 165140, 208063, 262144, 330280, 416127, 524287, 660561,
+                 832255, 1048576, 1321122, 1664510, 2097152, 2642245, 3329021,
+                 4194304, 5284491, 6658042, 8388607, 10568983, 13316085, 16777216]
+
+def xtc_decompress(buf, lsize, minint, maxint, smallidx, precision):
+    """
+    Decompress the coordinates of one .xtc frame.  This is a port of
+    xdrfile_decompress_coord_float() from the GROMACS xdrfile library.
+
+    @param[in] buf String containing the compressed coordinate data.
+    @param[in] lsize Number of atoms.
+    @param[in] minint Minimum values of the integer coordinates.
+    @param[in] maxint Maximum values of the integer coordinates.
+    @param[in] smallidx Initial index into the table of magic integers.
+    @param[in] precision Precision of the compressed coordinates.
+    @return xyz (lsize, 3) array of coordinates in nanometers.
+    """
+    data = bytearray(buf)
+    # Bit reader state: byte position, number of leftover bits, and the leftover bits themselves.
+    state = [0, 0, 0]
+    def decodebits(nbits):
+        cnt, lastbits, lastbyte = state
+        mask = (1 << nbits) - 1
+        num = 0
+        while nbits >= 8:
+            lastbyte = ((lastbyte << 8) | data[cnt]) & 0xffff
+            cnt += 1
+            num |= (lastbyte >> lastbits) << (nbits - 8)
+            nbits -= 8
+        if nbits > 0:
+            if lastbits < nbits:
+                lastbits += 8
+                lastbyte = ((lastbyte << 8) | data[cnt]) & 0xffff
+                cnt += 1
+            lastbits -= nbits
+            num |= (lastbyte >> lastbits) & ((1 << nbits) - 1)
+        state[0] = cnt; state[1] = lastbits; state[2] = lastbyte
+        return num & mask
+    def decodeints(nbits, sizes):
+        # Read the bytes of one large integer (least significant first) and
+        # split it into three small integers using the sizes as the bases.
+        num = 0
+        shift = 0
+        while nbits > 8:
+            num |= decodebits(8) << shift
+            shift += 8
+            nbits -= 8
+        if nbits > 0:
+            num |= decodebits(nbits) << shift
+        num, z = divmod(num, sizes[2])
+        x, y = divmod(num, sizes[1])
+        return [x, y, z]
+    sizeint = [maxint[i] - minint[i] + 1 for i in range(3)]
+    # Check if one of the sizes is too big to be multiplied.
+    if (sizeint[0] | sizeint[1] | sizeint[2]) > 0xffffff:
+        bitsizeint = [i.bit_length() for i in sizeint]
+        bitsize = 0
+    else:
+        bitsizeint = None
+        bitsize = (sizeint[0]*sizeint[1]*sizeint[2]).bit_length()
+    FIRSTIDX = 9
+    LASTIDX = len(xtc_magicints)
+    maxidx = min(LASTIDX, smallidx + 8)
+    smaller = xtc_magicints[max(FIRSTIDX, smallidx - 1)] / 2
+    smallnum = xtc_magicints[smallidx] / 2
+    sizesmall = [xtc_magicints[smallidx]]*3
+    ints = np.empty((lsize, 3), dtype=int)
+    i = 0
+    n = 0
+    run = 0
+    while i < lsize:
+        if bitsize == 0:
+            thiscoord = [decodebits(bitsizeint[0]), decodebits(bitsizeint[1]), decodebits(bitsizeint[2])]
+        else:
+            thiscoord = decodeints(bitsize, sizeint)
+        i += 1
+        thiscoord = [thiscoord[0] + minint[0], thiscoord[1] + minint[1], thiscoord[2] + minint[2]]
+        prevcoord = thiscoord
+        flag = decodebits(1)
+        is_smaller = 0
+        if flag == 1:
+            run = decodebits(5)
+            is_smaller = run % 3
+            run -= is_smaller
+            is_smaller -= 1
+        if 3*n + run > 3*lsize:
+            logger.error('Buffer overrun while decompressing .xtc coordinates\n')
+            raise RuntimeError
+        if run > 0:
+            for k in range(0, run, 3):
+                small = decodeints(smallidx, sizesmall)
+                i += 1
+                thiscoord = [small[0] + prevcoord[0] - smallnum, small[1] + prevcoord[1] - smallnum, small[2] + prevcoord[2] - smallnum]
+                if k == 0:
+                    # The first two atoms of a run are swapped for better compression of water molecules.
+                    thiscoord, prevcoord = prevcoord, thiscoord
+                    ints[n] = prevcoord
+                    n += 1
+                else:
+                    prevcoord = thiscoord
+                ints[n] = thiscoord
+                n += 1
+        else:
+            ints[n] = thiscoord
+            n += 1
+        smallidx += is_smaller
+        if is_smaller < 0:
+            smallnum = smaller
+            smaller = xtc_magicints[smallidx - 1] / 2 if smallidx > FIRSTIDX else 0
+        elif is_smaller > 0:
+            smaller = smallnum
+            smallnum = xtc_magicints[smallidx] / 2
+        sizesmall = [xtc_magicints[smallidx]]*3
+        if sizesmall[0] == 0:
+            logger.error('Error while decompressing .xtc coordinates\n')
+            raise RuntimeError
+    return ints / precision
+
+def iter_xtc(fnm, stride=1, atoms=None):
+    """
+    Iterate over the frames of a GROMACS .xtc file.  Frames that are
+    not selected by the stride are skipped over without being decompressed.
+
+    @param[in] fnm Name of the .xtc file.
+    @param[in] stride Return every stride-th frame, starting from the first one.
+    @param[in] atoms List of (zero-based) atom indices to return (default is all atoms).
+    @return Generator of dictionaries with the step, time, box ('box') and
+    coordinates ('x') of each frame, in GROMACS units.
+    """
+    iframe = 0
+    with open(fnm, 'rb') as f:
+        while True:
+            head = f.read(16)
+            if len(head) < 16: break
+            magic, natoms, step, t = struct.unpack('>3if', head)
+            if magic != 1995:
+                logger.error('%s is not a GROMACS .xtc file\n' % fnm)
+                raise RuntimeError
+            box = np.frombuffer(f.read(36), dtype='>f4').reshape(3,3)
+            lsize = struct.unpack('>i', f.read(4))[0]
+            if lsize != natoms:
+                logger.error('Number of atoms in .xtc frame is inconsistent (%i vs. %i)\n' % (lsize, natoms))
+                raise RuntimeError
+            # Coordinates of systems with nine atoms or fewer are not compressed.
+            if natoms <= 9:
+                if iframe % stride != 0:
+                    f.seek(12*natoms, 1)
+                    iframe += 1
+                    continue
+                xyz = np.frombuffer(f.read(12*natoms), dtype='>f4').reshape(-1,3)
+            else:
+                precision = struct.unpack('>f', f.read(4))[0]
+                minint = struct.unpack('>3i', f.read(12))
+                maxint = struct.unpack('>3i', f.read(12))
+                smallidx, nbytes = struct.unpack('>2i', f.read(8))
+                if iframe % stride != 0:
+                    f.seek(nbytes + (-nbytes % 4), 1)
+                    iframe += 1
+                    continue
+                buf = f.read(nbytes + (-nbytes % 4))
+                xyz = xtc_decompress(buf, natoms, minint, maxint, smallidx, precision)
+            if atoms is not None:
+                xyz = xyz[atoms]
+            iframe += 1
+            yield OrderedDict([('step', step), ('time', t), ('box', box.astype(float)), ('x', xyz.astype(float))])
+
+def read_edr(fnm):
+    """
+    Read the energy terms from a GROMACS .edr file directly
+    (instead of calling g_energy and parsing the .xvg output).
+
+    Supports the file format written by GROMACS 4.5 and later, in
+    single or double precision.
+
+    @param[in] fnm Name of the .edr file.
+    @return times Array of frame times in ps.
+    @return energies OrderedDict that maps energy term names to arrays of values over the frames.
+    """
+    data = open(fnm, 'rb').read()
+    xdr = xdrlib.Unpacker(data)
+    if xdr.unpack_int() != -55555:
+        logger.error('%s is not a GROMACS .edr file, or was written by a GROMACS version older than 4.5\n' % fnm)
+        raise RuntimeError
+    version = xdr.unpack_int()
+    nre = xdr.unpack_int()
+    names = []
+    for i in range(nre):
+        names.append(xdr.unpack_string())
+        # Units
+        if version >= 2: xdr.unpack_string()
+    times = []
+    energies = []
+    pos = xdr.get_position()
+    # Each frame begins with the real number -2e10, which tells us the precision.
+    rsize = 4 if (pos+4 <= len(data) and struct.unpack('>f', data[pos:pos+4])[0] < -1e10) else 8
+    while pos < len(data):
+        xdr.set_position(pos + rsize)
+        if xdr.unpack_int() != -7777777:
+            logger.error('Energy frame magic number mismatch in %s\n' % fnm)
+            raise RuntimeError
+        fversion = xdr.unpack_int()
+        if fversion < 4:
+            logger.error('Energy frames in %s were written by a GROMACS version older than 4.5\n' % fnm)
+            raise RuntimeError
+        t = xdr.unpack_double()
+        step = xdr.unpack_hyper()
+        nsum = xdr.unpack_int()
+        # Number of steps (version 3) and time step (version 5)
+        xdr.unpack_hyper()
+        if fversion >= 5: xdr.unpack_double()
+        fnre = xdr.unpack_int()
+        # Reserved
+        xdr.unpack_int()
+        nblock = xdr.unpack_int()
+        # Types and lengths of sub-blocks
+        subs = []
+        for b in range(nblock):
+            xdr.unpack_int()
+            nsub = xdr.unpack_int()
+            for i in range(nsub):
+                subs.append((xdr.unpack_int(), xdr.unpack_int()))
+        # Size of the energies (e_size) and two reserved integers
+        xdr.unpack_int(); xdr.unpack_int(); xdr.unpack_int()
+        pos = xdr.get_position()
+        # Each energy is followed by its average and sum if nsum > 0
+        nval = 3 if nsum > 0 else 1
+        frame = np.frombuffer(data, dtype='>f%i' % rsize, count=fnre*nval, offset=pos)[::nval]
+        pos += fnre*nval*rsize
+        # Skip over the data in the sub-blocks.
+        for typ, nr in subs:
+            # int, float, char (four bytes each)
+            if typ in [0, 1, 4]: pos += 4*nr
+            # double, 64-bit int
+            elif typ in [2, 3]: pos += 8*nr
+            # string
+            elif typ == 5:
+                xdr.set_position(pos)
+                for i in range(nr):
+                    xdr.unpack_int()
+                    xdr.unpack_string()
+                pos = xdr.get_position()
+            else:
+                logger.error('Unknown data type %i in energy frame of %s\n' % (typ, fnm))
+                raise RuntimeError
+        if fnre > 0:
+            times.append(t)
+            energies.append(np.array(frame, dtype=float))
+    energies = np.array(energies).reshape(-1, nre)
+    return np.array(times), OrderedDict([(name, energies[:,i]) for i, name in enumerate(names)])
+
 #===========================#
 #|   Connectivity graph    |#
 #|  Good for doing simple  |#
@@ -570,6 +901,12 @@ def diff(A, B, key):
 def either(A, B, key):
     return key in A.Data or key in B.Data
 
+def copy_unless_mapped(obj):
+    """ Return a deep copy of a per-frame quantity, unless it is a memory-mapped array (which is returned as a view). """
+    if isinstance(obj, np.memmap):
+        return obj
+    return copy.deepcopy(obj)
+
 #===========================#
 #|  Alignment subroutines  |#
 #| Moments added 08/03/12  |#
@@ -689,6 +1026,49 @@ def get_rotate_translate(matrix1,matrix2):
     trans_matrix = avg_pos2-np.dot(avg_pos1,rot_matrix)
     return trans_matrix, rot_matrix
 
+def rmsd_qcp(xyz1, xyz2):
+    """
+    RMSD after optimal superposition computed with the quaternion
+    characteristic polynomial (QCP) method, vectorized over frames.
+    The RMSD is obtained from the largest eigenvalue of the 4x4 key
+    matrix, so no rotation matrix or SVD is needed.
+
+    Parameters
+    ----------
+    xyz1 : np.ndarray
+        Centered coordinates, shape (na, 3) or (nframes, na, 3)
+    xyz2 : np.ndarray
+        Centered coordinates, shape (nframes, na, 3)
+
+    Returns
+    -------
+    np.ndarray
+        RMSD between each pair of frames, shape (nframes)
+    """
+    xyz1 = np.asarray(xyz1, dtype=float)
+    xyz2 = np.asarray(xyz2, dtype=float)
+    na = xyz2.shape[1]
+    # Inner products and 3x3 correlation matrices.
+    G1 = np.sum(xyz1**2, axis=(-2,-1))
+    G2 = np.sum(xyz2**2, axis=(1,2))
+    if xyz1.ndim == 2:
+        S = np.tensordot(xyz2, xyz1, axes=([1],[0])).transpose(0,2,1)
+    else:
+        S = np.einsum('mak,mal->mkl', xyz1, xyz2)
+    Sxx, Sxy, Sxz = S[:,0,0], S[:,0,1], S[:,0,2]
+    Syx, Syy, Syz = S[:,1,0], S[:,1,1], S[:,1,2]
+    Szx, Szy, Szz = S[:,2,0], S[:,2,1], S[:,2,2]
+    K = np.array([[Sxx+Syy+Szz, Syz-Szy, Szx-Sxz, Sxy-Syx],
+                  [Syz-Szy, Sxx-Syy-Szz, Sxy+Syx, Szx+Sxz],
+                  [Szx-Sxz, Sxy+Syx, -Sxx+Syy-Szz, Syz+Szy],
+                  [Sxy-Syx, Szx+Sxz, Syz+Szy, -Sxx-Syy+Szz]]).transpose(2,0,1)
+    # The largest eigenvalue of the key matrix.  This is computed directly
+    # rather than by Newton iterations on the characteristic polynomial,
+    # because the eigenvalue is degenerate for linear molecules, where
+    # Newton's method converges slowly.
+    lam = np.linalg.eigvalsh(K)[:,-1]
+    return np.sqrt(np.maximum(G1+G2-2*lam, 0.0)/na)
+
 def cartesian_product2(arrays):
     """ Form a Cartesian product of two NumPy arrays. """
     la = len(arrays)
@@ -829,7 +1209,8 @@ def arc(Mol, begin=None, end=None, RMSD=True, align=True):
     if RMSD:
         Arc = Mol.pathwise_rmsd(align)
     else:
-        Arc = np.array([np.max([np.linalg.norm(Mol.xyzs[i+1][j]-Mol.xyzs[i][j]) for j in range(Mol.na)]) for i in range(begin, end-1)])
+        xyzs = np.array(Mol.xyzs[begin:end], dtype=float)
+        Arc = np.max(np.sqrt(np.sum((xyzs[1:]-xyzs[:-1])**2, axis=2)), axis=1)
     return Arc
 
 def EqualSpacing(Mol, frames=0, dx=0, RMSD=True, align=True):
@@ -989,16 +1370,19 @@ class Molecule(object):
         """
         The Molecule class has list-like behavior, so we can get slices of it.
         If we say MyMolecule[0:10], then we'll return a copy of MyMolecule with frames 0 through 9.
+        Frames that are memory-mapped (see read_npy) are not copied; the new object contains views of them.
         """
         if isinstance(key, int) or isinstance(key, slice) or isinstance(key,np.ndarray) or isinstance(key,list):
             if isinstance(key, int):
                 key = [key]
             New = Molecule()
+            # Only the selected frames are copied.
+            idx = np.arange(len(self))[key]
             for k in self.FrameKeys:
                 if k == 'boxes':
-                    New.Data[k] = [j for i, j in enumerate(self.Data[k]) if i in np.arange(len(self))[key]]
+                    New.Data[k] = [self.Data[k][i] for i in idx]
                 else:
-                    New.Data[k] = list(np.array(copy.deepcopy(self.Data[k]))[key])
+                    New.Data[k] = [copy_unless_mapped(self.Data[k][i]) for i in idx]
             for k in self.AtomKeys | self.MetaKeys:
                 New.Data[k] = copy.deepcopy(self.Data[k])
             New.top_settings = copy.deepcopy(self.top_settings)
@@ -1233,6 +1617,10 @@ class Molecule(object):
                          'charmm'   : self.read_charmm,
                          'dcd'      : self.read_dcd,
                          'mdcrd'    : self.read_mdcrd,
+                         'netcdf'   : self.read_netcdf,
+                         'npy'      : self.read_npy,
+                         'trr'      : self.read_trr,
+                         'xtc'      : self.read_xtc,
                          'inpcrd'   : self.read_inpcrd,
                          'pdb'      : self.read_pdb,
                          'xyz'      : self.read_xyz,
@@ -1250,6 +1638,7 @@ class Molecule(object):
                           'dcd'     : self.write_dcd,
                           'inpcrd'  : self.write_inpcrd,
                           'mdcrd'   : self.write_mdcrd,
+                          'npy'     : self.write_npy,
                           'pdb'     : self.write_pdb,
                           'qcin'    : self.write_qcin,
                           'qdata'   : self.write_qdata,
@@ -1269,7 +1658,9 @@ class Molecule(object):
                           'txt'     : 'qdata',
                           'crd'     : 'charmm',
                           'cor'     : 'charmm',
-                          'arc'     : 'tinker'}
+                          'arc'     : 'tinker',
+                          'nc'      : 'netcdf',
+                          'ncdf'    : 'netcdf'}
         ## Creates entries like 'gromacs' : 'gromacs' and 'xyz' : 'xyz'
         ## in the Funnel
         self.positive_resid = kwargs.get('positive_resid', 0)
@@ -1525,14 +1916,20 @@ class Molecule(object):
             raise RuntimeError
 
     def atom_select(self,atomslice,build_topology=True):
-        """ Return a copy of the object with certain atoms selected.  Takes an integer, list or array as argument. """
+        """ Return a copy of the object with certain atoms selected.  Takes an integer, list or array as argument.
+        If the frames are memory-mapped and the atoms are a contiguous range, the new object contains views of the frames. """
         if isinstance(atomslice, int):
             atomslice = [atomslice]
         if isinstance(atomslice, list):
             atomslice = np.array(atomslice)
+        # A slice (unlike an index array) does not copy the memory-mapped frames.
+        atomrange = atomslice
+        if atomslice.dtype.kind in 'iu' and len(atomslice) > 0 and (np.diff(atomslice) == 1).all():
+            atomrange = slice(atomslice[0], atomslice[-1]+1)
         New = Molecule()
         for key in self.FrameKeys | self.MetaKeys:
-            New.Data[key] = copy.deepcopy(self.Data[key])
+            if key not in ['xyzs', 'qm_grads', 'qm_mulliken_charges', 'qm_mulliken_spins']:
+                New.Data[key] = copy.deepcopy(self.Data[key])
         for key in self.AtomKeys:
             if key == 'tinkersuf': # Tinker suffix is a bit tricky
                 Map = dict([(a+1, i+1) for i, a in enumerate(atomslice)])
@@ -1552,7 +1949,8 @@ class Molecule(object):
                 New.Data[key] = list(np.array(self.Data[key])[atomslice])
         for key in self.FrameKeys:
            if key in ['xyzs', 'qm_grads', 'qm_mulliken_charges', 'qm_mulliken_spins']:
-               New.Data[key] = [self.Data[key][i][atomslice] for i in range(len(self))]
+               New.Data[key] = [self.Data[key][i][atomrange] if isinstance(self.Data[key][i], np.memmap)
+                                else self.Data[key][i][atomslice] for i in range(len(self))]
         if 'bonds' in self.Data:
             New.Data['bonds'] = [(list(atomslice).index(b[0]), list(atomslice).index(b[1])) for b in self.bonds if (b[0] in atomslice and b[1] in atomslice)]
         New.top_settings = self.top_settings
@@ -1684,162 +2082,123 @@ class Molecule(object):
                 self.xyzs[i] -= self.xyzs[i].mean(0)
 
     def build_bonds(self):
-        """ Build the bond connectivity graph. """
+        """
+        Build the bond connectivity graph.
+
+        Atoms are sorted into a cell list whose cells are at least as
+        wide as the largest possible bond length, so only atoms in the
+        same or adjacent cells need to be compared.  Each pair of
+        adjacent cells is visited once using a half-shell of 13
+        neighbor offsets, and the atom pairs are processed in chunks of
+        bounded size, so the cost scales linearly with the number of
+        atoms.  Orthorhombic periodic boxes are supported through the
+        minimum image convention when toppbc is set.
+        """
         sn = self.top_settings['topframe']
         toppbc = self.top_settings['toppbc']
         Fac = self.top_settings['Fac']
         mindist = 1.0 # Any two atoms that are closer than this distance are bonded.
+        # Maximum number of atom pairs whose distances are computed at once.
+        maxpairs = 2**20
         # Create an atom-wise list of covalent radii.
         # Molecule object can have its own set of radii that overrides the global ones
         R = np.array([self.top_settings['radii'].get(i, (Radii[Elements.index(i)-1] if i in Elements else 0.0)) for i in self.elem])
-        # Create a list of 2-tuples corresponding to combinations of atomic indices using a grid algorithm.
-        mins = np.min(self.xyzs[sn],axis=0)
-        maxs = np.max(self.xyzs[sn],axis=0)
-        # Grid size in Angstrom.  This number is optimized for speed in a 15,000 atom system (united atom pentadecane).
-        gsz = 6.0
         if hasattr(self, 'boxes'):
-            xmin = 0.0
-            ymin = 0.0
-            zmin = 0.0
-            xmax = self.boxes[sn].a
-            ymax = self.boxes[sn].b
-            zmax = self.boxes[sn].c
             if any([i != 90.0 for i in [self.boxes[sn].alpha, self.boxes[sn].beta, self.boxes[sn].gamma]]):
                 print "Warning: Topology building will not work with broken molecules in nonorthogonal cells."
                 toppbc = False
         else:
-            xmin = mins[0]
-            ymin = mins[1]
-            zmin = mins[2]
-            xmax = maxs[0]
-            ymax = maxs[1]
-            zmax = maxs[2]
             toppbc = False
-
-        xext = xmax-xmin
-        yext = ymax-ymin
-        zext = zmax-zmin
-
+        # Update topology settings with what we learned
+        self.top_settings['toppbc'] = toppbc
+        if self.na == 0:
+            self.Data['bonds'] = []
+            self.built_bonds = True
+            return
+        # No two atoms farther apart than this distance can be bonded.
+        rc = max(2*np.max(R)*Fac, mindist)
+        xyz = np.array(self.xyzs[sn], dtype=float)
         if toppbc:
-            gszx = xext/int(xext/gsz)
-            gszy = yext/int(yext/gsz)
-            gszz = zext/int(zext/gsz)
+            # Wrap the coordinates into the box.
+            L = np.array([self.boxes[sn].a, self.boxes[sn].b, self.boxes[sn].c], dtype=float)
+            xyz -= np.floor(xyz/L)*L
+            ext = L
         else:
-            gszx = gsz
-            gszy = gsz
-            gszz = gsz
-
-        # Run algorithm to determine bonds.
-        # Decide if we want to use the grid algorithm.
-        use_grid = toppbc or (np.min([xext, yext, zext]) > 2.0*gsz)
-        if use_grid:
-            # Inside the grid algorithm.
-            # 1) Determine the left edges of the grid cells.
-            # Note that we leave out the rightmost grid cell,
-            # because this may cause spurious partitionings.
-            xgrd = np.arange(xmin, xmax-gszx, gszx)
-            ygrd = np.arange(ymin, ymax-gszy, gszy)
-            zgrd = np.arange(zmin, zmax-gszz, gszz)
-            # 2) Grid cells are denoted by a three-index tuple.
-            gidx = list(itertools.product(range(len(xgrd)), range(len(ygrd)), range(len(zgrd))))
-            # 3) Build a dictionary which maps a grid cell to itself plus its neighboring grid cells.
-            # Two grid cells are defined to be neighbors if the differences between their x, y, z indices are at most 1.
-            gngh = OrderedDict()
-            amax = np.array(gidx[-1])
-            amin = np.array(gidx[0])
-            n27 = np.array(list(itertools.product([-1,0,1],repeat=3)))
-            for i in gidx:
-                gngh[i] = []
-                ai = np.array(i)
-                for j in n27:
-                    nj = ai+j
-                    for k in range(3):
-                        mod = amax[k]-amin[k]+1
-                        if nj[k] < amin[k]:
-                            nj[k] += mod
-                        elif nj[k] > amax[k]:
-                            nj[k] -= mod
-                    gngh[i].append(tuple(nj))
-            # 4) Loop over the atoms and assign each to a grid cell.
-            # Note: I think this step becomes the bottleneck if we choose very small grid sizes.
-            gasn = OrderedDict([(i, []) for i in gidx])
-            for i in range(self.na):
-                xidx = -1
-                yidx = -1
-                zidx = -1
-                for j in xgrd:
-                    xi = self.xyzs[sn][i][0]
-                    while xi < xmin: xi += xext
-                    while xi > xmax: xi -= xext
-                    if xi < j: break
-                    xidx += 1
-                for j in ygrd:
-                    yi = self.xyzs[sn][i][1]
-                    while yi < ymin: yi += yext
-                    while yi > ymax: yi -= yext
-                    if yi < j: break
-                    yidx += 1
-                for j in zgrd:
-                    zi = self.xyzs[sn][i][2]
-                    while zi < zmin: zi += zext
-                    while zi > zmax: zi -= zext
-                    if zi < j: break
-                    zidx += 1
-                gasn[(xidx,yidx,zidx)].append(i)
-
-            # 5) Create list of 2-tuples corresponding to combinations of atomic indices.
-            # This is done by looping over pairs of neighboring grid cells and getting Cartesian products of atom indices inside.
-            # It may be possible to get a 2x speedup by eliminating forward-reverse pairs (e.g. (5, 4) and (4, 5) and duplicates (5,5).)
-            AtomIterator = []
-            for i in gasn:
-                for j in gngh[i]:
-                    apairs = cartesian_product2([gasn[i], gasn[j]])
-                    if len(apairs) > 0: AtomIterator.append(apairs[apairs[:,0]>apairs[:,1]])
-            AtomIterator = np.ascontiguousarray(np.vstack(AtomIterator))
-        else:
-            # Create a list of 2-tuples corresponding to combinations of atomic indices.
-            # This is much faster than using itertools.combinations.
-            AtomIterator = np.ascontiguousarray(np.vstack((np.fromiter(itertools.chain(*[[i]*(self.na-i-1) for i in range(self.na)]),dtype=np.int32), np.fromiter(itertools.chain(*[range(i+1,self.na) for i in range(self.na)]),dtype=np.int32))).T)
-        # Create a list of thresholds for determining whether a certain interatomic distance is considered to be a bond.
-        BT0 = R[AtomIterator[:,0]]
-        BT1 = R[AtomIterator[:,1]]
-        BondThresh = (BT0+BT1) * Fac
-        BondThresh = (BondThresh > mindist) * BondThresh + (BondThresh < mindist) * mindist
-        if ('%s.contact' % module_name) in sys.modules:
-            if hasattr(self, 'boxes') and toppbc:
-                dxij = contact.atom_distances(np.array([self.xyzs[sn]]),AtomIterator,np.array([self.boxes[sn].a, self.boxes[sn].b, self.boxes[sn].c]))
+            xyz -= np.min(xyz, axis=0)
+            ext = np.max(xyz, axis=0)
+        # Number of cells in each dimension; capped so that the cell index fits into a 64-bit integer.
+        nc = np.minimum(np.maximum(1, np.floor(ext/rc).astype(np.int64)), 2**20)
+        # A periodic dimension with fewer than three cells would visit some pairs of cells twice,
+        # so it is treated as a single cell and the minimum image convention takes care of the rest.
+        single = np.zeros(3, dtype=bool)
+        if toppbc:
+            single = nc < 3
+            nc[single] = 1
+        # Integer cell indices of each atom.
+        ci = np.floor(xyz * nc / np.where(ext > 0, ext, 1.0)).astype(np.int64)
+        ci = np.minimum(np.maximum(ci, 0), nc-1)
+        cid = (ci[:,0]*nc[1] + ci[:,1])*nc[2] + ci[:,2]
+        # Sort the atoms by cell; each occupied cell is a contiguous range in the sorted order.
+        order = np.argsort(cid, kind='mergesort')
+        scid = cid[order]
+        cells, cstart = np.unique(scid, return_index=True)
+        ccount = np.diff(np.append(cstart, self.na))
+        cidx = ci[order[cstart]]
+        # The half-shell contains the cell itself and the 13 neighbor offsets whose first nonzero component is positive.
+        offsets = [o for o in itertools.product([-1,0,1],repeat=3) if o > (0,0,0) or o == (0,0,0)]
+        offsets = [np.array(o) for o in offsets if not any([o[k] != 0 for k in range(3) if single[k]])]
+        fragment = self.top_settings['fragment'] and 'resid' in self.Data.keys()
+        if fragment: resid = np.array(self.resid)
+        bonds = []
+        for o in offsets:
+            nidx = cidx + o
+            if toppbc:
+                nidx %= nc
+                valid = np.ones(len(cells), dtype=bool)
             else:
-                dxij = contact.atom_distances(np.array([self.xyzs[sn]]),AtomIterator)
-        else:
-            # Inefficient implementation if importing contact doesn't work.
-            if hasattr(self, 'boxes') and toppbc:
-                logger.error("No minimum image convention available (import '%s.contact' if you need it)." % module_name)
-                raise RuntimeError
-            dxij = [np.array([np.linalg.norm(self.xyzs[sn][i]-self.xyzs[sn][j]) for i, j in AtomIterator])]
-
-        # Update topology settings with what we learned
-        self.top_settings['toppbc'] = toppbc
-
-        # Create a list of atoms that each atom is bonded to.
-        atom_bonds = [[] for i in range(self.na)]
-        bond_bool = dxij[0] < BondThresh
-        for i, a in enumerate(bond_bool):
-            if not a: continue
-            (ii, jj) = AtomIterator[i]
-            if ii == jj: continue
-            atom_bonds[ii].append(jj)
-            atom_bonds[jj].append(ii)
-        bondlist = []
-        for i, bi in enumerate(atom_bonds):
-            for j in bi:
-                if i == j: continue
+                valid = np.all((nidx >= 0) & (nidx < nc), axis=1)
+            ncid = (nidx[:,0]*nc[1] + nidx[:,1])*nc[2] + nidx[:,2]
+            pos = np.minimum(np.searchsorted(cells, ncid), len(cells)-1)
+            valid &= (cells[pos] == ncid)
+            # Pairs of occupied cells (a, b) and the number of atom pairs between them.
+            ca = np.nonzero(valid)[0]
+            cb = pos[ca]
+            npair = ccount[ca]*ccount[cb]
+            if len(npair) == 0: continue
+            # Split the cell pairs into chunks of at most maxpairs atom pairs (or a single cell pair).
+            cum = np.cumsum(npair)
+            bounds = [0]
+            while bounds[-1] < len(npair):
+                done = cum[bounds[-1]-1] if bounds[-1] > 0 else 0
+                bounds.append(max(bounds[-1]+1, np.searchsorted(cum, done+maxpairs, side='right')))
+            for b0, b1 in zip(bounds[:-1], bounds[1:]):
+                n = npair[b0:b1]
+                k = np.repeat(np.arange(b0, b1), n)
+                local = np.arange(np.sum(n)) - np.repeat(np.cumsum(n)-n, n)
+                ia = local // ccount[cb[k]]
+                ib = local % ccount[cb[k]]
+                if not o.any():
+                    # Within a cell, only count each pair once.
+                    keep = ia < ib
+                    k = k[keep]
+                    ia = ia[keep]
+                    ib = ib[keep]
+                ai = order[cstart[ca[k]]+ia]
+                aj = order[cstart[cb[k]]+ib]
+                dx = xyz[ai]-xyz[aj]
+                if toppbc:
+                    dx -= L*np.round(dx/L)
+                BondThresh = np.maximum((R[ai]+R[aj]) * Fac, mindist)
+                bond_bool = np.sum(dx*dx, axis=1) < BondThresh**2
                 # Do not add a bond between resids if fragment is set to True.
-                if self.top_settings['fragment'] and 'resid' in self.Data.keys() and self.resid[i] != self.resid[j] : continue
-                elif i < j:
-                    bondlist.append((i, j))
-                else:
-                    bondlist.append((j, i))
-        self.Data['bonds'] = sorted(list(set(bondlist)))
+                if fragment: bond_bool &= (resid[ai] == resid[aj])
+                ai = ai[bond_bool]
+                aj = aj[bond_bool]
+                bonds.append(np.array([np.minimum(ai, aj), np.maximum(ai, aj)]).T)
+        bonds = np.vstack(bonds) if len(bonds) > 0 else np.zeros((0, 2), dtype=np.int64)
+        bonds = bonds[bonds[:,0] != bonds[:,1]]
+        bkey = np.unique(bonds[:,0].astype(np.int64)*self.na + bonds[:,1])
+        self.Data['bonds'] = [(int(i), int(j)) for i, j in zip(bkey // self.na, bkey % self.na)]
         self.built_bonds = True
 
     def build_topology(self, force_bonds=True, **kwargs):
@@ -2199,55 +2558,70 @@ class Molecule(object):
                 hyds.append(i)
         return hyds
 
-    def all_pairwise_rmsd(self):
-        """ Find pairwise RMSD (super slow, not like the one in MSMBuilder.) """
+    def all_pairwise_rmsd(self, nthreads=1, chunk=100, out=None):
+        """
+        Find the RMSD between all pairs of frames after optimal superposition.
+
+        Each row of the matrix is computed for all earlier frames at
+        once using the QCP method (see rmsd_qcp), on a contiguous
+        array of centered coordinates.
+
+        Parameters
+        ----------
+        nthreads : int, default=1
+            Number of threads that compute the rows of the matrix
+            (NumPy releases the GIL in the array operations)
+        chunk : int, default=100
+            Number of rows given to a thread at a time
+        out : np.ndarray, optional
+            (N, N) array for storing the result, for example a memory-mapped
+            array from np.lib.format.open_memmap for very large N
+
+        Returns
+        -------
+        np.ndarray
+            Symmetric (N, N) matrix of RMSD values
+        """
         N = len(self)
-        Mat = np.zeros((N,N),dtype=float)
-        for i in range(N):
-            xyzi = self.xyzs[i].copy()
-            xyzi -= xyzi.mean(0)
-            for j in range(i):
-                xyzj = self.xyzs[j].copy()
-                xyzj -= xyzj.mean(0)
-                tr, rt = get_rotate_translate(xyzj, xyzi)
-                xyzj = np.dot(xyzj, rt) + tr
-                rmsd = np.sqrt(3*np.mean((xyzj - xyzi) ** 2))
-                Mat[i,j] = rmsd
-                Mat[j,i] = rmsd
+        xyzs = np.array(self.xyzs, dtype=float)
+        xyzs -= xyzs.mean(1)[:, np.newaxis, :]
+        Mat = np.zeros((N,N),dtype=float) if out is None else out
+        def fill_row(i):
+            rmsd = rmsd_qcp(xyzs[i], xyzs[:i]) if i > 0 else np.zeros(0)
+            Mat[i,:i] = rmsd
+            Mat[:i,i] = rmsd
+            Mat[i,i] = 0.0
+        if nthreads > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(nthreads)
+            # Rows are given out from the end because they take longer.
+            pool.map(fill_row, range(N)[::-1], chunksize=chunk)
+            pool.close()
+            pool.join()
+        else:
+            for i in range(N):
+                fill_row(i)
         return Mat
 
     def pathwise_rmsd(self, align=True):
         """ Find RMSD between frames along path. """
-        N = len(self)
-        Vec = np.zeros(N-1, dtype=float)
-        for i in range(N-1):
-            xyzi = self.xyzs[i].copy()
-            j=i+1
-            xyzj = self.xyzs[j].copy()
-            if align:
-                xyzi -= xyzi.mean(0)
-                xyzj -= xyzj.mean(0)
-                tr, rt = get_rotate_translate(xyzj, xyzi)
-                xyzj = np.dot(xyzj, rt) + tr
-            rmsd = np.sqrt(3*np.mean((xyzj - xyzi) ** 2))
-            Vec[i] = rmsd
-        return Vec
+        xyzs = np.array(self.xyzs, dtype=float)
+        if len(xyzs) < 2:
+            return np.zeros(0)
+        if align:
+            xyzs -= xyzs.mean(1)[:, np.newaxis, :]
+            return rmsd_qcp(xyzs[:-1], xyzs[1:])
+        return np.sqrt(3*np.mean((xyzs[1:] - xyzs[:-1]) ** 2, axis=(1,2)))
 
     def ref_rmsd(self, i, align=True):
         """ Find RMSD to a reference frame. """
-        N = len(self)
-        Vec = np.zeros(N)
-        xyzi = self.xyzs[i].copy()
-        if align: xyzi -= xyzi.mean(0)
-        for j in range(N):
-            xyzj = self.xyzs[j].copy()
-            if align:
-                xyzj -= xyzj.mean(0)
-                tr, rt = get_rotate_translate(xyzj, xyzi)
-                xyzj = np.dot(xyzj, rt) + tr
-            rmsd = np.sqrt(3*np.mean((xyzj - xyzi) ** 2))
-            Vec[j] = rmsd
-        return Vec
+        xyzs = np.array(self.xyzs, dtype=float)
+        if align:
+            xyzs -= xyzs.mean(1)[:, np.newaxis, :]
+            Vec = rmsd_qcp(xyzs[i], xyzs)
+            Vec[i] = 0.0
+            return Vec
+        return np.sqrt(3*np.mean((xyzs - xyzs[i]) ** 2, axis=(1,2)))
 
     def align_center(self):
         self.align()
@@ -2588,6 +2962,120 @@ class Molecule(object):
                   'boxes' : boxes}
         return Answer
 
+    def read_trr(self, fnm, **kwargs):
+        """ Read the coordinates and boxes from a GROMACS .trr file.
+        All of the frames are stored in one contiguous array.
+
+        @param[in] fnm The input file name
+        @param[in] stride (keyword argument) Read every stride-th frame
+        @param[in] atoms (keyword argument) List of atom indices to read (default is all atoms)
+        @return xyzs  A list of XYZ coordinates (number of snapshots times number of atoms)
+        @return boxes Boxes (if present.)
+
+        """
+        return self.read_gmx_frames(iter_trr(fnm, kwargs.get('stride', 1), kwargs.get('atoms', None)))
+
+    def read_xtc(self, fnm, **kwargs):
+        """ Read the coordinates and boxes from a GROMACS .xtc file.
+        All of the frames are stored in one contiguous array.
+
+        @param[in] fnm The input file name
+        @param[in] stride (keyword argument) Read every stride-th frame
+        @param[in] atoms (keyword argument) List of atom indices to read (default is all atoms)
+        @return xyzs  A list of XYZ coordinates (number of snapshots times number of atoms)
+        @return boxes Boxes
+
+        """
+        return self.read_gmx_frames(iter_xtc(fnm, kwargs.get('stride', 1), kwargs.get('atoms', None)))
+
+    def read_gmx_frames(self, frames):
+        """ Collect the frames returned by iter_trr or iter_xtc, converting nanometers to Angstrom. """
+        xyzs = []
+        boxes = []
+        for frame in frames:
+            # .trr frames may contain only velocities or forces.
+            if 'x' not in frame: continue
+            xyzs.append(frame['x'])
+            if 'box' in frame:
+                boxes.append(BuildLatticeFromGMX(frame['box']))
+        # Each frame is a view into the same (nframes, natoms, 3) array.
+        Answer = {'xyzs' : list(np.array(xyzs) * 10)}
+        if len(boxes) == len(xyzs) and all([b.V > 0 for b in boxes]):
+            Answer['boxes'] = boxes
+        return Answer
+
+    def read_netcdf(self, fnm, **kwargs):
+        """ Read the coordinates and boxes from an AMBER NetCDF trajectory.
+        The file is memory mapped, so only the selected frames and atoms are read.
+
+        @param[in] fnm The input file name
+        @param[in] stride (keyword argument) Read every stride-th frame
+        @param[in] atoms (keyword argument) List of atom indices to read (default is all atoms)
+        @return xyzs  A list of XYZ coordinates (number of snapshots times number of atoms)
+        @return boxes Boxes (if present.)
+
+        """
+        from scipy.io import netcdf
+        stride = kwargs.get('stride', 1)
+        atoms = kwargs.get('atoms', None)
+        nc = netcdf.netcdf_file(fnm, 'r', mmap=True)
+        if 'coordinates' not in nc.variables:
+            logger.error('%s does not contain any coordinates\n' % fnm)
+            raise RuntimeError
+        xyz = nc.variables['coordinates'][::stride]
+        if atoms is not None:
+            xyz = xyz[:, atoms]
+        # Copy the data out of the memory map before the file is closed.
+        Answer = {'xyzs' : list(np.array(xyz, dtype=float))}
+        if 'cell_lengths' in nc.variables:
+            lengths = np.array(nc.variables['cell_lengths'][::stride], dtype=float)
+            angles = np.array(nc.variables['cell_angles'][::stride], dtype=float)
+            Answer['boxes'] = [BuildLatticeFromLengthsAngles(*(list(l) + list(a))) for l, a in zip(lengths, angles)]
+        del xyz
+        nc.close()
+        return Answer
+
+    def read_npy(self, fnm, **kwargs):
+        """ Read coordinates from a NumPy .npy file containing an array of shape
+        (number of snapshots, number of atoms, 3) in Angstrom, as written by write_npy.
+        The file is memory-mapped, so the frames are only loaded from disk when they are used,
+        and slicing the Molecule object returns views instead of copies.
+        Writing to the coordinates does not modify the file.
+
+        Boxes are read from a file with the same base name ending in _boxes.npy
+        which contains the lattice lengths and angles for each frame, if it exists.
+        Since there is no topology information, the file is usually loaded with a topology
+        file, as in Molecule('all.npy', top='conf.pdb').
+
+        @param[in] fnm The input file name
+        @param[in] stride (keyword argument) Read every stride-th frame
+        @param[in] atoms (keyword argument) List of atom indices to read (default is all atoms)
+        @return xyzs  A list of XYZ coordinates (number of snapshots times number of atoms)
+        @return boxes Boxes (if present.)
+
+        """
+        stride = kwargs.get('stride', 1)
+        atoms = kwargs.get('atoms', None)
+        xyz = np.load(fnm, mmap_mode='c')
+        if xyz.ndim != 3 or xyz.shape[2] != 3:
+            logger.error('%s does not contain an array of coordinates with shape (frames, atoms, 3)\n' % fnm)
+            raise RuntimeError
+        xyz = xyz[::stride]
+        if atoms is not None:
+            xyz = xyz[:, atoms]
+        Answer = {'xyzs' : list(xyz)}
+        boxfnm = os.path.splitext(fnm)[0] + '_boxes.npy'
+        if os.path.exists(boxfnm):
+            # Many frames usually share the same box, so each box is only built once.
+            Boxes = {}
+            Answer['boxes'] = []
+            for abc in np.load(boxfnm)[::stride]:
+                abc = tuple(abc)
+                if abc not in Boxes:
+                    Boxes[abc] = BuildLatticeFromLengthsAngles(*abc)
+                Answer['boxes'].append(Boxes[abc])
+        return Answer
+
     def read_com(self, fnm, **kwargs):
         """ Parse a Gaussian .com file and return a SINGLE-ELEMENT list of xyz coordinates (no multiple file support)
 
@@ -3758,6 +4246,16 @@ class Molecule(object):
         _dcdlib.close_file_write(dcd)
         dcd = None
 
+    def write_npy(self, selection, **kwargs):
+        """ Write the coordinates to a NumPy .npy file that can be memory-mapped by read_npy,
+        and the boxes (if present) to a file with the same base name ending in _boxes.npy. """
+        self.require('xyzs')
+        np.save(self.fout, np.array([self.xyzs[i] for i in selection], dtype=float))
+        if 'boxes' in self.Data:
+            np.save(os.path.splitext(self.fout)[0] + '_boxes.npy',
+                    np.array([[self.boxes[i].a, self.boxes[i].b, self.boxes[i].c,
+                               self.boxes[i].alpha, self.boxes[i].beta, self.boxes[i].gamma] for i in selection], dtype=float))
+
     def write_pdb(self, selection, **kwargs):
         """Save to a PDB. Copied wholesale from MSMBuilder. """
 
@@ -180,8 +180,7 @@ class Moments(Target):
         dV = np.zeros((self.FF.np,len(calc_momvals)))
 
         if AGrad or AHess:
-            for p in self.pgrad:
-                dV[p,:], _ = f12d3p(fdwrap(get_momvals, mvals, p), h = self.h, f0 = calc_momvals)
+            dV[self.pgrad,:], _ = self.fd_pool(get_momvals, mvals, f0 = calc_momvals)
                 
         Answer['X'] = np.dot(D,D)
         for p in self.pgrad:
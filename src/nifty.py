@@ -22,6 +22,10 @@ import itertools
 import threading
 import pickle
 import tarfile
+import tempfile
+import hashlib
+import atexit
+import socket
 import time
 import subprocess
 import math
@@ -592,6 +596,8 @@ def statisticalInefficiency(A_n, B_n=None, fast=False, mintime=3, warn=True):
     Notes
       The same timeseries can be used for both A_n and B_n to get the autocorrelation statistical inefficiency.
       The fast method described in Ref [1] is used to compute g.
+      The correlation function is computed for all times at once using FFTs,
+      so the cost is O(N log N) in the length of the timeseries.
 
     References
       [1] J. D. Chodera, W. C. Swope, J. W. Pitera, C. Seok, and K. A. Dill. Use of the weighted
@@ -607,7 +613,8 @@ def statisticalInefficiency(A_n, B_n=None, fast=False, mintime=3, warn=True):
     >>> g = statisticalInefficiency(A_n, fast=True)
 
     @param[in] A_n (required, numpy array) - A_n[n] is nth value of
-    timeseries A.  Length is deduced from vector.
+    timeseries A.  Length is deduced from vector.  If a 2-D array is
+    given, each column is treated as a separate timeseries.
 
     @param[in] B_n (optional, numpy array) - B_n[n] is nth value of
     timeseries B.  Length is deduced from vector.  If supplied, the
@@ -627,6 +634,7 @@ def statisticalInefficiency(A_n, B_n=None, fast=False, mintime=3, warn=True):
 
     @return g The estimated statistical inefficiency (equal to 1 + 2
     tau, where tau is the correlation time).  We enforce g >= 1.0.
+    If A_n is 2-D, an array containing g for each column.
 
     """
     # Create numpy copies of input arguments.
@@ -635,46 +643,81 @@ def statisticalInefficiency(A_n, B_n=None, fast=False, mintime=3, warn=True):
         B_n = np.array(B_n)
     else:
         B_n = np.array(A_n)
-    # Get the length of the timeseries.
-    N = A_n.shape[0]
     # Be sure A_n and B_n have the same dimensions.
     if(A_n.shape != B_n.shape):
         logger.error('A_n and B_n must have same dimensions.\n')
         raise ParameterError
-    # Initialize statistical inefficiency estimate with uncorrelated value.
-    g = 1.0
-    # Compute mean of each timeseries.
-    mu_A = A_n.mean()
-    mu_B = B_n.mean()
+    # Get the length of the timeseries.
+    N = A_n.shape[0]
+    # The times at which the correlation function is evaluated, and the amount by which t is incremented.
+    # The correlation function is computed out to t = N-2.
+    if fast:
+        increment = np.arange(1, N)
+        t = 1 + np.cumsum(increment) - increment
+        keep = t < N-1
+        t, increment = t[keep], increment[keep]
+    else:
+        t = np.arange(1, N-1)
+        increment = np.ones(len(t), dtype=int)
+    C = correlationFunction(A_n, B_n)
+    if A_n.ndim == 2:
+        return np.array([statisticalInefficiency_(C[:,i], t, increment, mintime, warn) for i in range(C.shape[1])])
+    return statisticalInefficiency_(C, t, increment, mintime, warn)
+
+def correlationFunction(A_n, B_n):
+
+    """
+    Compute the normalized fluctuation (cross) correlation function
+    of two timeseries at all times t = 0 .. N-1 using FFTs.
+
+    @param[in] A_n, B_n Timeseries of the same shape; 2-D arrays are treated column by column.
+    @return C The correlation function with the same shape as A_n, symmetrized in A and B
+    and normalized so that C[0] = 1.  If the sample covariance is zero, C is all zeros.
+    """
+    N = A_n.shape[0]
     # Make temporary copies of fluctuation from mean.
-    dA_n = A_n.astype(np.float64) - mu_A
-    dB_n = B_n.astype(np.float64) - mu_B
+    dA_n = A_n.astype(np.float64) - A_n.mean(axis=0)
+    dB_n = B_n.astype(np.float64) - B_n.mean(axis=0)
     # Compute estimator of covariance of (A,B) using estimator that will ensure C(0) = 1.
-    sigma2_AB = (dA_n * dB_n).mean() # standard estimator to ensure C(0) = 1
-    # Trap the case where this covariance is zero, and we cannot proceed.
-    if(sigma2_AB == 0):
+    sigma2_AB = (dA_n * dB_n).mean(axis=0)
+    # Zero-pad to 2N so the circular correlation from the FFT is equal to the linear one.
+    fA = np.fft.rfft(dA_n, n=2*N, axis=0)
+    fB = np.fft.rfft(dB_n, n=2*N, axis=0)
+    # sum_n dA[n]*dB[n+t] + dB[n]*dA[n+t] for each t
+    S = np.fft.irfft(2*np.real(np.conj(fA)*fB), n=2*N, axis=0)[:N]
+    NT = (N - np.arange(N)).astype(np.float64).reshape((N,) + (1,)*(A_n.ndim-1))
+    # Trap the case where the covariance is zero, and we cannot proceed.
+    nz = np.array(sigma2_AB != 0)
+    return np.where(nz, S / (2.0 * NT * np.where(nz, sigma2_AB, 1.0)), 0.0)
+
+def statisticalInefficiency_(C, t, increment, mintime=3, warn=True):
+
+    """
+    Accumulate the statistical inefficiency from the correlation function
+    returned by correlationFunction.  Not intended to be called directly.
+
+    @param[in] C The normalized correlation function for times 0 .. N-1
+    @param[in] t The times at which to evaluate C
+    @param[in] increment The amount by which t is incremented at each time
+    @param[in] mintime Minimum amount of correlation function to compute
+    @param[in] warn Print a warning if the sample covariance is zero
+    @return g The estimated statistical inefficiency
+    """
+    if not np.any(C):
         if warn:
             logger.warning('Sample covariance sigma_AB^2 = 0 -- cannot compute statistical inefficiency\n')
         return 1.0
+    N = len(C)
     # Accumulate the integrated correlation time by computing the normalized correlation time at
     # increasing values of t.  Stop accumulating if the correlation function goes negative, since
     # this is unlikely to occur unless the correlation function has decayed to the point where it
     # is dominated by noise and indistinguishable from zero.
-    t = 1
-    increment = 1
-    while (t < N-1):
-        # compute normalized fluctuation correlation function at time t
-        C = sum( dA_n[0:(N-t)]*dB_n[t:N] + dB_n[0:(N-t)]*dA_n[t:N] ) / (2.0 * float(N-t) * sigma2_AB)
-        # Terminate if the correlation function has crossed zero and we've computed the correlation
-        # function at least out to 'mintime'.
-        if (C <= 0.0) and (t > mintime):
-            break
-        # Accumulate contribution to the statistical inefficiency.
-        g += 2.0 * C * (1.0 - float(t)/float(N)) * float(increment)
-        # Increment t and the amount by which we increment t.
-        t += increment
-        # Increase the interval if "fast mode" is on.
-        if fast: increment += 1
+    Ct = C[t]
+    stop = np.nonzero((Ct <= 0.0) & (t > mintime))[0]
+    if len(stop) > 0:
+        t, increment, Ct = t[:stop[0]], increment[:stop[0]], Ct[:stop[0]]
+    # Accumulate contribution to the statistical inefficiency.
+    g = 1.0 + np.sum(2.0 * Ct * (1.0 - t.astype(np.float64)/float(N)) * increment)
     # g must be at least unity
     if (g < 1.0): g = 1.0
     # Return the computed statistical inefficiency.
@@ -685,16 +728,12 @@ def mean_stderr(ts):
     return np.mean(ts), \
       np.std(ts)*np.sqrt(statisticalInefficiency(ts, warn=False)/len(ts))
 
-# Slices a 2D array of data by column.  The new array is fed into the statisticalInefficiency function.
+# Computes the statistical inefficiency of each column of a 2D array of data, broadcast to the shape of the array.
 def multiD_statisticalInefficiency(A_n, B_n=None, fast=False, mintime=3, warn=True):
     n_row = A_n.shape[0]
     n_col = A_n.shape[-1]
     multiD_sI = np.zeros((n_row, n_col))
-    for col in range(n_col):
-        if B_n is None:
-            multiD_sI[:,col] = statisticalInefficiency(A_n[:,col], B_n, fast, mintime, warn)
-        else:
-            multiD_sI[:,col] = statisticalInefficiency(A_n[:,col], B_n[:,col], fast, mintime, warn)
+    multiD_sI[:,:] = statisticalInefficiency(A_n, B_n, fast, mintime, warn)
     return multiD_sI
 
 #==============================#
@@ -853,13 +892,254 @@ def createWorkQueue(wq_port, debug=True, name='forcebalance'):
     #WORK_QUEUE.specify_keepalive_timeout(8640000)
     WORK_QUEUE.specify_keepalive_interval(8640000)
 
+def createLocalQueue(nworkers, scratch=None, max_retries=3):
+    """ Create a LocalQueue that runs the tasks on this machine in place of Work Queue. """
+    global WORK_QUEUE
+    WORK_QUEUE = LocalQueue(nworkers, scratch=scratch, max_retries=max_retries)
+
 def destroyWorkQueue():
     # Convenience function to destroy the Work Queue objects.
     global WORK_QUEUE, WQIDS
     WORK_QUEUE = None
     WQIDS = defaultdict(list)
 
-def queue_up(wq, command, input_files, output_files, tag=None, tgt=None, verbose=True, print_time=60):
+class TaskQueue(object):
+    """
+    Interface of a task queue backend that can be used in place of
+    the Work Queue object by queue_up, queue_up_src_dest, wq_wait1
+    and wq_wait.  It follows the part of the Work Queue API that
+    ForceBalance uses: tasks are created with new_task, submitted with
+    submit, and returned by wait once they are finished.  The stats
+    attribute contains the queue statistics printed by wq_wait1.
+    """
+    def new_task(self, command):
+        """ Create a task that runs a shell command. """
+        raise NotImplementedError
+
+    def submit(self, task):
+        """ Submit a task and return the task ID. """
+        raise NotImplementedError
+
+    def wait(self, timeout):
+        """ Wait up to timeout seconds for a task to finish.  Return the finished task, or None. """
+        raise NotImplementedError
+
+    def empty(self):
+        """ Return True if there are no submitted tasks that have not been returned by wait. """
+        raise NotImplementedError
+
+class TaskQueueStats(object):
+    """ Queue statistics with the same names as the Work Queue statistics. """
+    def __init__(self):
+        self.workers_init = 0
+        self.workers_ready = 0
+        self.workers_busy = 0
+        self.total_workers_joined = 0
+        self.total_workers_removed = 0
+        self.tasks_running = 0
+        self.tasks_waiting = 0
+        self.total_tasks_dispatched = 0
+        self.total_tasks_complete = 0
+        self.total_bytes_sent = 0
+        self.total_bytes_received = 0
+
+class LocalTask(object):
+    """ A task for LocalQueue, with the same methods and result attributes as a Work Queue task. """
+    def __init__(self, command):
+        self.command = command
+        self.tag = command
+        self.id = None
+        self.input_files = []
+        self.output_files = []
+        self.retries = 0
+        self.status = 0
+        self.result = 0
+        self.return_status = None
+        self.output = ''
+        self.hostname = socket.gethostname()
+        self.cmd_execution_time = 0
+        self.total_bytes_transferred = 0
+
+    def specify_input_file(self, local_name, remote_name=None, cache=False):
+        self.input_files.append((local_name, remote_name if remote_name is not None else os.path.basename(local_name)))
+
+    def specify_output_file(self, local_name, remote_name=None, cache=False):
+        self.output_files.append((local_name, remote_name if remote_name is not None else os.path.basename(local_name)))
+
+    def specify_algorithm(self, algorithm):
+        pass
+
+    def specify_tag(self, tag):
+        self.tag = tag
+
+class LocalQueue(TaskQueue):
+    """
+    Task queue that runs the tasks as processes on this machine, so that
+    the targets that use Work Queue can run their simulations concurrently
+    without a Work Queue master and workers.
+
+    Each task runs in its own scratch directory, like on a Work Queue
+    worker: the input files are copied in before the command starts,
+    and the output files are moved back when it finishes.  A task is
+    successful if the command created all of the output files (as in
+    Work Queue, the exit status of the command is only reported);
+    otherwise it is run again in a new scratch directory, up to
+    max_retries times, before it is returned as failed.
+    """
+    def __init__(self, nworkers, scratch=None, max_retries=3):
+        """
+        @param[in] nworkers Number of tasks that run at the same time
+        @param[in] scratch Directory for the task scratch directories (default is the system temporary directory)
+        @param[in] max_retries Number of times that a failed task is run again
+        """
+        self.nworkers = nworkers
+        self.scratch = scratch
+        self.max_retries = max_retries
+        self.port = None
+        self.waiting = []
+        self.running = []
+        self.finished = []
+        self.last_id = 0
+        self.stats = TaskQueueStats()
+        self.stats.workers_init = nworkers
+        self.stats.total_workers_joined = nworkers
+
+    def new_task(self, command):
+        return LocalTask(command)
+
+    def submit(self, task):
+        self.last_id += 1
+        task.id = self.last_id
+        task.retries = 0
+        self.waiting.append(task)
+        self.stats.tasks_waiting = len(self.waiting)
+        return task.id
+
+    def empty(self):
+        return len(self.waiting) + len(self.running) + len(self.finished) == 0
+
+    def start(self, task):
+        """ Copy the input files of a task into a new scratch directory and start the command. """
+        task.scratch = tempfile.mkdtemp(prefix='task%i.' % task.id, dir=self.scratch)
+        for lf, rf in task.input_files:
+            dest = os.path.join(task.scratch, rf)
+            if not os.path.isdir(os.path.dirname(dest)): os.makedirs(os.path.dirname(dest))
+            if os.path.isdir(lf):
+                shutil.copytree(lf, dest)
+            else:
+                shutil.copy2(lf, dest)
+                task.total_bytes_transferred += os.path.getsize(lf)
+                self.stats.total_bytes_sent += os.path.getsize(lf)
+        task.logfile = open(os.path.join(task.scratch, '.task.log'), 'w+')
+        task.start_time = time.time()
+        task.process = subprocess.Popen(task.command, shell=True, cwd=task.scratch, stdout=task.logfile, stderr=STDOUT)
+        self.running.append(task)
+        self.stats.total_tasks_dispatched += 1
+
+    def finish(self, task):
+        """ Move the output files of a finished task back, and run it again if any of them are missing. """
+        task.cmd_execution_time = int((time.time() - task.start_time) * 1000000)
+        task.return_status = task.process.returncode
+        task.logfile.seek(0)
+        task.output = task.logfile.read()
+        task.logfile.close()
+        task.result = 0
+        for lf, rf in task.output_files:
+            src = os.path.join(task.scratch, rf)
+            if not os.path.exists(src):
+                task.result = 1
+                continue
+            if os.path.isfile(src):
+                task.total_bytes_transferred += os.path.getsize(src)
+                self.stats.total_bytes_received += os.path.getsize(src)
+            if os.path.isdir(lf):
+                shutil.rmtree(lf)
+            shutil.move(src, lf)
+        shutil.rmtree(task.scratch, ignore_errors=True)
+        del task.process, task.logfile, task.scratch
+        if task.result != 0 and task.retries < self.max_retries:
+            task.retries += 1
+            logger.warning("Task '%s' (task %i) failed (exit status %s, missing output files), retrying (%i/%i)\n" %
+                           (task.tag, task.id, str(task.return_status), task.retries, self.max_retries))
+            self.waiting.insert(0, task)
+        else:
+            self.finished.append(task)
+            self.stats.total_tasks_complete += 1
+
+    def update(self):
+        """ Collect the tasks that are finished and start waiting tasks on the free workers. """
+        for task in [t for t in self.running if t.process.poll() is not None]:
+            self.running.remove(task)
+            self.finish(task)
+        while len(self.waiting) > 0 and len(self.running) < self.nworkers:
+            self.start(self.waiting.pop(0))
+        self.stats.tasks_waiting = len(self.waiting)
+        self.stats.tasks_running = len(self.running)
+        self.stats.workers_busy = len(self.running)
+        self.stats.workers_ready = self.nworkers - len(self.running)
+
+    def wait(self, timeout):
+        t0 = time.time()
+        while True:
+            self.update()
+            if len(self.finished) > 0:
+                return self.finished.pop(0)
+            if len(self.running) == 0 or time.time() - t0 >= timeout:
+                return None
+            time.sleep(0.05)
+
+# Content-addressed copies of the input files that are cached on the Work Queue workers.
+CACHED_INPUTS = {}
+CACHED_INPUTS_DIR = []
+# Number of cached input files and their total size, for each time they are specified as an input file.
+CACHED_INPUTS_STATS = {'files' : 0, 'bytes' : 0}
+
+def cached_input(lf):
+    """
+    Return a copy of a file whose name contains the SHA-1 hash of its
+    contents, for specifying as an input file that is cached on the
+    Work Queue workers.  Workers cache files by their local name, so
+    a file is sent to each worker once, and again only if its contents
+    change.  The copies are made once for each version of the file,
+    in a temporary directory that is removed on exit.
+
+    @param[in] lf Path of the input file
+    @return Path of the content-addressed copy
+    """
+    st = os.stat(lf)
+    key = (os.path.realpath(lf), st.st_size, st.st_mtime)
+    if key not in CACHED_INPUTS:
+        if len(CACHED_INPUTS_DIR) == 0:
+            CACHED_INPUTS_DIR.append(tempfile.mkdtemp(prefix='fb-wq-cache-'))
+            atexit.register(shutil.rmtree, CACHED_INPUTS_DIR[0], True)
+        sha = hashlib.sha1()
+        with open(lf, 'rb') as f:
+            for chunk in iter(lambda: f.read(1048576), ''):
+                sha.update(chunk)
+        cf = os.path.join(CACHED_INPUTS_DIR[0], '%s-%s' % (sha.hexdigest(), os.path.basename(lf)))
+        if not os.path.exists(cf):
+            shutil.copy2(lf, cf)
+        CACHED_INPUTS[key] = cf
+    CACHED_INPUTS_STATS['files'] += 1
+    CACHED_INPUTS_STATS['bytes'] += st.st_size
+    return CACHED_INPUTS[key]
+
+def specify_input_file(wq, task, lf, rf, cache):
+    """ Specify an input file of a task, which is content-addressed and cached on the workers if cache is True. """
+    if cache and not isinstance(wq, TaskQueue):
+        task.specify_input_file(cached_input(lf), rf, cache=True)
+    else:
+        task.specify_input_file(lf, rf, cache=False)
+
+def new_task(wq, command):
+    """ Create a task for the Work Queue or the task queue backend that is used in its place. """
+    if isinstance(wq, TaskQueue):
+        return wq.new_task(command)
+    task = work_queue.Task(command)
+    task.specify_algorithm(work_queue.WORK_QUEUE_SCHEDULE_FCFS)
+    return task
+
+def queue_up(wq, command, input_files, output_files, tag=None, tgt=None, verbose=True, print_time=60, cache_files=[]):
     """
     Submit a job to the Work Queue.
 
@@ -867,17 +1147,18 @@ def queue_up(wq, command, input_files, output_files, tag=None, tgt=None, verbose
     @param[in] command (string) The command to run on the remote worker.
     @param[in] input_files (list of files) A list of locations of the input files.
     @param[in] output_files (list of files) A list of locations of the output files.
+    @param[in] cache_files (list of files) Input files that don't change between iterations
+    (e.g. coordinates and scripts); these are cached on the workers by their contents (see cached_input).
     """
     global WQIDS
-    task = work_queue.Task(command)
+    task = new_task(wq, command)
     cwd = os.getcwd()
     for f in input_files:
         lf = os.path.join(cwd,f)
-        task.specify_input_file(lf,f,cache=False)
+        specify_input_file(wq, task, lf, f, f in cache_files)
     for f in output_files:
         lf = os.path.join(cwd,f)
         task.specify_output_file(lf,f,cache=False)
-    task.specify_algorithm(work_queue.WORK_QUEUE_SCHEDULE_FCFS)
     if tag is None: tag = command
     task.specify_tag(tag)
     task.print_time = print_time
@@ -889,7 +1170,7 @@ def queue_up(wq, command, input_files, output_files, tag=None, tgt=None, verbose
     else:
         WQIDS["None"].append(taskid)
 
-def queue_up_src_dest(wq, command, input_files, output_files, tag=None, tgt=None, verbose=True, print_time=60):
+def queue_up_src_dest(wq, command, input_files, output_files, tag=None, tgt=None, verbose=True, print_time=60, cache_files=[]):
     """
     Submit a job to the Work Queue.  This function is a bit fancier in that we can explicitly
     specify where the input files come from, and where the output files go to.
@@ -900,16 +1181,17 @@ def queue_up_src_dest(wq, command, input_files, output_files, tag=None, tgt=None
     remote locations of the input files.
     @param[in] output_files (list of 2-tuples) A list of local and
     remote locations of the output files.
+    @param[in] cache_files (list of files) Local locations of input files that don't change between
+    iterations; these are cached on the workers by their contents (see cached_input).
     """
     global WQIDS
-    task = work_queue.Task(command)
+    task = new_task(wq, command)
     for f in input_files:
         # print f[0], f[1]
-        task.specify_input_file(f[0],f[1],cache=False)
+        specify_input_file(wq, task, f[0], f[1], f[0] in cache_files)
     for f in output_files:
         # print f[0], f[1]
         task.specify_output_file(f[0],f[1],cache=False)
-    task.specify_algorithm(work_queue.WORK_QUEUE_SCHEDULE_FCFS)
     if tag is None: tag = command
     task.specify_tag(tag)
     task.print_time = print_time
@@ -943,7 +1225,12 @@ def wq_wait1(wq, wait_time=10, wait_intvl=1, print_time=60, verbose=False):
                 logger.info("host = " + task.hostname + '\n')
                 logger.info("execution time = " + exectime)
                 logger.info("total_bytes_transferred = " + task.total_bytes_transferred + '\n')
-            if task.result != 0:
+            if task.result != 0 and isinstance(wq, LocalQueue):
+                # The local queue has already run the task again as many times as it is allowed to.
+                logger.error("Task '%s' (task %i) failed %i times, last exit status %s; output:\n%s\n" %
+                             (task.tag, task.id, task.retries+1, str(task.return_status), task.output))
+                raise RuntimeError
+            elif task.result != 0:
                 oldid = task.id
                 oldhost = task.hostname
                 tgtname = "None"
@@ -2,17 +2,22 @@
 
 ForceBalance objective function."""
 
-import sys
+import os, sys, time
 import inspect
+import hashlib
+import pickle
+import multiprocessing
+from cStringIO import StringIO
 #from implemented import Implemented_Targets
 import numpy as np
 from collections import defaultdict, OrderedDict
 import forcebalance
 from forcebalance.finite_difference import in_fd
-from forcebalance.nifty import printcool_dictionary, createWorkQueue, getWorkQueue, wq_wait
+from forcebalance.nifty import printcool_dictionary, createWorkQueue, createLocalQueue, getWorkQueue, getWQIds, wq_wait, wq_wait1, CACHED_INPUTS_STATS
+from forcebalance.engine import Engine
 import datetime
 import traceback
-from forcebalance.output import getLogger
+from forcebalance.output import getLogger, RawStreamHandler
 logger = getLogger(__name__)
 
 try:
@@ -98,6 +103,71 @@ Implemented_Targets = {
 ## This is the canonical lettering that corresponds to : objective function, gradient, Hessian.
 Letters = ['X','G','H']
 
+## The targets being evaluated by the worker processes of Objective.Target_Terms.
+## This is set before the worker processes are forked, so they inherit it.
+async_job = {}
+
+def target_state(Tgt):
+    """ Return digests of the picklable attributes of a target, which
+    are used to find the attributes that were changed by evaluating the
+    target in a worker process.  The force field and engines are shared
+    with other objects, so they are left out, as are the attributes in
+    Tgt.async_nosync.  Memory-mapped arrays are left out because their
+    contents are in files that all processes share.  Other arrays are
+    hashed directly instead of being pickled first. """
+    state = {}
+    for key, val in Tgt.__dict__.items():
+        if key == 'FF' or key in Tgt.async_nosync or isinstance(val, (Engine, np.memmap)): continue
+        try:
+            if isinstance(val, np.ndarray) and val.dtype != object:
+                digest = hashlib.md5(np.ascontiguousarray(val))
+                digest.update(str((val.shape, val.dtype)))
+                state[key] = digest.digest()
+            else:
+                state[key] = hashlib.md5(pickle.dumps(val, 2)).digest()
+        except Exception:
+            pass
+    return state
+
+def evaluate_target(Tgt, mvals, Order, verbose, customdir):
+    """ Compute the contribution of a target and print its qualitative indicators.
+
+    @return Ans Dictionary containing the objective function, gradient and Hessian of the target
+    @return walltime Wall time of the evaluation in seconds
+    """
+    t0 = time.time()
+    # List of functions that I can call.
+    Funcs   = [Tgt.get_X, Tgt.get_G, Tgt.get_H]
+    # Call the appropriate function
+    Ans = Funcs[Order](mvals, customdir=customdir)
+    # Print out the qualitative indicators
+    if verbose:
+        Tgt.meta_indicate(customdir=customdir)
+    return Ans, time.time() - t0
+
+def target_worker(args):
+    """ Evaluate one target in a worker process.  Returns the
+    contribution of the target along with the target attributes that
+    changed and the printout, so they can be passed on to the target
+    in the main process. """
+    i, mvals, Order, verbose, customdir = args
+    Tgt = async_job['targets'][i]
+    # Capture the printout instead of mixing it with other processes.
+    fblogger = getLogger('forcebalance')
+    handlers = fblogger.handlers[:]
+    stream = StringIO()
+    hdlr = RawStreamHandler(stream)
+    fblogger.addHandler(hdlr)
+    for h in handlers: fblogger.removeHandler(h)
+    try:
+        state = target_state(Tgt)
+        Ans, walltime = evaluate_target(Tgt, mvals, Order, verbose, customdir)
+        changed = dict([(key, Tgt.__dict__[key]) for key, digest in target_state(Tgt).items() if state.get(key) != digest])
+    finally:
+        for h in handlers: fblogger.addHandler(h)
+        fblogger.removeHandler(hdlr)
+    return i, Ans, changed, stream.getvalue(), walltime
+
 class Objective(forcebalance.BaseClass):
     """ Objective function.
     
@@ -125,8 +195,20 @@ class Objective(forcebalance.BaseClass):
         self.set_option(options, 'normalize_weights')
         ## Work Queue Port (The specific target itself may or may not actually use this.)
         self.set_option(options, 'wq_port')
+        ## Number of local processes for running the tasks when Work Queue is not used.
+        self.set_option(options, 'local_workers')
         ## Asynchronous objective function evaluation (i.e. execute Work Queue and local objective concurrently.)
         self.set_option(options, 'asynchronous')
+        ## Number of worker processes for evaluating local targets in asynchronous mode.
+        self.set_option(options, 'async_workers')
+
+        ## The force field is only kept in memory if every target reads it from FF.render().
+        if forcefield.ff_inmemory:
+            unsupported = [opts['name'] for opts in tgt_opts if opts['type'] not in Implemented_Targets or opts["remote"] or
+                           not getattr(Implemented_Targets[opts['type']], 'supports_ff_inmemory', False)]
+            if len(unsupported) > 0:
+                logger.error("ff_inmemory is only supported by OpenMM targets that run in the same process; not supported by: %s\n" % ', '.join(unsupported))
+                raise RuntimeError
 
         ## The list of fitting targets
         self.Targets = []
@@ -138,7 +220,7 @@ class Objective(forcebalance.BaseClass):
             # Target class from the Implemented_Targets dictionary
             # using opts['type'] as the key.  The object is created by
             # passing (options, opts, forcefield) to the constructor.
-            if opts["remote"] and self.wq_port != 0: Tgt = forcebalance.target.RemoteTarget(options, opts, forcefield)
+            if opts["remote"] and (self.wq_port != 0 or self.local_workers > 0): Tgt = forcebalance.target.RemoteTarget(options, opts, forcefield)
             else: Tgt = Implemented_Targets[opts['type']](options,opts,forcefield)
             self.Targets.append(Tgt)
             printcool_dictionary(Tgt.PrintOptionDict,"Setup for target %s :" % Tgt.name)
@@ -163,6 +245,9 @@ class Objective(forcebalance.BaseClass):
         if self.wq_port != 0:
             createWorkQueue(self.wq_port)
             logger.info('Work Queue is listening on %d\n' % self.wq_port)
+        elif self.local_workers > 0:
+            createLocalQueue(self.local_workers)
+            logger.info('Running Work Queue tasks locally with %d processes\n' % self.local_workers)
 
         printcool_dictionary(self.PrintOptionDict, "Setup for objective function :")
 
@@ -170,36 +255,21 @@ class Objective(forcebalance.BaseClass):
     def Target_Terms(self, mvals, Order=0, verbose=False, customdir=None):
         ## This is the objective function; it's a dictionary containing the value, first and second derivatives
         Objective = {'X':0.0, 'G':np.zeros(self.FF.np), 'H':np.zeros((self.FF.np,self.FF.np))}
+        # Work Queue data transfers before this evaluation.
+        wq = getWorkQueue()
+        if wq is not None:
+            Transfers = (wq.stats.total_bytes_sent, wq.stats.total_bytes_received, CACHED_INPUTS_STATS.copy())
         # Loop through the targets, stage the directories and submit the Work Queue processes.
         for Tgt in self.Targets:
             Tgt.stage(mvals, AGrad = Order >= 1, AHess = Order >= 2, customdir=customdir)
         if self.asynchronous:
-            # Asynchronous evaluation of objective function and Work Queue tasks.
-            # Create a list of the targets, and remove them from the list as they are finished.
-            Need2Evaluate = self.Targets[:]
-            # This ensures that the OrderedDict doesn't get out of order.
-            for Tgt in self.Targets:
-                self.ObjDict[Tgt.name] = None
-            # Loop through the targets and compute the objective function for ones that are finished.
-            while len(Need2Evaluate) > 0:
-                for Tgt in Need2Evaluate:
-                    if Tgt.wq_complete():
-                        # List of functions that I can call.
-                        Funcs   = [Tgt.get_X, Tgt.get_G, Tgt.get_H]
-                        # Call the appropriate function
-                        Ans = Funcs[Order](mvals, customdir=customdir)
-                        # Print out the qualitative indicators
-                        if verbose:
-                            Tgt.meta_indicate(customdir=customdir)
-                        # Note that no matter which order of function we call, we still increment the objective / gradient / Hessian the same way.
-                        if not in_fd():
-                            self.ObjDict[Tgt.name] = {'w' : Tgt.weight/self.WTot , 'x' : Ans['X']}
-                        for i in range(3):
-                            Objective[Letters[i]] += Ans[Letters[i]]*Tgt.weight/self.WTot
-                        Need2Evaluate.remove(Tgt)
-                        break
-                    else:
-                        pass
+            Answers = self.Target_Terms_Async(mvals, Order, verbose, customdir)
+            for Tgt, Ans in zip(self.Targets, Answers):
+                # Note that no matter which order of function we call, we still increment the objective / gradient / Hessian the same way.
+                if not in_fd():
+                    self.ObjDict[Tgt.name] = {'w' : Tgt.weight/self.WTot , 'x' : Ans['X']}
+                for i in range(3):
+                    Objective[Letters[i]] += Ans[Letters[i]]*Tgt.weight/self.WTot
         else:
             wq = getWorkQueue()
             if wq is not None:
@@ -222,12 +292,100 @@ class Objective(forcebalance.BaseClass):
         # The target has evaluated at least once.
         for Tgt in self.Targets:
             Tgt.evaluated = True
+        if wq is not None and verbose:
+            logger.info("Work Queue data transfers: %.3f MB sent, %.3f MB received; %i cached input files (%.3f MB) are only sent to workers without them\n" %
+                        ((wq.stats.total_bytes_sent - Transfers[0]) / 1e6, (wq.stats.total_bytes_received - Transfers[1]) / 1e6,
+                         CACHED_INPUTS_STATS['files'] - Transfers[2]['files'], (CACHED_INPUTS_STATS['bytes'] - Transfers[2]['bytes']) / 1e6))
         # Safeguard to make sure we don't have exact zeros on Hessian diagonal
         for i in range(self.FF.np):
             if Objective['H'][i,i] == 0.0:
                 Objective['H'][i,i] = 1.0
         return Objective
 
+    def Target_Terms_Async(self, mvals, Order=0, verbose=False, customdir=None):
+
+        """
+        Evaluate the targets as soon as they are ready, concurrently
+        with the Work Queue tasks of the other targets.
+
+        A target is ready when its Work Queue tasks have finished.
+        Targets without Work Queue tasks are ready right away; if
+        async_workers > 1 these are evaluated in a pool of worker
+        processes, so several of them run at the same time while the
+        main process waits on Work Queue.  The target attributes that
+        are changed in a worker process are copied back to the target.
+        The worker processes are created by forking, so the engines
+        must be safe to use after a fork (as in f12d3p_pool).
+
+        Targets with Work Queue tasks are evaluated in the main
+        process, because they read the output files and keep
+        information between evaluations.
+
+        @param[in] mvals The mathematical parameter values
+        @param[in] Order The requested order of differentiation
+        @param[in] verbose Print the qualitative indicators of each target
+        @param[in] customdir Custom directory for the target calculations
+        @return Answers List of the target contributions, in the order of self.Targets
+        """
+        wq = getWorkQueue()
+        WQIds = getWQIds()
+        def remote(Tgt):
+            if wq is None:
+                return False
+            elif wq.empty():
+                # Clear the IDs of tasks that are no longer in the queue, as in Target.wq_complete.
+                WQIds[Tgt.name] = []
+                return False
+            return len(WQIds[Tgt.name]) > 0
+        t0 = time.time()
+        Answers = [None for Tgt in self.Targets]
+        Times = [None for Tgt in self.Targets]
+        Waiting = [i for i, Tgt in enumerate(self.Targets) if remote(Tgt)]
+        Local = [i for i, Tgt in enumerate(self.Targets) if not remote(Tgt)]
+        # This ensures that the OrderedDict doesn't get out of order.
+        for Tgt in self.Targets:
+            self.ObjDict[Tgt.name] = None
+        pool = None
+        Running = []
+        if self.async_workers > 1 and len(Local) > 1:
+            async_job['targets'] = self.Targets
+            pool = multiprocessing.Pool(min(self.async_workers, len(Local)))
+            Running = [pool.apply_async(target_worker, [(i, mvals, Order, verbose, customdir)]) for i in Local]
+        else:
+            Waiting += Local
+        try:
+            while len(Waiting) > 0 or len(Running) > 0:
+                # Evaluate the targets in the main process that are ready.
+                Ready = [i for i in Waiting if not remote(self.Targets[i])]
+                for i in Ready:
+                    Answers[i], walltime = evaluate_target(self.Targets[i], mvals, Order, verbose, customdir)
+                    Times[i] = (walltime, time.time() - t0)
+                    Waiting.remove(i)
+                # Collect the targets that are finished in the worker processes.
+                Done = [r for r in Running if r.ready()]
+                for r in Done:
+                    i, Ans, changed, printout, walltime = r.get()
+                    self.Targets[i].__dict__.update(changed)
+                    logger.info(printout)
+                    Answers[i] = Ans
+                    Times[i] = (walltime, time.time() - t0)
+                    Running.remove(r)
+                if len(Ready) > 0 or len(Done) > 0:
+                    continue
+                # Wait for something to happen.
+                if any([remote(self.Targets[i]) for i in Waiting]):
+                    wq_wait1(wq, wait_time=1, wait_intvl=1)
+                elif len(Running) > 0:
+                    Running[0].wait(1)
+        finally:
+            if pool is not None:
+                pool.terminate()
+            async_job.clear()
+        if verbose:
+            printcool_dictionary(OrderedDict([(Tgt.name, "%10.2f %10.2f" % Times[i]) for i, Tgt in enumerate(self.Targets)]),
+                                 title="Target wall times (s)\n%-25s %10s %10s" % ("Target", "Evaluation", "Finished"), center=[True, False])
+        return Answers
+
     def Indicate(self):
         """ Print objective function contributions. """
         PrintDict = OrderedDict()
@@ -18,6 +18,8 @@ import sys
 from forcebalance.finite_difference import *
 import pickle
 import shutil
+import hashlib
+from cStringIO import StringIO
 from copy import deepcopy
 from forcebalance.engine import Engine
 from forcebalance.molecule import *
@@ -34,6 +36,10 @@ try:
     import simtk.openmm._openmm as _openmm
 except:
     pass
+try:
+    from lxml import etree
+except:
+    pass
 
 def get_mask(grps):
     """ Given a list of booleans [1, 0, 1] return the bitmask that sets
@@ -118,6 +124,86 @@ def get_dipole(simulation,q=None,mass=None,positions=None):
     Note that this quantity is meaningless if the system carries a net charge."""
     return get_multipoles(simulation, q=q, mass=mass, positions=positions, rmcom=False)[:3]
 
+def get_dipoles(system, xyzs, batch=1000):
+    """Return the dipole moments in Debye of a trajectory from the charges in the NonbondedForce.
+
+    The coordinates are an array (or memory-mapped array) of shape
+    (frames, particles, 3) in nanometers, which is processed in batches
+    of frames.  Returns None if the system contains an
+    AmoebaMultipoleForce, whose dipoles can only be computed from the
+    context (use get_dipole for each frame instead)."""
+    enm_debye = 48.03204255928332 # Conversion factor from e*nm to Debye
+    if any([isinstance(f, AmoebaMultipoleForce) for f in system.getForces()]):
+        return None
+    dips = np.zeros((len(xyzs), 3))
+    for f in system.getForces():
+        if isinstance(f, NonbondedForce):
+            q = np.array([f.getParticleParameters(j)[0]._value for j in range(f.getNumParticles())])
+            for i in range(0, len(xyzs), batch):
+                dips[i:i+batch] += enm_debye * np.dot(np.asarray(xyzs[i:i+batch], dtype=np.float64).transpose(0, 2, 1), q)
+    return dips
+
+class StreamedFrames(object):
+    """
+    Frames of a trajectory stored in memory-mapped arrays on disk,
+    with the same list-like interface as OpenMM.xyz_omms (each frame
+    is a list of positions and box vectors with units).
+
+    The arrays have room for a fixed number of frames and are
+    filled in order by append.  The positions are stored in single
+    precision and the box vectors in double precision, both in
+    nanometers.
+    """
+    def __init__(self, fnm, nframes, nparticles, pbc):
+        """
+        @param[in] fnm Prefix of the file names; the positions are written to fnm.xyz.npy and the box vectors to fnm.box.npy
+        @param[in] nframes Number of frames to allocate
+        @param[in] nparticles Number of particles
+        @param[in] pbc Whether to store box vectors
+        """
+        self.xyzs_ = np.lib.format.open_memmap('%s.xyz.npy' % fnm, mode='w+', dtype=np.float32, shape=(nframes, nparticles, 3))
+        self.boxes_ = np.lib.format.open_memmap('%s.box.npy' % fnm, mode='w+', dtype=np.float64, shape=(nframes, 3, 3)) if pbc else None
+        self.nframes = 0
+
+    @property
+    def xyzs(self):
+        """ The stored positions as an array of shape (frames, particles, 3) in nanometers. """
+        return self.xyzs_[:self.nframes]
+
+    def box_vectors(self):
+        """ List of the box vectors (with units) of the stored frames, or Nones for a nonperiodic system. """
+        if self.boxes_ is None:
+            return [None for i in range(self.nframes)]
+        return [[Vec3(*v) for v in box]*nanometer for box in self.boxes_[:self.nframes]]
+
+    def __len__(self):
+        return self.nframes
+
+    def __getitem__(self, i):
+        i = range(self.nframes)[i]
+        return [self.xyzs_[i]*nanometer, [Vec3(*v) for v in self.boxes_[i]]*nanometer if self.boxes_ is not None else None]
+
+    def __setitem__(self, i, frame):
+        i = range(self.nframes)[i]
+        pos, box = frame
+        self.xyzs_[i] = np.array(pos.value_in_unit(nanometer))
+        if self.boxes_ is not None:
+            self.boxes_[i] = np.array(box.value_in_unit(nanometer))
+
+    def __iter__(self):
+        for i in range(self.nframes):
+            yield self[i]
+
+    def append(self, frame):
+        self.nframes += 1
+        self[self.nframes-1] = frame
+
+    def flush(self):
+        """ Write the stored frames to disk. """
+        self.xyzs_.flush()
+        if self.boxes_ is not None:
+            self.boxes_.flush()
+
 def PrepareVirtualSites(system):
     """ Prepare a list of function wrappers and vsite parameters from the system. """
     isvsites = []
@@ -330,6 +416,88 @@ def UpdateSimulationParameters(src_system, dest_simulation):
                 dest_simulation.context.setParameter(pName, pValue)
 
 
+## Force parameters that can be set directly when the force field changes.
+## Force name : (number of terms, parameter getter, parameter setter, positions of parameters in the argument list)
+SlotForces = {'HarmonicBondForce':('getNumBonds', 'getBondParameters', 'setBondParameters', [2, 3]),
+              'HarmonicAngleForce':('getNumAngles', 'getAngleParameters', 'setAngleParameters', [3, 4]),
+              'PeriodicTorsionForce':('getNumTorsions', 'getTorsionParameters', 'setTorsionParameters', [5, 6]),
+              'NonbondedForce':('getNumParticles', 'getParticleParameters', 'setParticleParameters', [0, 1, 2]),
+              'GBSAOBCForce':('getNumParticles', 'getParticleParameters', 'setParticleParameters', [0, 1, 2])}
+
+def SlotValue(x):
+    """ Return a force parameter as a number in OpenMM's default units. """
+    return x._value if is_quantity(x) else x
+
+def ApplySlotMap(system, slotmap, values, context=None):
+    """
+    Set force parameters in a system using the map built by OpenMM.make_slotmap.
+
+    @param[in] system The OpenMM System to be modified.
+    @param[in] slotmap The map from force field parameter fields to force parameters.
+    @param[in] values The values of the force field parameter fields.
+    @param[in] context If provided, the parameters are also updated in this Context.
+    """
+    for i, fmap in slotmap['forces'].items():
+        force = system.getForce(i)
+        count, getter, setter, positions = SlotForces[force.__class__.__name__]
+        get = getattr(force, getter)
+        put = getattr(force, setter)
+        for t, slots in fmap['terms'].items():
+            prm = list(get(t))
+            for pos, k in slots:
+                prm[pos] = values[k]
+            put(t, *prm)
+        if len(fmap['exceptions']) > 0:
+            # Rebuild the scaled 1-4 interactions from the new particle parameters,
+            # in the same way as NonbondedForce.createExceptionsFromBonds.
+            coulomb14scale, lj14scale = fmap['scales']
+            for e, p1, p2 in fmap['exceptions']:
+                q1, s1, e1 = [SlotValue(x) for x in force.getParticleParameters(p1)]
+                q2, s2, e2 = [SlotValue(x) for x in force.getParticleParameters(p2)]
+                force.setExceptionParameters(e, p1, p2, coulomb14scale*q1*q2, 0.5*(s1+s2), lj14scale*np.sqrt(e1*e2))
+        if context is not None and hasattr(force, 'updateParametersInContext'):
+            force.updateParametersInContext(context)
+
+## Force parameters that the energy depends on linearly, as the position of the
+## force constant in the parameter list and the number of particles in each term.
+LinearSlots = {'HarmonicBondForce':(3, 2),
+               'HarmonicAngleForce':(4, 3),
+               'PeriodicTorsionForce':(6, 4)}
+
+def LinearSlotDerivatives(name, xyz, atoms, prms):
+    """
+    Compute the derivatives of the energies of force terms with
+    respect to their force constants (i.e. the energies divided by the
+    force constants) for one frame.
+
+    @param[in] name The class name of the force, one of the keys in LinearSlots.
+    @param[in] xyz The coordinates in nanometers as a (nparticles, 3) array.
+    @param[in] atoms The particle indices of each term as a (nterms, nparticles per term) array.
+    @param[in] prms The parameters between the particle indices and the force constant
+    (length, angle, or periodicity and phase) as a (nterms, nprms) array.
+    @return dE The derivative of the energy of each term with respect to its force constant.
+    """
+    if name == 'HarmonicBondForce':
+        r = np.sqrt(np.sum((xyz[atoms[:,1]] - xyz[atoms[:,0]])**2, axis=1))
+        return 0.5*(r - prms[:,0])**2
+    elif name == 'HarmonicAngleForce':
+        u = xyz[atoms[:,0]] - xyz[atoms[:,1]]
+        v = xyz[atoms[:,2]] - xyz[atoms[:,1]]
+        cost = np.sum(u*v, axis=1)/np.sqrt(np.sum(u*u, axis=1)*np.sum(v*v, axis=1))
+        theta = np.arccos(np.clip(cost, -1.0, 1.0))
+        return 0.5*(theta - prms[:,0])**2
+    elif name == 'PeriodicTorsionForce':
+        b1 = xyz[atoms[:,1]] - xyz[atoms[:,0]]
+        b2 = xyz[atoms[:,2]] - xyz[atoms[:,1]]
+        b3 = xyz[atoms[:,3]] - xyz[atoms[:,2]]
+        n1 = np.cross(b1, b2)
+        n2 = np.cross(b2, b3)
+        phi = np.arctan2(np.sqrt(np.sum(b2*b2, axis=1))*np.sum(b1*n2, axis=1), np.sum(n1*n2, axis=1))
+        return 1.0 + np.cos(prms[:,0]*phi - prms[:,1])
+    else:
+        logger.error('%s does not have a linear force constant\n' % name)
+        raise RuntimeError
+
 def SetAmoebaVirtualExclusions(system):
     if any([f.__class__.__name__ == "AmoebaMultipoleForce" for f in system.getForces()]):
         # logger.info("Cajoling AMOEBA covalent maps so they work with virtual sites.\n")
@@ -741,6 +909,8 @@ class OpenMM(Engine):
         self.AtomLists['ParticleType'] = ['A' if m >= 1.0 else 'D' for m in self.AtomLists['Mass']]
         self.AtomLists['ResidueNumber'] = [a.residue.index for a in Atoms]
         self.AtomMask = [a == 'A' for a in self.AtomLists['ParticleType']]
+        ## Indices of real atoms, used to extract their forces.
+        self.AtomIdxs = np.array([i for i, a in enumerate(self.AtomMask) if a], dtype=int)
 
     def create_simulation(self, timestep=1.0, faststep=0.25, temperature=None, pressure=None, anisotropic=False, mts=False, collision=1.0, nbarostat=25, rpmd_beads=0, **kwargs):
 
@@ -818,46 +988,156 @@ class OpenMM(Engine):
         #                           for i in self.simulation.context.getPlatform().getPropertyNames()}, \
         #                          title="Platform %s has properties:" % self.simulation.context.getPlatform().getName())
 
-    def update_simulation(self, **kwargs):
+    def build_system(self, ffxml):
 
         """
-        Create the simulation object, or update the force field
-        parameters in the existing simulation object.  This should be
-        run when we write a new force field XML file.
+        Create the ForceField, Modeller and System objects from a
+        list of force field XML files (or file-like objects).
         """
-        if len(kwargs) > 0:
-            self.simkwargs = kwargs
-        self.forcefield = ForceField(*self.ffxml)
+        ff = ForceField(*ffxml)
         # OpenMM classes for force generators
         ismgens = [forcefield.AmoebaGeneralizedKirkwoodGenerator, forcefield.AmoebaWcaDispersionGenerator,
                      forcefield.CustomGBGenerator, forcefield.GBSAOBCGenerator]
         if self.ism is not None:
             if self.ism == False:
-                self.forcefield._forces = [f for f in self.forcefield._forces if not any([isinstance(f, f_) for f_ in ismgens])]
+                ff._forces = [f for f in ff._forces if not any([isinstance(f, f_) for f_ in ismgens])]
             elif self.ism == True:
-                if len([f for f in self.forcefield._forces if any([isinstance(f, f_) for f_ in ismgens])]) == 0:
+                if len([f for f in ff._forces if any([isinstance(f, f_) for f_ in ismgens])]) == 0:
                     logger.error("There is no implicit solvent model!\n")
                     raise RuntimeError
-        self.mod = Modeller(self.pdb.topology, self.pdb.positions)
-        self.mod.addExtraParticles(self.forcefield)
+        mod = Modeller(self.pdb.topology, self.pdb.positions)
+        mod.addExtraParticles(ff)
         # Add bonds for virtual sites. (Experimental)
-        if self.vbonds: AddVirtualSiteBonds(self.mod, self.forcefield)
+        if self.vbonds: AddVirtualSiteBonds(mod, ff)
         #printcool_dictionary(self.mmopts, title="Creating/updating simulation in engine %s with system settings:" % (self.name))
-        # for b in list(self.mod.topology.bonds()):
+        # for b in list(mod.topology.bonds()):
         #     print b[0].index, b[1].index
-        self.system = self.forcefield.createSystem(self.mod.topology, **self.mmopts)
+        system = ff.createSystem(mod.topology, **self.mmopts)
+        if self.SetPME:
+            for i in system.getForces():
+                if isinstance(i, NonbondedForce) or isinstance(i, AmoebaMultipoleForce):
+                    i.setNonbondedMethod(i.PME)
+        return ff, mod, system
+
+    def make_slotmap(self):
+
+        """
+        Build the map from parameter fields in the force field XML
+        file to the force parameters in the System, so that new
+        parameters can be set without parsing the force field and
+        creating the System again.
+
+        The map is found by creating a probe System where every
+        parameter field is displaced to a unique value, and it is
+        checked by making sure that applying the map to the current
+        System reproduces the probe System exactly.  If the System
+        contains parameters that can't be set in this way (for
+        example, virtual sites or constraints that depend on the
+        parameters, or unsupported force types), returns None.
+        """
+        if not hasattr(self, 'FF') or getattr(self.FF, 'fftemplate', None) is None: return None
+        xmls = [f for f in self.ffxml if f in self.FF.ffdata and self.FF.ffdata_isxml[f]]
+        ## Parameter fields in the XML files as (file name, line number, attribute).
+        fields = list(OrderedDict.fromkeys([(fnm, ln, fld) for pid, fnm, ln, fld, mult, cmd in self.FF.pfields if fnm in xmls]))
+        if len(fields) == 0: return None
+        # Write the probe force field; each parameter field gets a unique value.
+        trees = OrderedDict([(f, etree.fromstring(self.FF.render(f))) for f in xmls])
+        elements = OrderedDict([(f, list(trees[f].iter())) for f in xmls])
+        probe_vals = OrderedDict()
+        for k, (fnm, ln, fld) in enumerate(fields):
+            val = float(elements[fnm][ln].get(fld))
+            val = val*(1+1e-4*(k+1)) if val != 0.0 else 1e-4*(k+1)
+            elements[fnm][ln].attrib[fld] = "%.12e" % val
+            probe_vals[float(elements[fnm][ln].get(fld))] = k
+        if len(probe_vals) != len(fields): return None
+        try:
+            _, _, probe = self.build_system([StringIO(etree.tostring(trees[f])) if f in trees else f for f in self.ffxml])
+        except:
+            logger.info("Failed to create the probe system, parameters will be updated by creating a new system\n")
+            return None
+        nbgens = [g for g in self.forcefield._forces if isinstance(g, forcefield.NonbondedGenerator)]
+        slotmap = {'fields' : fields, 'forces' : OrderedDict()}
+        if self.system.getNumForces() != probe.getNumForces(): return None
+        for i in range(self.system.getNumForces()):
+            fb = self.system.getForce(i)
+            fp = probe.getForce(i)
+            nm = fb.__class__.__name__
+            if nm not in SlotForces or fp.__class__.__name__ != nm: continue
+            count, getter, setter, positions = SlotForces[nm]
+            fmap = {'terms' : OrderedDict(), 'exceptions' : [], 'scales' : None}
+            for t in range(getattr(fb, count)()):
+                pb = getattr(fb, getter)(t)
+                pp = getattr(fp, getter)(t)
+                for pos in positions:
+                    if SlotValue(pb[pos]) != SlotValue(pp[pos]):
+                        if SlotValue(pp[pos]) not in probe_vals: return None
+                        fmap['terms'].setdefault(t, []).append((pos, probe_vals[SlotValue(pp[pos])]))
+            if nm == 'NonbondedForce':
+                if len(nbgens) == 1:
+                    fmap['scales'] = (nbgens[0].coulomb14scale, nbgens[0].lj14scale)
+                for e in range(fb.getNumExceptions()):
+                    eb = [SlotValue(x) for x in fb.getExceptionParameters(e)]
+                    ep = [SlotValue(x) for x in fp.getExceptionParameters(e)]
+                    if eb == ep: continue
+                    if fmap['scales'] is None: return None
+                    fmap['exceptions'].append((e, ep[0], ep[1]))
+            if len(fmap['terms']) > 0 or len(fmap['exceptions']) > 0:
+                slotmap['forces'][i] = fmap
+        # Apply the map to a copy of the current system and compare with the probe.
+        check = XmlSerializer.deserialize(XmlSerializer.serialize(self.system))
+        ApplySlotMap(check, slotmap, probe_vals.keys())
+        if XmlSerializer.serialize(check) != XmlSerializer.serialize(probe):
+            logger.info("Force field parameters will be updated by creating a new system\n")
+            return None
+        return slotmap
+
+    def update_slots(self):
+
+        """
+        Set the force field parameters from the last call to FF.make()
+        in the existing simulation object using the slot map.
+        """
+        elements = dict([(f, self.FF.rendered_elements(f)) for f in set([fnm for fnm, ln, fld in self.slotmap['fields']])])
+        values = [float(elements[fnm][ln].get(fld)) for fnm, ln, fld in self.slotmap['fields']]
+        self.system = self.simulation.system
+        ApplySlotMap(self.system, self.slotmap, values, self.simulation.context)
+        for i in self.system.getForces():
+            if isinstance(i, NonbondedForce):
+                self.nbcharges = np.array([i.getParticleParameters(j)[0]._value for j in range(i.getNumParticles())])
+
+    def update_simulation(self, **kwargs):
+
+        """
+        Create the simulation object, or update the force field
+        parameters in the existing simulation object.  This should be
+        run when we write a new force field XML file.
+
+        If the simulation object exists and the parameters can be
+        mapped directly onto the forces (see make_slotmap), they are
+        set in place without creating a new System.
+        """
+        if len(kwargs) > 0:
+            self.simkwargs = kwargs
+        if hasattr(self, 'simulation') and getattr(self, 'slotmap', None) is not None:
+            self.update_slots()
+            return
+        if hasattr(self,'FF') and getattr(self.FF, 'ff_inmemory', False):
+            # Read the force field created by FF.make() directly from memory.
+            ffxml = [StringIO(self.FF.render(f)) if f in self.FF.ffdata else f for f in self.ffxml]
+        else:
+            ffxml = self.ffxml
+        self.forcefield, self.mod, self.system = self.build_system(ffxml)
         self.vsinfo = PrepareVirtualSites(self.system)
         self.nbcharges = np.zeros(self.system.getNumParticles())
 
         for i in self.system.getForces():
             if isinstance(i, NonbondedForce):
                 self.nbcharges = np.array([i.getParticleParameters(j)[0]._value for j in range(i.getNumParticles())])
-                if self.SetPME:
-                    i.setNonbondedMethod(i.PME)
-            if isinstance(i, AmoebaMultipoleForce):
-                if self.SetPME:
-                    i.setNonbondedMethod(i.PME)
 
+        ## The slot map is built once, from the unmodified system.  It needs the
+        ## force field from FF.make(), so it isn't stored until that exists.
+        if not hasattr(self, 'slotmap') and hasattr(self, 'FF') and getattr(self.FF, 'fftemplate', None) is not None:
+            self.slotmap = self.make_slotmap()
 
         #----
         # If the virtual site parameters have changed,
@@ -892,14 +1172,45 @@ class OpenMM(Engine):
         # else:
         #     simulation.context.computeVirtualSites()
         #----
+        xyzs, boxes = self.xyz_arrays()
         # NOTE: Periodic box vectors must be set FIRST
         if self.pbc:
-            self.simulation.context.setPeriodicBoxVectors(*self.xyz_omms[shot][1])
+            self.simulation.context.setPeriodicBoxVectors(*boxes[shot])
         # self.simulation.context.setPositions(ResetVirtualSites(self.xyz_omms[shot][0], self.system))
         # self.simulation.context.setPositions(ResetVirtualSites_fast(self.xyz_omms[shot][0], self.vsinfo))
-        self.simulation.context.setPositions(self.xyz_omms[shot][0])
+        self.simulation.context.setPositions(xyzs[shot]*nanometer)
         self.simulation.context.computeVirtualSites()
 
+    @property
+    def xyz_omms(self):
+        """ The stored coordinates and box vectors of each frame, with units. """
+        return self.xyz_omms_
+
+    @xyz_omms.setter
+    def xyz_omms(self, value):
+        self.xyz_omms_ = value
+        self.xyz_cache = None
+
+    def xyz_arrays(self):
+
+        """
+        Return the stored coordinates in self.xyz_omms as a contiguous
+        (nframes, nparticles, 3) array in nanometers, along with the
+        list of box vectors.  The array is cached; it is invalidated
+        when self.xyz_omms is replaced, and by the methods that change
+        the stored frames in place (molecular_dynamics and scale_box).
+        Frames streamed to disk by molecular_dynamics are returned as
+        the memory-mapped array, so they are read from disk as they
+        are used.
+        """
+        if isinstance(self.xyz_omms, StreamedFrames):
+            return self.xyz_omms.xyzs, self.xyz_omms.box_vectors()
+        if getattr(self, 'xyz_cache', None) is None:
+            xyzs = np.array([np.array(pos.value_in_unit(nanometer), dtype=np.float64) for pos, box in self.xyz_omms], dtype=np.float64)
+            boxes = [box for pos, box in self.xyz_omms]
+            self.xyz_cache = (xyzs, boxes)
+        return self.xyz_cache
+
     def get_charges(self):
         logger.error('OpenMM engine does not have get_charges (should be trivial to implement however.)')
         raise NotImplementedError
@@ -926,9 +1237,8 @@ class OpenMM(Engine):
         Result = {}
         Result["Energy"] = State.getPotentialEnergy() / kilojoules_per_mole
         if force:
-            Force = list(np.array(State.getForces() / kilojoules_per_mole * nanometer).flatten())
             # Extract forces belonging to real atoms only
-            Result["Force"] = np.array(list(itertools.chain(*[Force[3*i:3*i+3] for i in range(len(Force)/3) if self.AtomMask[i]])))
+            Result["Force"] = State.getForces(asNumpy=True).value_in_unit(kilojoules_per_mole/nanometer)[self.AtomIdxs].flatten()
         if dipole: Result["Dipole"] = get_dipole(self.simulation, q=self.nbcharges, mass=self.AtomLists['Mass'], positions=State.getPositions())
         return Result
 
@@ -950,22 +1260,30 @@ class OpenMM(Engine):
         self.update_simulation()
 
         # If trajectory flag set to False, perform a single-point calculation.
-        if not traj: return evaluate_one_(force, dipole)
-        Energies = []
-        Forces = []
-        Dipoles = []
-        for I in range(len(self.xyz_omms)):
-            self.set_positions(I)
-            R1 = self.evaluate_one_(force, dipole)
-            Energies.append(R1["Energy"])
-            if force: Forces.append(R1["Force"])
-            if dipole: Dipoles.append(R1["Dipole"])
+        if not traj: return self.evaluate_one_(force, dipole)
+        xyzs, boxes = self.xyz_arrays()
+        nframes = len(xyzs)
+        # Results are written into preallocated arrays.
+        Energies = np.zeros(nframes)
+        if force: Forces = np.zeros((nframes, 3*len(self.AtomIdxs)))
+        if dipole: Dipoles = np.zeros((nframes, 3))
+        context = self.simulation.context
+        for I in range(nframes):
+            # NOTE: Periodic box vectors must be set FIRST
+            if self.pbc:
+                context.setPeriodicBoxVectors(*boxes[I])
+            context.setPositions(xyzs[I]*nanometer)
+            context.computeVirtualSites()
+            State = context.getState(getPositions=dipole, getEnergy=True, getForces=force)
+            Energies[I] = State.getPotentialEnergy() / kilojoules_per_mole
+            if force: Forces[I] = State.getForces(asNumpy=True).value_in_unit(kilojoules_per_mole/nanometer)[self.AtomIdxs].flatten()
+            if dipole: Dipoles[I] = get_dipole(self.simulation, q=self.nbcharges, mass=self.AtomLists['Mass'], positions=State.getPositions())
         # Compile it all into the dictionary object
         Result = OrderedDict()
 
-        Result["Energy"] = np.array(Energies)
-        if force: Result["Force"] = np.array(Forces)
-        if dipole: Result["Dipole"] = np.array(Dipoles)
+        Result["Energy"] = Energies
+        if force: Result["Force"] = Forces
+        if dipole: Result["Dipole"] = Dipoles
         return Result
 
     def energy_one(self, shot):
@@ -992,6 +1310,135 @@ class OpenMM(Engine):
         Result = self.evaluate_(dipole=True, traj=True)
         return np.hstack((Result["Energy"].reshape(-1,1), Result["Dipole"]))
 
+    def energy_sweep(self, mvals_list, dipole=False):
+
+        """
+        Compute the energies (and optionally dipoles) of the stored
+        trajectory for a list of parameter displacements.
+
+        The parameters for every displacement are read from the slot
+        map up front.  Then each displacement is applied once, by
+        updating only the forces whose parameters differ from the
+        previous displacement in the existing context, and all of the
+        frames are evaluated with it.  If there is no slot map, this
+        falls back to the generic implementation in the Engine base
+        class.
+
+        @param[in] mvals_list List of mathematical parameter values
+        @param[in] dipole Switch for computing the dipole moments
+        @return ED Array of energies with shape (len(mvals_list), nframes),
+        or (len(mvals_list), nframes, 4) containing the energy and dipole moment if dipole is True.
+        """
+        self.update_simulation()
+        if getattr(self, 'slotmap', None) is None:
+            return super(OpenMM, self).energy_sweep(mvals_list, dipole)
+        self.system = self.simulation.system
+        fields = self.slotmap['fields']
+        values = []
+        for mvals in mvals_list:
+            self.FF.make(mvals)
+            elements = dict([(f, self.FF.rendered_elements(f)) for f in set([fnm for fnm, ln, fld in fields])])
+            values.append([float(elements[fnm][ln].get(fld)) for fnm, ln, fld in fields])
+        values = np.array(values)
+        # The slot map restricted to each force, and the parameter fields that each force depends on.
+        submaps = OrderedDict()
+        for i, fmap in self.slotmap['forces'].items():
+            ks = set([k for slots in fmap['terms'].values() for pos, k in slots])
+            if len(fmap['exceptions']) > 0:
+                # The 1-4 exceptions depend on all of the particle parameters.
+                ks = set(range(len(fields)))
+            submaps[i] = ({'fields' : fields, 'forces' : OrderedDict([(i, fmap)])}, sorted(ks))
+        def changed(v0, v1):
+            return [m for i, (m, ks) in submaps.items() if (v0 is None or np.any(v0[ks] != v1[ks]))]
+        # The charges for each displacement are needed for the dipoles.
+        charges = []
+        if dipole:
+            for v in values:
+                for m in changed(None, v):
+                    ApplySlotMap(self.system, m, v)
+                q = self.nbcharges
+                for f in self.system.getForces():
+                    if isinstance(f, NonbondedForce):
+                        q = np.array([SlotValue(f.getParticleParameters(j)[0]) for j in range(f.getNumParticles())])
+                charges.append(q)
+        xyzs, boxes = self.xyz_arrays()
+        nframes = len(xyzs)
+        ED = np.zeros((len(values), nframes, 4)) if dipole else np.zeros((len(values), nframes))
+        context = self.simulation.context
+        current = None
+        for k, v in enumerate(values):
+            for m in changed(current, v):
+                ApplySlotMap(self.system, m, v, context)
+            current = v
+            for I in range(nframes):
+                # NOTE: Periodic box vectors must be set FIRST
+                if self.pbc:
+                    context.setPeriodicBoxVectors(*boxes[I])
+                context.setPositions(xyzs[I]*nanometer)
+                context.computeVirtualSites()
+                State = context.getState(getPositions=dipole, getEnergy=True)
+                if dipole:
+                    ED[k, I, 0] = State.getPotentialEnergy() / kilojoules_per_mole
+                    ED[k, I, 1:] = get_dipole(self.simulation, q=charges[k], mass=self.AtomLists['Mass'], positions=State.getPositions())
+                else:
+                    ED[k, I] = State.getPotentialEnergy() / kilojoules_per_mole
+        # The simulation is left with the parameters of the last displacement, consistent with the force field.
+        for f in self.system.getForces():
+            if isinstance(f, NonbondedForce):
+                self.nbcharges = np.array([SlotValue(f.getParticleParameters(j)[0]) for j in range(f.getNumParticles())])
+        return ED
+
+    def linear_energy_derivatives(self):
+
+        """
+        Compute the derivatives of the energies of the stored
+        trajectory with respect to the force field parameter fields
+        that the energy depends on linearly.
+
+        Using the slot map, the parameter fields that only appear as
+        the force constants of harmonic bonds, harmonic angles and
+        periodic torsions are found, and the derivative of the energy
+        is the sum of the energies of those terms divided by their
+        force constants, which is computed directly from the
+        coordinates.  All other fields are left out (they need to be
+        differentiated by finite difference), as is everything if
+        there is no slot map.
+
+        @return dE OrderedDict mapping parameter field locations (file name, line number, field)
+        to the derivative of the energy of each frame
+        """
+        self.update_simulation()
+        if getattr(self, 'slotmap', None) is None:
+            return OrderedDict()
+        self.system = self.simulation.system
+        fields = self.slotmap['fields']
+        nonlinear = set()
+        groups = []
+        for i, fmap in self.slotmap['forces'].items():
+            force = self.system.getForce(i)
+            nm = force.__class__.__name__
+            count, getter, setter, positions = SlotForces[nm]
+            terms = []
+            for t, slots in fmap['terms'].items():
+                for pos, k in slots:
+                    if nm in LinearSlots and pos == LinearSlots[nm][0]:
+                        terms.append((t, k))
+                    else:
+                        nonlinear.add(k)
+            if len(terms) == 0: continue
+            pos, na = LinearSlots[nm]
+            prms = [[SlotValue(x) for x in getattr(force, getter)(t)] for t, k in terms]
+            atoms = np.array([p[:na] for p in prms], dtype=int)
+            other = np.array([p[na:pos] for p in prms], dtype=float)
+            groups.append((nm, atoms, other, np.array([k for t, k in terms], dtype=int)))
+        xyzs, boxes = self.xyz_arrays()
+        dE = np.zeros((len(xyzs), len(fields)))
+        for I in range(len(xyzs)):
+            xyz = np.asarray(xyzs[I], dtype=np.float64)
+            for nm, atoms, other, kidx in groups:
+                dE[I] += np.bincount(kidx, weights=LinearSlotDerivatives(nm, xyz, atoms, other), minlength=len(fields))
+        return OrderedDict([(fields[k], dE[:,k]) for k in range(len(fields)) if k not in nonlinear])
+
     def normal_modes(self, shot=0, optimize=True):
         logger.error("OpenMM cannot do normal mode analysis\n")
         raise NotImplementedError
@@ -1103,7 +1550,7 @@ class OpenMM(Engine):
 
         return (D - A - B) / 4.184
 
-    def molecular_dynamics(self, nsteps, timestep, temperature=None, pressure=None, nequil=0, nsave=1000, minimize=True, anisotropic=False, save_traj=False, verbose=False, **kwargs):
+    def molecular_dynamics(self, nsteps, timestep, temperature=None, pressure=None, nequil=0, nsave=1000, minimize=True, anisotropic=False, save_traj=False, verbose=False, checkpoint=None, checkpoint_interval=10, stream=None, **kwargs):
 
         """
         Method for running a molecular dynamics simulation.
@@ -1116,6 +1563,11 @@ class OpenMM(Engine):
         nequil      = (int)   Number of additional time steps at the beginning for equilibration
         nsave       = (int)   Step interval for saving and printing data
         minimize    = (bool)  Perform an energy minimization prior to dynamics
+        checkpoint  = (str)   If provided, write a checkpoint of the simulation to checkpoint.chk and the
+                              data of each frame to checkpoint.frames, and resume from them if they exist
+        checkpoint_interval = (int) Number of nsave intervals between checkpoints
+        stream      = (str)   If provided, write the coordinates of each frame to memory-mapped files
+                              stream.xyz.npy and stream.box.npy instead of keeping them in memory
 
         Returns simulation data:
         Rhos        = (array)     Density in kilogram m^-3
@@ -1144,6 +1596,19 @@ class OpenMM(Engine):
         self.update_simulation(timestep=timestep, temperature=temperature, pressure=pressure, anisotropic=anisotropic, **kwargs)
         self.set_positions()
 
+        # Resume from the checkpoint if there is one for this simulation.
+        # The checkpoint must be for the same settings and the same System (i.e. force field parameters).
+        if checkpoint is not None:
+            md_key = (nsteps, timestep, temperature, pressure, nequil, nsave,
+                      hashlib.md5(XmlSerializer.serialize(self.system)).hexdigest())
+        resume = self.read_md_checkpoint(checkpoint, md_key) if checkpoint is not None else None
+        if resume is not None:
+            stage, first, frames = resume
+            logger.info("Resuming from checkpoint %s.chk (%s, iteration %i, %i frames)\n" % (checkpoint, stage, first, len(frames)))
+            minimize = False
+        else:
+            stage, first, frames = 'equil', -1, []
+
         # Minimize the energy.
         if minimize:
             if verbose: logger.info("Minimizing the energy... (starting energy % .3f kJ/mol)" %
@@ -1171,7 +1636,12 @@ class OpenMM(Engine):
         # Initialize statistics.
         edecomp = OrderedDict()
         # Stored coordinates, box vectors
-        self.xyz_omms = []
+        if stream is not None:
+            self.xyz_omms = StreamedFrames(stream, isteps+1, self.system.getNumParticles(), self.pbc)
+        else:
+            self.xyz_omms = []
+        # Dipole moments are computed from the stored coordinates after the simulation if possible.
+        batch_dips = not any([isinstance(f, AmoebaMultipoleForce) for f in self.system.getForces()])
         # Densities, potential and kinetic energies, box volumes, dipole moments
         Rhos = []
         Potentials = []
@@ -1183,17 +1653,33 @@ class OpenMM(Engine):
         # Now run the simulation #
         #========================#
         # Initialize velocities.
-        self.simulation.context.setVelocitiesToTemperature(temperature*kelvin)
+        if resume is None:
+            self.simulation.context.setVelocitiesToTemperature(temperature*kelvin)
+        # Restore the stored frames.
+        for frame in frames:
+            self.xyz_omms.append([frame['positions']*nanometer, frame['box']*nanometer if frame['box'] is not None else None])
+            for comp, val in frame['Ecomps'].items():
+                edecomp.setdefault(comp, []).append(val)
+            Temps.append(frame['Temp'])
+            Rhos.append(frame['Rho'])
+            Potentials.append(frame['Potential'])
+            Kinetics.append(frame['Kinetic'])
+            Volumes.append(frame['Volume'])
+            if not batch_dips: Dips.append(frame['Dip'])
+        if checkpoint is not None:
+            framefile = open('%s.frames' % checkpoint, 'ab')
         # Equilibrate.
-        if iequil > 0:
+        if iequil > 0 and stage == 'equil':
             if verbose: logger.info("Equilibrating...\n")
             if self.pbc:
                 if verbose: logger.info("%6s %9s %9s %13s %10s %13s\n" % ("Iter.", "Time(ps)", "Temp(K)", "Epot(kJ/mol)", "Vol(nm^3)", "Rho(kg/m^3)"))
             else:
                 if verbose: logger.info("%6s %9s %9s %13s\n" % ("Iter.", "Time(ps)", "Temp(K)", "Epot(kJ/mol)"))
-        for iteration in range(-1, iequil):
+        for iteration in range(first if stage == 'equil' else iequil, iequil):
             if iteration >= 0:
                 self.simulation.step(nsave)
+            if checkpoint is not None and iteration >= 0 and (iteration+1) % checkpoint_interval == 0:
+                self.write_md_checkpoint(checkpoint, md_key, 'equil', iteration+1, framefile)
             state = self.simulation.context.getState(getEnergy=True,getPositions=True,getVelocities=False,getForces=False)
             kinetic = state.getKineticEnergy()/self.tdiv
             potential = state.getPotentialEnergy()
@@ -1222,7 +1708,7 @@ class OpenMM(Engine):
             self.simulation.reporters.append(PDBReporter('%s-md.pdb' % self.name, nsteps))
             self.simulation.reporters.append(DCDReporter('%s-md.dcd' % self.name, nsave))
 
-        for iteration in range(-1, isteps):
+        for iteration in range(first if stage == 'prod' else -1, isteps):
             # Propagate dynamics.
             if iteration >= 0: self.simulation.step(nsave)
             # Compute properties.
@@ -1258,12 +1744,25 @@ class OpenMM(Engine):
             Potentials.append(potential / kilojoules_per_mole)
             Kinetics.append(kinetic / kilojoules_per_mole)
             Volumes.append(volume / nanometer**3)
-            Dips.append(get_dipole(self.simulation,positions=self.xyz_omms[-1][0]))
+            if not batch_dips: Dips.append(get_dipole(self.simulation,positions=positions))
+            if checkpoint is not None:
+                # Append this frame to the frame file; it becomes part of the checkpoint when the next checkpoint is written.
+                pickle.dump({'positions' : np.array(positions / nanometer), 'box' : np.array(box_vectors / nanometer) if box_vectors is not None else None,
+                             'Ecomps' : OrderedDict([(comp, val[-1]) for comp, val in edecomp.items()]), 'Temp' : Temps[-1], 'Rho' : Rhos[-1],
+                             'Potential' : Potentials[-1], 'Kinetic' : Kinetics[-1], 'Volume' : Volumes[-1], 'Dip' : None if batch_dips else Dips[-1]}, framefile, 2)
+                if (iteration+1) % checkpoint_interval == 0:
+                    self.write_md_checkpoint(checkpoint, md_key, 'prod', iteration+1, framefile)
+        if checkpoint is not None:
+            framefile.close()
+        if stream is not None:
+            self.xyz_omms.flush()
+        # The frames were appended to self.xyz_omms in place.
+        self.xyz_cache = None
         Rhos = np.array(Rhos)
         Potentials = np.array(Potentials)
         Kinetics = np.array(Kinetics)
         Volumes = np.array(Volumes)
-        Dips = np.array(Dips)
+        Dips = get_dipoles(self.system, self.xyz_arrays()[0]) if batch_dips else np.array(Dips)
         Ecomps = OrderedDict([(key, np.array(val)) for key, val in edecomp.items()])
         Ecomps["Potential Energy"] = Potentials
         Ecomps["Kinetic Energy"] = Kinetics
@@ -1274,6 +1773,66 @@ class OpenMM(Engine):
         prop_return.update({'Rhos': Rhos, 'Potentials': Potentials, 'Kinetics': Kinetics, 'Volumes': Volumes, 'Dips': Dips, 'Ecomps': Ecomps})
         return prop_return
 
+    def write_md_checkpoint(self, checkpoint, md_key, stage, iteration, framefile):
+
+        """
+        Write a checkpoint of the simulation that molecular_dynamics can resume from.
+
+        The frame file is flushed to disk first, and the checkpoint
+        records how many frames it contains, so frames written after
+        the last checkpoint are discarded when resuming.  The
+        checkpoint file is replaced atomically.
+
+        @param[in] checkpoint Prefix of the checkpoint file names
+        @param[in] md_key Simulation settings; the checkpoint is only used by a simulation with the same settings
+        @param[in] stage 'equil' or 'prod'
+        @param[in] iteration The iteration of the stage to resume from
+        @param[in] framefile The open frame file
+        """
+        framefile.flush()
+        os.fsync(framefile.fileno())
+        nframes = (iteration + 1) if stage == 'prod' else 0
+        with open('%s.chk.tmp' % checkpoint, 'wb') as f:
+            pickle.dump({'key' : md_key, 'stage' : stage, 'iteration' : iteration, 'nframes' : nframes,
+                         'context' : self.simulation.context.createCheckpoint()}, f, 2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename('%s.chk.tmp' % checkpoint, '%s.chk' % checkpoint)
+
+    def read_md_checkpoint(self, checkpoint, md_key):
+
+        """
+        Load a checkpoint written by write_md_checkpoint into the
+        simulation, and read the frames that belong to it.  The frame
+        file is truncated to these frames.  If there is no usable
+        checkpoint, any old checkpoint files are removed.
+
+        @param[in] checkpoint Prefix of the checkpoint file names
+        @param[in] md_key Simulation settings, which must match the checkpoint
+        @return None if there is no usable checkpoint; otherwise the stage, the iteration
+        to resume from, and the list of frames
+        """
+        chkfnm = '%s.chk' % checkpoint
+        framefnm = '%s.frames' % checkpoint
+        if os.path.exists(chkfnm):
+            try:
+                with open(chkfnm, 'rb') as f:
+                    chk = pickle.load(f)
+                if chk['key'] != md_key:
+                    raise RuntimeError('Checkpoint is for a different simulation')
+                frames = []
+                with open(framefnm, 'r+b') as f:
+                    for i in range(chk['nframes']):
+                        frames.append(pickle.load(f))
+                    f.truncate(f.tell())
+                self.simulation.context.loadCheckpoint(chk['context'])
+                return chk['stage'], chk['iteration'], frames
+            except Exception as e:
+                logger.warning("Cannot resume from checkpoint %s (%s), starting from the beginning\n" % (chkfnm, str(e)))
+        for fnm in [chkfnm, framefnm]:
+            if os.path.exists(fnm): os.remove(fnm)
+        return None
+
     def scale_box(self, x=1.0, y=1.0, z=1.0):
         """ Scale the positions of molecules and box vectors. Molecular structures will be kept the same.
         Input: x, y, z :scaling factors (float)
@@ -1304,6 +1863,7 @@ class OpenMM(Engine):
             new_pos = (residue_positions + center_pos_shift[:,np.newaxis,:]).reshape(-1,3)
             # update this frame
             self.xyz_omms[i] = [new_pos.astype(np.float32)*nanometer, new_box*nanometer]
+        self.xyz_cache = None
 
 class Liquid_OpenMM(Liquid):
     """ Condensed phase property matching using OpenMM. """
@@ -1349,6 +1909,8 @@ class Liquid_OpenMM(Liquid):
 
 class AbInitio_OpenMM(AbInitio):
     """ Force and energy matching using OpenMM. """
+    supports_ff_inmemory = True
+
     def __init__(self,options,tgt_opts,forcefield):
         ## Default file names for coordinates and key file.
         self.set_option(tgt_opts,'pdb',default="conf.pdb")
@@ -1362,6 +1924,8 @@ class AbInitio_OpenMM(AbInitio):
 class BindingEnergy_OpenMM(BindingEnergy):
     """ Binding energy matching using OpenMM. """
 
+    supports_ff_inmemory = True
+
     def __init__(self,options,tgt_opts,forcefield):
         self.engine_ = OpenMM
         self.set_option(tgt_opts,'openmm_precision','precision',default="double", forceprint=True)
@@ -1371,6 +1935,8 @@ class BindingEnergy_OpenMM(BindingEnergy):
 
 class Interaction_OpenMM(Interaction):
     """ Interaction matching using OpenMM. """
+    supports_ff_inmemory = True
+
     def __init__(self,options,tgt_opts,forcefield):
         ## Default file names for coordinates and key file.
         self.set_option(tgt_opts,'coords',default="all.pdb")
@@ -1382,6 +1948,8 @@ class Interaction_OpenMM(Interaction):
 
 class Moments_OpenMM(Moments):
     """ Multipole moment matching using OpenMM. """
+    supports_ff_inmemory = True
+
     def __init__(self,options,tgt_opts,forcefield):
         ## Default file names for coordinates and key file.
         self.set_option(tgt_opts,'coords',default="input.pdb")
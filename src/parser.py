@@ -83,6 +83,8 @@ gen_opts_types = {
     'ints'    : {"maxstep"      : (100, 50, 'Maximum number of steps in an optimization', 'Main Optimizer'),
                  "objective_history"  : (2, 20, 'Number of good optimization steps to average over when checking the objective convergence criterion', 'Main Optimizer (jobtype "newton")'),
                  "wq_port"   : (0, 0, 'The port number to use for Work Queue', 'Targets that use Work Queue (advanced usage)'),
+                 "local_workers"  : (0, -50, 'Number of local processes that run the Work Queue tasks of the targets when Work Queue is not used (wq_port is zero)', 'Targets that use Work Queue (advanced usage)'),
+                 "async_workers"  : (1, -50, 'Number of worker processes for evaluating local targets concurrently with Work Queue tasks', 'Asynchronous objective function evaluation (engines must be safe to fork; not for GPU platforms)'),
                  "criteria"   : (1, 160, 'The number of convergence criteria that must be met for main optimizer to converge', 'Main Optimizer'),
                  "rpmd_beads"       : (0, -160, 'Number of beads in ring polymer MD (zero to disable)', 'Condensed phase property targets (advanced usage)', 'liquid_openmm'),
                  "zerograd"         : (-1, 0, 'Set to a nonnegative number to turn on zero gradient skipping at that optimization step.', 'All'),
@@ -106,6 +108,7 @@ gen_opts_types = {
                  "reevaluate"       : (None, 0, 'Re-evaluate the objective function and gradients when the step is rejected (for noisy objective functions).', 'Main Optimizer'),
                  "continue"         : (0, 140, 'Continue the current run from where we left off (supports mid-iteration recovery).', 'Main Optimizer'),
                  "duplicate_pnames" : (0, -150, 'Allow duplicate parameter names (only if you know what you are doing!', 'Force Field Parser'),
+                 "ff_inmemory"      : (0, -150, 'Keep the force field created at each step in memory instead of writing it to disk', 'Creating the force field; only supported by AbInitio, Interaction, BindingEnergy and Moments targets that use OpenMM', ['OPENMM']),
                  },
     'floats'  : {"trust0"                 : (1e-1, 100, 'Levenberg-Marquardt trust radius; set to negative for nonlinear search', 'Main Optimizer'),
                  "mintrust"               : (0.0,   10, 'Minimum trust radius (if the trust radius is tiny, then noisy optimizations become really gnarly)', 'Main Optimizer'),
@@ -184,6 +187,7 @@ tgt_opts_types = {
                  "gas_eq_steps"       : (10000, 0, 'Number of time steps for the gas equilibration run, if different from default.', 'Condensed phase property targets', 'liquid'),
                  "nvt_md_steps"       : (100000, 0, 'Number of time steps for the liquid NVT production run.', 'Condensed phase property targets', 'liquid'),
                  "nvt_eq_steps"       : (10000, 0, 'Number of time steps for the liquid NVT equilibration run.', 'Condensed phase property targets', 'liquid'),
+                 "snapshot_chunk"     : (0, -50, 'Number of snapshots to sum over at once when building the objective function and its derivatives; defaults to all of them', 'Energy + Force Matching', 'AbInitio'),
                  "writelevel"         : (0, 0, 'Affects the amount of data being printed to the temp directory.', 'Energy + Force Matching', 'AbInitio'),
                  "md_threads"         : (1, 0, 'Set the number of threads used by Gromacs or TINKER processes in MD simulations', 'Condensed phase properties in GROMACS and TINKER', 'Liquid_GMX, Lipid_GMX, Liquid_TINKER'),
                  "save_traj"          : (0, -10, 'Whether to save trajectories.  0 = Never save; 1 = Delete if optimization step is good; 2 = Always save', 'Condensed phase properties', 'Liquid, Lipid'),
@@ -191,6 +195,7 @@ tgt_opts_types = {
                  "md_steps"           : (50000, 0, 'Number of time steps for the production run.', 'Thermodynamic property targets', 'thermo'),
                  "n_sim_chain"        : (1, 0, 'Number of simulations required to calculate quantities.', 'Thermodynamic property targets', 'thermo'),
                  "n_molecules"        : (-1, 0, 'Provide the number of molecules in the structure (defaults to auto-detect).', 'Condensed phase properties', 'Liquid'),
+                 "fd_workers"         : (1, -50, 'Number of worker processes for evaluating finite difference parameter displacements in parallel', 'Targets that use finite difference (engine must be safe to fork; not for GPU platforms)'),
                  },
     'bools'   : {"fdgrad"           : (0, -100, 'Finite difference gradient of objective function w/r.t. specified parameters', 'Use together with fd_ptypes (advanced usage)'),
                  "fdhess"           : (0, -100, 'Finite difference Hessian of objective function w/r.t. specified parameters', 'Use together with fd_ptypes (advanced usage)'),
@@ -203,6 +208,9 @@ tgt_opts_types = {
                  "do_cosmo"         : (0, -150, 'Call Q-Chem to do MM COSMO on MM snapshots.', 'Currently unused, but possible in AbInitio target'),
                  "optimize_geometry": (1, 0, 'Perform a geometry optimization before computing properties', 'Monomer properties', 'moments'),
                  "absolute"         : (0, -150, 'When matching energies in AbInitio, do not subtract the mean energy gap.', 'Energy matching (advanced usage)', 'abinitio'),
+                 "dm_scratch"       : (0, -50, 'Store the finite difference derivatives of energies and forces in a memory-mapped scratch file instead of memory (use with snapshot_chunk for large targets)', 'Ab initio targets', 'abinitio'),
+                 "resp_float32"     : (0, -50, 'Store the ESP inverse distance matrix used in RESP fitting in single precision, which halves its memory', 'Ab initio targets with RESP', 'abinitio'),
+                 "qdata_cache"      : (1, -50, 'Cache the data read from qdata.txt in a binary file (qdata.cache.npz) that is used when qdata.txt is unchanged', 'Ab initio targets', 'abinitio'),
                  "cauchy"           : (0, 0, 'Normalize interaction energies each using 1/(denom**2 + reference**2) which resembles a Cauchy distribution', 'Interaction energy targets', 'interaction'),
                  "attenuate"        : (0, 0, 'Normalize interaction energies using 1/(denom**2 + reference**2) only for repulsive interactions greater than denom.', 'Interaction energy targets', 'interaction'),
                  "normalize"        : (0, -150, 'Divide objective function by the number of snapshots / vibrations', 'Interaction energy / vibrational mode targets', 'interaction, vibration'),
@@ -212,6 +220,8 @@ tgt_opts_types = {
                  "force_cuda"       : (0, -150, 'Force the external npt.py script to crash if CUDA Platform not available', 'Condensed phase property targets (advanced usage)', 'liquid_openmm'),
                  "anisotropic_box"  : (0, -150, 'Enable anisotropic box scaling (e.g. for crystals or two-phase simulations) in external npt.py script', 'Condensed phase property targets (advanced usage)', 'liquid_openmm, liquid_tinker'),
                  "mts_integrator"   : (0, -150, 'Enable multiple-timestep integrator in external npt.py script', 'Condensed phase property targets (advanced usage)', 'liquid_openmm'),
+                 "md_checkpoint"    : (0, -150, 'Write checkpoints during the condensed phase simulation so that a rerun in the same directory resumes from the last one', 'Condensed phase property targets (advanced usage)', 'liquid_openmm'),
+                 "md_stream"        : (0, -150, 'Write the condensed phase trajectory to memory-mapped files on disk instead of keeping it in memory, for large systems and long simulations', 'Condensed phase property targets (advanced usage)', 'liquid_openmm'),
                  "minimize_energy"  : (1, 0, 'Minimize the energy of the system prior to running dynamics', 'Condensed phase property targets (advanced usage)', 'liquid_openmm', 'liquid_tinker'),
                  "remote"           : (0, 50, 'Evaluate target as a remote work_queue task', 'All targets (optional)'),
                  "adapt_errors"     : (0, 50, 'Adapt to simulation uncertainty by combining property estimations and adjusting simulation length.', 'Condensed phase property targets', 'liquid'),
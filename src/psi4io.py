@@ -379,7 +379,8 @@ class RDVR3_Psi4(Target):
                 logger.info("\r")
                 queue_up_src_dest(wq,"sh run_psi_rdvr3_objective.sh -c %s &> run_psi_rdvr3_objective.log" % os.path.join(self.root, self.tgtdir, dname),
                                   input_files=input_files,
-                                  output_files=[(os.path.join(this_apath, i),i) for i in ["run_psi_rdvr3_objective.log", "output.dat"]], verbose=False)
+                                  output_files=[(os.path.join(this_apath, i),i) for i in ["run_psi_rdvr3_objective.log", "output.dat"]], verbose=False,
+                                  cache_files=[f for f, r in input_files[-2:]])
             os.chdir(cwd)
 
         for d in self.objfiles:
@@ -10,7 +10,7 @@ from collections import OrderedDict
 import tarfile
 import forcebalance
 from forcebalance.nifty import row, col, printcool_dictionary, link_dir_contents, createWorkQueue, getWorkQueue, wq_wait1, getWQIds, wopen, warn_press_key, _exec, lp_load
-from forcebalance.finite_difference import fdwrap_G, fdwrap_H, f1d2p, f12d3p, in_fd
+from forcebalance.finite_difference import fdwrap_G, fdwrap_H, f1d2p, f12d3p, f12d3p_pool, in_fd
 from forcebalance.optimizer import Counter
 from forcebalance.output import getLogger
 logger = getLogger(__name__)
@@ -74,6 +74,16 @@ class Target(forcebalance.BaseClass):
     """
 
     __metaclass__ = abc.ABCMeta
+
+    ## Whether the target reads the force field from FF.render() in the
+    ## same process, so that it works with the ff_inmemory option.
+    supports_ff_inmemory = False
+
+    ## Attributes that are not copied back to the main process after the
+    ## target is evaluated in a worker process (see async_workers); these
+    ## are large caches, along with the flags that keep track of them, so
+    ## the target in the main process rebuilds them when needed.
+    async_nosync = []
     
     def __init__(self,options,tgt_opts,forcefield):
         """
@@ -116,6 +126,8 @@ class Target(forcebalance.BaseClass):
         ## Parameter types that trigger FD Hessian elements
         ## Finite difference step size
         self.set_option(options, 'finite_difference_h', 'h')
+        ## Number of worker processes for finite difference displacements
+        self.set_option(tgt_opts, 'fd_workers')
         ## Whether to make backup files
         self.set_option(options, 'backup')
         ## Directory to read data from.
@@ -326,6 +338,23 @@ class Target(forcebalance.BaseClass):
         self.hct += 1
         return Ans
     
+    def fd_pool(self, func, mvals, f0=None, out=None):
+        """
+        Finite difference derivatives of a function of the mathematical
+        parameters (usually a closure that calls FF.make and then the
+        engine) for all of the parameters in self.pgrad.  The parameter
+        displacements are evaluated in parallel if fd_workers > 1.
+
+        @param[in] func Function of the mathematical parameters to be differentiated
+        @param[in] mvals Mathematical parameter values
+        @param[in] f0 Function value at mvals, if already available
+        @param[in] out Tuple of preallocated arrays (fp, fpp) for the derivatives; fpp may be None
+        @return fp First derivatives stacked in the order of self.pgrad
+        @return fpp Second derivatives (diagonal only) stacked in the order of self.pgrad
+        """
+        ffnms = [fnm.split(':')[0] for fnm in self.FF.fnms]
+        return f12d3p_pool(func, mvals, self.pgrad, self.h, f0=f0, nproc=self.fd_workers, exclude=ffnms, out=out)
+
     def link_from_tempdir(self,absdestdir):
         link_dir_contents(os.path.join(self.root,self.tempdir), absdestdir)
 
@@ -753,8 +782,8 @@ class RemoteTarget(Target):
         
         self.remote_indicate = ""
 
-        if options['wq_port'] == 0:
-            logger.error("Please set the Work Queue port to use Remote Targets.\n")
+        if options['wq_port'] == 0 and options.get('local_workers', 0) == 0:
+            logger.error("Please set the Work Queue port (or local_workers) to use Remote Targets.\n")
             raise RuntimeError
 
         # Remote target will read objective.p and indicate.log at the same time,
@@ -794,7 +823,8 @@ class RemoteTarget(Target):
                                                                                     if len(self.rpfx) > 0 else ""),
                                     ["forcefield.p", "options.p", "rtarget.py", "target.tar.bz2"] + ([self.rpfx] if len(self.rpfx) > 0 else []),
                                     ['objective.p', 'indicate.log', 'rtarget.out'],
-                                    tgt=self, tag=self.name, verbose=False)
+                                    tgt=self, tag=self.name, verbose=False,
+                                    cache_files=["rtarget.py", "target.tar.bz2"] + ([self.rpfx] if len(self.rpfx) > 0 else []))
 
     def read(self,mvals,AGrad=False,AHess=False):
         return self.get(mvals, AGrad, AHess)
@@ -195,8 +195,7 @@ class Vibration(Target):
         D = calc_eigvals - self.ref_eigvals
         dV = np.zeros((self.FF.np,len(calc_eigvals)))
         if AGrad or AHess:
-            for p in self.pgrad:
-                dV[p,:], _ = f12d3p(fdwrap(get_eigvals, mvals, p), h = self.h, f0 = calc_eigvals)
+            dV[self.pgrad,:], _ = self.fd_pool(get_eigvals, mvals, f0 = calc_eigvals)
         Answer['X'] = np.dot(D,D) / self.denom**2 / (len(D) if self.normalize else 1)
         for p in self.pgrad:
             Answer['G'][p] = 2*np.dot(D, dV[p,:]) / self.denom**2 / (len(D) if self.normalize else 1)
@@ -0,0 +1,199 @@
+import unittest
+import sys, os, shutil
+import time
+import tempfile
+import forcebalance.abinitio
+from __init__ import ForceBalanceTestCase
+import numpy as np
+
+class TestQdata(ForceBalanceTestCase):
+    def setUp(self):
+        super(TestQdata,self).setUp()
+        os.chdir('test/files')
+        os.mkdir('qdata_test')
+        shutil.copy(os.path.join('targets', 'cluster-02', 'qdata.txt'), 'qdata_test')
+        self.qfnm = os.path.join('qdata_test', 'qdata.txt')
+        self.addCleanup(shutil.rmtree, 'qdata_test')
+        # Reference values, read in the same way as the original AbInitio parser.
+        self.eqm = []
+        self.fqm = []
+        for line in open(self.qfnm):
+            sline = line.split()
+            if len(sline) == 0: continue
+            elif sline[0] == 'ENERGY':
+                self.eqm.append(float(sline[1]))
+            elif sline[0] == 'FORCES':
+                self.fqm.append([float(i) for i in sline[1:]])
+
+    def test_read_qdata(self):
+        """Check reading qdata.txt with and without the cache file"""
+        cfnm = os.path.join('qdata_test', 'qdata.cache.npz')
+        # The first call writes the cache file and the second call reads it.
+        for i in range(2):
+            qdata = forcebalance.abinitio.read_qdata(self.qfnm)
+            self.assertEqual(os.path.exists(cfnm), True)
+            self.assertNdArrayEqual(qdata['ENERGY'][:,0], np.array(self.eqm), delta=0)
+            self.assertNdArrayEqual(qdata['FORCES'], np.array(self.fqm), delta=0)
+            self.assertEqual(qdata['ESPXYZ'], [])
+
+    def test_qdata_changed(self):
+        """Check that the qdata cache file is not used after qdata.txt changes"""
+        forcebalance.abinitio.read_qdata(self.qfnm)
+        with open(self.qfnm, 'a') as f:
+            print >> f, "JOB 99"
+            print >> f, "ENERGY -1.0"
+            print >> f, "ESPVAL 1.0 2.0"
+            print >> f, "ESPVAL 3.0"
+        qdata = forcebalance.abinitio.read_qdata(self.qfnm)
+        self.assertEqual(len(qdata['ENERGY']), len(self.eqm)+1)
+        self.assertEqual(qdata['ENERGY'][-1][0], -1.0)
+        self.assertEqual([list(i) for i in qdata['ESPVAL']], [[1.0, 2.0], [3.0]])
+
+class TestAccumulateSnapshots(ForceBalanceTestCase):
+    def test_accumulate_benchmark(self):
+        """Benchmark summing the objective function over snapshots against a loop over snapshots and parameters"""
+        np.random.seed(0)
+        NS, NP, NCP1 = 500, 20, 61
+        M_all = np.random.randn(NS, NCP1)
+        Q_all = np.random.randn(NS, NCP1)
+        dM = np.random.randn(NS, NP, NCP1)
+        wts = np.random.rand(NS)
+        boost = np.where(M_all[:,0] < Q_all[:,0], 2.0, 1.0)
+        # Loop over snapshots and parameters as it was done previously.
+        t0 = time.time()
+        SPX = np.zeros(NCP1)
+        QQ0 = np.zeros(NCP1)
+        X0 = 0.0
+        SPX_p = np.zeros((NP, NCP1))
+        M0_p = np.zeros(NP)
+        SPX_pq = np.zeros((NP, NP, NCP1))
+        for i in range(NS):
+            P = wts[i]
+            X = M_all[i] - Q_all[i]
+            X0 += P*X[0]
+            QQ0 += P*Q_all[i]*Q_all[i]
+            Xi = X**2
+            Xi[0] *= boost[i]
+            SPX += P * Xi
+            for p in range(NP):
+                M0_p[p] += P * dM[i,p,0]
+                Xi_p = 2 * X * dM[i,p]
+                Xi_p[0] *= boost[i]
+                SPX_p[p] += P * Xi_p
+                for q in range(p+1):
+                    Xi_pq = 2 * dM[i,p] * dM[i,q]
+                    Xi_pq[0] *= boost[i]
+                    SPX_pq[p,q] += P * Xi_pq
+        t1 = time.time()
+        Sums = forcebalance.abinitio.accumulate_snapshots(M_all, Q_all, wts, boost, dM=dM, hess=True)
+        t2 = time.time()
+        self.logger.info("\nSum over %i snapshots and %i parameters: %.3f s with loops, %.3f s vectorized\n" % (NS, NP, t1-t0, t2-t1))
+        self.assertAlmostEqual(Sums['Z'], np.sum(wts), places=10)
+        self.assertAlmostEqual(Sums['X0'][0], X0, places=10)
+        self.assertNdArrayEqual(Sums['QQ0'], QQ0, delta=1e-10)
+        self.assertNdArrayEqual(Sums['SPX'], SPX, delta=1e-10)
+        self.assertNdArrayEqual(Sums['M0_p'][:,0], M0_p, delta=1e-10)
+        self.assertNdArrayEqual(Sums['SPX_p'], SPX_p, delta=1e-10)
+        for p in range(NP):
+            for q in range(p+1):
+                self.assertNdArrayEqual(Sums['SPX_pq'][p,q], SPX_pq[p,q], delta=1e-10)
+                self.assertNdArrayEqual(Sums['SPX_pq'][q,p], SPX_pq[p,q], delta=1e-10)
+
+    def test_accumulate_chunks(self):
+        """Check summing over snapshots in chunks, with derivatives stored in a memory-mapped file"""
+        np.random.seed(1)
+        NS, NP, NCP1 = 103, 5, 10
+        M_all = np.random.randn(NS, NCP1)
+        Q_all = np.random.randn(NS, NCP1)
+        wts = np.random.rand(NS)
+        boost = np.ones(NS)
+        dM = np.random.randn(NP, NS, NCP1)
+        dM_file = tempfile.TemporaryFile()
+        dM_map = np.memmap(dM_file, dtype=float, mode='w+', shape=dM.shape)
+        dM_map[:] = dM
+        Ref = forcebalance.abinitio.accumulate_snapshots(M_all, Q_all, wts, boost, dM=np.swapaxes(dM, 0, 1), hess=True)
+        Sums = forcebalance.abinitio.accumulate_snapshots(M_all, Q_all, wts, boost, dM=np.swapaxes(dM_map, 0, 1), hess=True, chunk=20)
+        self.assertEqual(Ref.keys(), Sums.keys())
+        for key in Ref:
+            self.assertNdArrayEqual(np.array(Sums[key]), np.array(Ref[key]), delta=1e-10)
+        dM_file.close()
+
+class TestNetForceTorque(ForceBalanceTestCase):
+    def setUp(self):
+        super(TestNetForceTorque,self).setUp()
+        # A three-atom molecule with a virtual site, labeled 1, and a single atom labeled 0.
+        self.Block = [1, 1, 1, 1, 0]
+        self.AtomMask = [True, True, True, False, True]
+        self.Mass = [1.0, 1.0, 2.0, 0.0, 5.0]
+        # The target is not initialized, only the attributes used here are set.
+        self.target = forcebalance.abinitio.AbInitio.__new__(forcebalance.abinitio.AbInitio)
+        self.target.force_map = 'molecule'
+        self.target.AtomLists = {'MoleculeNumber' : self.Block, 'Mass' : self.Mass}
+        self.target.AtomMask = self.AtomMask
+        self.target.fitatoms = range(sum(self.AtomMask))
+
+    def test_netforce_torque(self):
+        """Check net forces and torques for a molecule and a single atom"""
+        # The center of mass of the molecule is at (5, 5, 5).
+        xyz = np.array([[6, 5, 5], [4, 5, 5], [5, 5, 5], [5, 5, 6], [0, 0, 0]], dtype=float)
+        frc = np.array([[0, 1, 0], [0, -1, 0], [1, 2, 3], [7, 7, 7], [4, 5, 6]], dtype=float)
+        # Net forces on blocks 0 and 1 (in sorted order of the labels), then the torque on block 1 in nm.
+        Ref = np.array([4, 5, 6, 1, 2, 3, 0, 0, 0.2])
+        xyzs = np.array([xyz, xyz + 1.0])
+        frcs = np.array([frc.flatten(), 2*frc.flatten()])
+        Nft = self.target.compute_netforce_torque(xyzs, frcs)
+        self.assertNdArrayEqual(Nft, np.array([Ref, 2*Ref]), delta=1e-12)
+        self.assertEqual((self.target.nnf, self.target.ntq), (2, 1))
+        # Forces and coordinates of the true atoms only, for a single frame.
+        mask = np.nonzero(self.AtomMask)[0]
+        Nft1 = self.target.compute_netforce_torque(xyz[mask], frc[mask].flatten())
+        self.assertNdArrayEqual(Nft1, Ref, delta=1e-12)
+        self.assertRaises(RuntimeError, self.target.compute_netforce_torque, xyz, frc.flatten()[:-6])
+
+class TestESPDistances(ForceBalanceTestCase):
+    def test_esp_invdist(self):
+        """Check the inverse distance matrix for ESP points at known distances from the particles"""
+        xyz = np.array([[0, 0, 0], [3, 0, 0], [0, 0, 5]], dtype=float)
+        espxyz = np.array([[0, 4, 0], [3, 0, 2]], dtype=float)
+        # Distances in Angstrom; the inverse distances are in inverse bohr.
+        Ref = forcebalance.nifty.bohrang / np.array([[4, 5, np.sqrt(41)], [np.sqrt(13), 2, np.sqrt(18)]])
+        # The second snapshot is translated.
+        invdists = forcebalance.abinitio.esp_invdist(np.array([espxyz, espxyz + 1.5]), np.array([xyz, xyz + 1.5]))
+        self.assertNdArrayEqual(invdists, np.array([Ref, Ref]), delta=1e-12)
+        invdists32 = forcebalance.abinitio.esp_invdist(np.array([espxyz]), np.array([xyz]), dtype=np.float32)
+        self.assertEqual(invdists32.dtype, np.float32)
+        self.assertNdArrayEqual(invdists32[0].astype(float), Ref, delta=1e-6)
+        # A single snapshot and a subset of the particles.
+        self.assertNdArrayEqual(forcebalance.abinitio.esp_invdist(espxyz, xyz[[0,2]]), Ref[:,[0,2]], delta=1e-12)
+
+class TestRESPObjective(ForceBalanceTestCase):
+    def test_resp_objective(self):
+        """Check the RESP objective function and its derivatives for a small system"""
+        # Two snapshots with two ESP points and two atoms each.
+        invdists = np.array([[[1, 0], [0, 1]], [[1, 1], [0, 2]]], dtype=float)
+        charges = np.array([1, -1], dtype=float)
+        espvals = np.array([[0, 0], [1, -1]], dtype=float)
+        wts = np.array([0.25, 0.75])
+        dq = np.array([[1, 0], [0, 1]], dtype=float)
+        # Parameter 1 also moves the particles (like a virtual site).
+        dV = {1 : np.array([[[1, 0], [0, 0]]]*2, dtype=float)}
+        d2V = {1 : np.array([[[0, 1], [0, 0]]]*2, dtype=float)}
+        for chunk in [0, 1]:
+            Sums = forcebalance.abinitio.resp_objective(invdists, charges, espvals, wts, dq=dq, dV=dV, d2V=d2V, hess=True, chunk=chunk)
+            self.assertAlmostEqual(Sums['X'], 1.0, places=12)
+            self.assertAlmostEqual(Sums['Q'], 0.75, places=12)
+            self.assertAlmostEqual(Sums['D'], 0.75, places=12)
+            self.assertNdArrayEqual(Sums['G'], np.array([-0.5, -3.0]), delta=1e-12)
+            self.assertNdArrayEqual(Sums['H'], np.array([[1.0, 1.75], [1.75, 7.0]]), delta=1e-12)
+        # Derivatives of the inverse distances stored for a subset of the columns, in a different order.
+        Sums = forcebalance.abinitio.resp_objective(invdists, charges, espvals, wts, dq=dq, dV={1 : dV[1][:,:,[1,0]]}, d2V={1 : d2V[1][:,:,[1,0]]},
+                                                    dVcols={1 : [1,0]}, hess=True)
+        self.assertNdArrayEqual(Sums['G'], np.array([-0.5, -3.0]), delta=1e-12)
+        self.assertNdArrayEqual(Sums['H'], np.array([[1.0, 1.75], [1.75, 7.0]]), delta=1e-12)
+        # Without derivatives, only the objective function is computed.
+        Sums = forcebalance.abinitio.resp_objective(invdists.astype(np.float32), charges, espvals, wts)
+        self.assertAlmostEqual(Sums['X'], 1.0, places=6)
+        self.assertEqual(Sums['G'].shape, (0,))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -56,7 +56,46 @@ class TestFiniteDifference(ForceBalanceTestCase):
                         else:
                             self.assertAlmostEqual(result, func[1](input,p), places=3)
             
-            
+
+    def test_f12d3p_pool(self):
+        """Check parallel finite difference matches the serial three-point stencil"""
+        func = lambda x: numpy.array([x[0]**2*x[1], cos(x[1]), x[2]**3])
+        mvals = [0.5, 1.0, -0.3]
+        pidxs = [0, 2]
+        serial = forcebalance.finite_difference.f12d3p_pool(func, mvals, pidxs, .0001, nproc=1)
+        parallel = forcebalance.finite_difference.f12d3p_pool(func, mvals, pidxs, .0001, nproc=2)
+        self.logger.debug("Comparing serial and parallel finite difference derivatives\n")
+        for k, p in enumerate(pidxs):
+            ref = forcebalance.finite_difference.f12d3p(forcebalance.finite_difference.fdwrap(func, mvals, p), .0001)
+            self.assertEqual(serial[0][k], ref[0])
+            self.assertEqual(serial[1][k], ref[1])
+            self.assertEqual(parallel[0][k], serial[0][k])
+            self.assertEqual(parallel[1][k], serial[1][k])
+
+    def test_f12d3p_pool_out(self):
+        """Check storing parallel finite difference derivatives in preallocated arrays"""
+        func = lambda x: numpy.array([x[0]**2*x[1], cos(x[1]), x[2]**3])
+        mvals = [0.5, 1.0, -0.3]
+        pidxs = [0, 2]
+        ref = forcebalance.finite_difference.f12d3p_pool(func, mvals, pidxs, .0001, nproc=1)
+        for nproc in [1, 2]:
+            fp = numpy.zeros((len(pidxs), 3))
+            result = forcebalance.finite_difference.f12d3p_pool(func, mvals, pidxs, .0001, nproc=nproc, out=(fp, None))
+            self.assertTrue(result[0] is fp)
+            self.assertEqual(result[1], None)
+            self.assertNdArrayEqual(fp, ref[0], delta=0)
+
+    def test_f12d3p_sweep(self):
+        """Check batched finite difference matches the serial three-point stencil"""
+        func = lambda x: numpy.array([x[0]**2*x[1], cos(x[1]), x[2]**3])
+        sweep = lambda mvals_list: numpy.array([func(x) for x in mvals_list])
+        mvals = [0.5, 1.0, -0.3]
+        pidxs = [0, 2]
+        ref = forcebalance.finite_difference.f12d3p_pool(func, mvals, pidxs, .0001, nproc=1)
+        for f0 in [None, func(mvals)]:
+            result = forcebalance.finite_difference.f12d3p_sweep(sweep, mvals, pidxs, .0001, f0=f0)
+            self.assertNdArrayEqual(result[0], ref[0], delta=1e-8)
+            self.assertNdArrayEqual(result[1], ref[1], delta=1e-4)
 
 if __name__ == '__main__':           
     unittest.main()
@@ -64,7 +64,39 @@ class FFTests(object):
         self.assertNotEqual(self.ff, ff_ones,
                         msg = "make([1]) produced an unchanged output forcefield")
         os.remove(self.options['ffdir']+'/test_ones.' + self.filetype)
-    
+
+    def test_make_function_repeated(self):
+        """Check make() output does not depend on previous calls and matches render()"""
+        fnm = self.ff.fnms[0]
+        mvals = np.linspace(-0.5, 0.5, self.ff.np)
+        self.ff.make(mvals)
+        first = open(fnm).read()
+        self.assertEqual(first, self.ff.render(fnm),
+                        msg = "render() does not match the force field file written by make()")
+
+        self.logger.debug("Running make() again after other parameter values... ")
+        self.ff.make(np.ones(self.ff.np))
+        self.ff.make(mvals)
+        self.assertEqual(first, open(fnm).read(),
+                        msg = "make() output depends on the previous call")
+        self.logger.debug("ok\n")
+
+        self.logger.debug("Running make() on a copy of the force field... ")
+        ff_copy = deepcopy(self.ff)
+        ff_copy.make(mvals)
+        self.assertEqual(first, open(fnm).read(),
+                        msg = "make() on a copied force field produced a different output")
+        self.logger.debug("ok\n")
+        os.remove(fnm)
+
+        self.logger.debug("Running make() in memory... ")
+        ff_copy.ff_inmemory = True
+        ff_copy.make(mvals)
+        self.assertFalse(os.path.exists(fnm), msg = "make() wrote a file with ff_inmemory switched on")
+        self.assertEqual(first, ff_copy.render(fnm),
+                        msg = "make() in memory produced a different output")
+        self.logger.debug("ok\n")
+
 
 class TestWaterFF(ForceBalanceTestCase, FFTests):
     """Test FF class using water options and forcefield (text forcefield input)
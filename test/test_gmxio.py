@@ -31,5 +31,26 @@ class TestAbInitio_GMX(ForceBalanceTestCase, TargetTests):
         """@override ForceBalanceTestCase.shortDescription()"""
         return super(TestAbInitio_GMX,self).shortDescription() + " (AbInitio_GMX)"
 
+class TestGMXReaders(ForceBalanceTestCase):
+    """Test reading GROMACS binary files directly"""
+    def setUp(self):
+        self.datadir = os.path.join(os.getcwd(), 'studies', '009_voelz_nspe', 'analysis')
+
+    def test_read_edr(self):
+        """Check energies read from .edr file against g_energy output"""
+        times, energies = forcebalance.gmxio.read_edr(os.path.join(self.datadir, 'ener.edr'))
+        xvg = numpy.loadtxt(os.path.join(self.datadir, 'energy.xvg'), comments=['#', '@'])
+        self.assertEqual(energies.keys()[8], 'Potential')
+        self.assertNdArrayEqual(times, xvg[:,0], delta=1e-6)
+        self.assertNdArrayEqual(energies['Potential'], xvg[:,1], delta=1e-5)
+
+    def test_read_trr(self):
+        """Check frames read from .trr file"""
+        frames = forcebalance.gmxio.read_trr(os.path.join(self.datadir, 'traj.trr'))
+        self.assertEqual(len(frames), 239)
+        self.assertEqual(frames[-1]['time'], 238.0)
+        self.assertEqual(frames[0]['x'].shape, (28, 3))
+        self.assertNdArrayEqual(frames[0]['box'], numpy.eye(3)*0.3, delta=1e-6)
+
 if __name__ == '__main__':           
     unittest.main()
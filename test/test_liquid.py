@@ -0,0 +1,70 @@
+import unittest
+import sys, os, re
+import forcebalance
+import forcebalance.liquid
+import numpy
+from collections import defaultdict, OrderedDict
+from __init__ import ForceBalanceTestCase
+
+class TestSolveMBAR(ForceBalanceTestCase):
+    def setUp(self):
+        super(TestSolveMBAR,self).setUp()
+        numpy.random.seed(0)
+        K, N = 3, 50
+        self.E = numpy.random.randn(K, N)*5 - 100
+        self.V = 30 + numpy.random.randn(K, N)*0.3
+        self.Beta = numpy.array([1. / (forcebalance.nifty.kb * T) for T in [300.0, 310.0, 320.0]])
+        self.Pres = numpy.array([1.0, 1.0, 500.0])
+        self.N_k = numpy.ones(K, dtype=int)*N
+        # The target is not initialized, only the attributes used here are set.
+        self.target = forcebalance.liquid.Liquid.__new__(forcebalance.liquid.Liquid)
+        self.target.MBarFreeEnergy = defaultdict(OrderedDict)
+        # Record the initial guesses that are passed to MBAR.
+        self.initial_f_k = []
+        MBAR = forcebalance.liquid.pymbar.MBAR
+        def record_MBAR(*args, **kwargs):
+            self.initial_f_k.append(kwargs.get('initial_f_k'))
+            return MBAR(*args, **kwargs)
+        forcebalance.liquid.pymbar.MBAR = record_MBAR
+        self.addCleanup(setattr, forcebalance.liquid.pymbar, 'MBAR', MBAR)
+
+    def test_reduced_potentials(self):
+        """Check the reduced potentials against a loop over pairs of states"""
+        K, N = self.E.shape
+        pvkj = 0.061019351687175
+        Ref = numpy.zeros((K, K, N))
+        mRef = numpy.zeros((K, K, N))
+        for m in range(K):
+            for k in range(K):
+                Ref[k, m, :] = (self.E[k] + self.Pres[m]*self.V[k]*pvkj) * self.Beta[m]
+                mRef[k, m, :] = self.E[k] * self.Beta[m]
+        self.assertNdArrayEqual(forcebalance.liquid.reduced_potentials(self.E, self.Beta, self.V, self.Pres), Ref, delta=1e-10)
+        self.assertNdArrayEqual(forcebalance.liquid.reduced_potentials(self.E, self.Beta), mRef, delta=1e-10)
+
+    def test_solve_mbar_initial_guess(self):
+        """Check that MBAR starts from the stored free energies"""
+        U_kln = forcebalance.liquid.reduced_potentials(self.E, self.Beta, self.V, self.Pres)
+        # Energies from a different set of parameters.
+        U_kln1 = forcebalance.liquid.reduced_potentials(self.E*1.01, self.Beta, self.V, self.Pres)
+        key = ('liquid', (300.0, 310.0, 320.0))
+        solve = lambda astrm, U: self.target.solve_mbar(key, astrm, U, self.N_k, verbose=False, relative_tolerance=5.0e-8)
+        f_a = solve('a', U_kln).f_k.copy()
+        self.assertTrue(self.initial_f_k[-1] is None)
+        # New parameters start from the most recent free energies.
+        f_b = solve('b', U_kln1).f_k.copy()
+        self.assertNdArrayEqual(self.initial_f_k[-1], f_a, delta=0)
+        self.assertTrue(numpy.max(numpy.abs(f_b - f_a)) > 1e-3)
+        # Parameters that were seen before start from their own free energies.
+        f_a1 = solve('a', U_kln).f_k.copy()
+        self.assertNdArrayEqual(self.initial_f_k[-1], f_a, delta=0)
+        self.assertNdArrayEqual(f_a1, f_a, delta=1e-6)
+        # These are now the most recent free energies.
+        solve('c', U_kln1)
+        self.assertNdArrayEqual(self.initial_f_k[-1], f_a1, delta=0)
+        self.assertEqual(list(self.target.MBarFreeEnergy[key].keys()), ['b', 'a', 'c'])
+        # Other phase points don't share the free energies.
+        self.target.solve_mbar(('gas', (300.0, 310.0, 320.0)), 'a', U_kln, self.N_k, verbose=False)
+        self.assertTrue(self.initial_f_k[-1] is None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,22 @@
 import unittest
-import sys, os, re
+import sys, os, re, time
+import itertools
 import forcebalance.molecule
 from __init__ import ForceBalanceTestCase
 import numpy as np
 
+def reference_bonds(M):
+    """ Bonds of the first frame computed from the distances between all pairs of atoms. """
+    xyz = np.array(M.xyzs[0])
+    R = np.array([forcebalance.molecule.Radii[forcebalance.molecule.Elements.index(e)-1] for e in M.elem])
+    i, j = np.triu_indices(M.na, 1)
+    dx = xyz[i] - xyz[j]
+    if M.top_settings['toppbc']:
+        L = np.array([M.boxes[0].a, M.boxes[0].b, M.boxes[0].c])
+        dx -= L*np.round(dx/L)
+    bonded = np.sqrt(np.sum(dx*dx, axis=1)) < np.maximum((R[i]+R[j])*M.top_settings['Fac'], 1.0)
+    return [(int(a), int(b)) for a, b in zip(i[bonded], j[bonded])]
+
 class TestPDBMolecule(ForceBalanceTestCase):
     def __init__(self, methodName='runTest'):
         super(TestPDBMolecule,self).__init__(methodName)
@@ -129,6 +142,34 @@ class TestWaterPDB(ForceBalanceTestCase):
         self.logger.debug("\nTrying to read water conformation... ")
         self.assertEqual(len(self.molecule.molecules), 500, msg = "\nIncorrect number of molecules for water structure")
 
+    def test_build_bonds(self):
+        """Check bonds from the cell list against all pairs of atoms"""
+        M = self.molecule
+        for toppbc in [True, False]:
+            M.top_settings['toppbc'] = toppbc
+            M.build_bonds()
+            self.assertEqual(M.bonds, reference_bonds(M), msg = "\nCell list bonds do not match all-pairs bonds (toppbc=%s)" % toppbc)
+            if toppbc: self.assertEqual(len(M.bonds), 1000)
+
+    def test_build_bonds_benchmark(self):
+        """Benchmark building bonds for a replicated water box with 10^6 atoms"""
+        M = self.molecule
+        a = M.boxes[0].a
+        nrep = 9
+        shifts = np.array(list(itertools.product(range(nrep), repeat=3)), dtype=float) * a
+        big = forcebalance.molecule.Molecule()
+        big.elem = M.elem * len(shifts)
+        big.xyzs = [(M.xyzs[0][np.newaxis,:,:] + shifts[:,np.newaxis,:]).reshape(-1, 3)]
+        big.boxes = [forcebalance.molecule.CubicLattice(a*nrep)]
+        big.top_settings['toppbc'] = True
+        t0 = time.time()
+        big.build_bonds()
+        t1 = time.time()
+        self.logger.info("\nBuilt %i bonds for %i atoms in %.2f s\n" % (len(big.bonds), big.na, t1-t0))
+        self.assertEqual(len(big.bonds), 1000 * len(shifts))
+        # Each copy of the box has the same bonds, possibly to atoms in a neighboring copy.
+        self.assertEqual(sorted(set([tuple(sorted((i % M.na, j % M.na))) for i, j in big.bonds])), M.bonds)
+
 class TestAlaGRO(ForceBalanceTestCase):
     def __init__(self, methodName='runTest'):
         super(TestAlaGRO,self).__init__(methodName)
@@ -148,5 +189,151 @@ class TestAlaGRO(ForceBalanceTestCase):
         self.logger.debug("\nTrying to read alanine dipeptide conformation... ")
         self.assertEqual(len(self.molecule.bonds), 21, msg = "\nIncorrect number of bonds for alanine dipeptide structure")
 
+class TestBinaryTrajectories(ForceBalanceTestCase):
+    def setUp(self):
+        super(TestBinaryTrajectories,self).setUp()
+        os.chdir('test/files')
+        self.trr = os.path.join('..', '..', 'studies', '009_voelz_nspe', 'analysis', 'traj.trr')
+        self.addCleanup(os.system, 'rm -f nspe_traj.nc')
+
+    def test_read_xtc(self):
+        """Check coordinates read from .xtc file against .trr file"""
+        xtc = forcebalance.molecule.Molecule('nspe_traj.xtc')
+        trr = forcebalance.molecule.Molecule(self.trr)
+        self.assertEqual(len(xtc), 25)
+        self.assertEqual(len(trr), 239)
+        # The .xtc file was written with a precision of 0.001 nm.
+        self.assertNdArrayEqual(np.array(xtc.xyzs), np.array(trr.xyzs[:25]), delta=0.0051)
+        self.assertAlmostEqual(xtc.boxes[0].a, 3.0, places=5)
+
+    def test_stride_atoms(self):
+        """Check reading a subset of frames and atoms from binary trajectories"""
+        for fnm in ['nspe_traj.xtc', self.trr]:
+            full = forcebalance.molecule.Molecule(fnm)
+            sub = forcebalance.molecule.Molecule(fnm, stride=4, atoms=[0, 5, 7])
+            self.assertEqual(len(sub), (len(full)+3)/4)
+            self.assertEqual(sub.na, 3)
+            self.assertNdArrayEqual(np.array(sub.xyzs), np.array(full.xyzs[::4])[:, [0, 5, 7]], delta=1e-10)
+
+    def test_read_netcdf(self):
+        """Check coordinates read from AMBER NetCDF trajectory"""
+        from scipy.io import netcdf
+        trr = forcebalance.molecule.Molecule(self.trr)
+        nc = netcdf.netcdf_file('nspe_traj.nc', 'w')
+        nc.Conventions = 'AMBER'
+        nc.createDimension('frame', None)
+        nc.createDimension('atom', trr.na)
+        nc.createDimension('spatial', 3)
+        nc.createDimension('cell_spatial', 3)
+        nc.createDimension('cell_angular', 3)
+        nc.createVariable('coordinates', 'f', ('frame', 'atom', 'spatial'))[:] = np.array(trr.xyzs)
+        nc.createVariable('cell_lengths', 'd', ('frame', 'cell_spatial'))[:] = [[b.a, b.b, b.c] for b in trr.boxes]
+        nc.createVariable('cell_angles', 'd', ('frame', 'cell_angular'))[:] = [[b.alpha, b.beta, b.gamma] for b in trr.boxes]
+        nc.close()
+        mol = forcebalance.molecule.Molecule('nspe_traj.nc', stride=2, atoms=range(10))
+        self.assertEqual(len(mol), 120)
+        self.assertNdArrayEqual(np.array(mol.xyzs), np.array(trr.xyzs[::2])[:, :10], delta=1e-5)
+        self.assertAlmostEqual(mol.boxes[-1].c, 3.0, places=5)
+
+def kabsch_rmsd(xyzi, xyzj):
+    """ RMSD after optimal superposition, from the singular values of the correlation matrix (Kabsch). """
+    xyzi = xyzi - xyzi.mean(0)
+    xyzj = xyzj - xyzj.mean(0)
+    S = np.linalg.svd(np.dot(xyzi.T, xyzj), compute_uv=False)
+    # Improper rotations are not allowed.
+    if np.linalg.det(np.dot(xyzi.T, xyzj)) < 0: S[-1] *= -1
+    return np.sqrt(max(np.sum(xyzi**2) + np.sum(xyzj**2) - 2*np.sum(S), 0.0) / len(xyzi))
+
+class TestRMSD(ForceBalanceTestCase):
+    def setUp(self):
+        super(TestRMSD,self).setUp()
+        os.chdir('test/files')
+        self.molecule = forcebalance.molecule.Molecule(os.path.join('..', '..', 'studies', '009_voelz_nspe', 'analysis', 'traj.trr'))
+        self.addCleanup(os.system, 'rm -f rmsd_matrix.npy')
+
+    def test_rmsd_qcp(self):
+        """Check QCP RMSD for structures with known RMSD"""
+        # A square and the same square twice as large; the best superposition is the identity.
+        A = np.array([[1, 0, 0], [-1, 0, 0], [0, 1, 0], [0, -1, 0]], dtype=float)
+        self.assertNdArrayEqual(forcebalance.molecule.rmsd_qcp(A, np.array([2*A])), np.array([1.0]), delta=1e-6)
+        # A frame and a rotated copy of itself.
+        xyz = self.molecule.xyzs[0] - self.molecule.xyzs[0].mean(0)
+        c, s = np.cos(0.7), np.sin(0.7)
+        rot = np.dot([[c, -s, 0], [s, c, 0], [0, 0, 1]], [[1, 0, 0], [0, c, -s], [0, s, c]])
+        self.assertNdArrayEqual(forcebalance.molecule.rmsd_qcp(xyz, np.array([xyz, np.dot(xyz, rot)])), np.zeros(2), delta=1e-6)
+        # A mirror image can't be superimposed.
+        self.assertNdArrayEqual(forcebalance.molecule.rmsd_qcp(xyz, np.array([-xyz])), np.array([kabsch_rmsd(xyz, -xyz)]), delta=1e-6)
+
+    def test_linear_rmsd(self):
+        """Check RMSD of nearly identical diatomic and linear triatomic molecules"""
+        np.random.seed(5)
+        c, s = np.cos(1.1), np.sin(1.1)
+        rot = np.dot([[c, -s, 0], [s, c, 0], [0, 0, 1]], [[1, 0, 0], [0, c, -s], [0, s, c]])
+        # Stretching a rotated diatomic by 2e-5 Angstrom moves each atom by 1e-5 after superposition.
+        A = np.array([[-0.55, 0, 0], [0.55, 0, 0]])
+        B = np.dot(np.array([[-0.55-1e-5, 0, 0], [0.55+1e-5, 0, 0]]), rot)
+        self.assertNdArrayEqual(forcebalance.molecule.rmsd_qcp(A, np.array([B])), np.array([1e-5]), delta=1e-10)
+        for xyz in [A, np.array([[-1.2, 0, 0], [0, 0, 0], [1.2, 0, 0]])]:
+            M = forcebalance.molecule.Molecule()
+            M.xyzs = [np.dot(xyz + 1e-4*np.random.randn(*xyz.shape), rot if i % 2 else np.eye(3)) + i for i in range(6)]
+            N = len(M)
+            Ref = np.array([[kabsch_rmsd(M.xyzs[i], M.xyzs[j]) if i != j else 0.0 for j in range(N)] for i in range(N)])
+            self.assertNdArrayEqual(M.all_pairwise_rmsd(), Ref, delta=1e-9)
+            self.assertNdArrayEqual(M.ref_rmsd(0), Ref[0], delta=1e-9)
+            self.assertNdArrayEqual(M.pathwise_rmsd(), np.diag(Ref, 1), delta=1e-9)
+
+    def test_all_pairwise_rmsd(self):
+        """Check pairwise RMSD against superposition with the SVD"""
+        M = self.molecule[::6]
+        N = len(M)
+        Ref = np.array([[kabsch_rmsd(M.xyzs[i], M.xyzs[j]) for j in range(N)] for i in range(N)])
+        Mat = M.all_pairwise_rmsd()
+        self.assertNdArrayEqual(Mat, Ref, delta=1e-6)
+        # Multiple threads and a memory-mapped output matrix.
+        out = np.lib.format.open_memmap('rmsd_matrix.npy', mode='w+', dtype=float, shape=(N, N))
+        M.all_pairwise_rmsd(nthreads=2, chunk=16, out=out)
+        out.flush()
+        self.assertNdArrayEqual(np.load('rmsd_matrix.npy'), Mat, delta=1e-12)
+
+    def test_ref_pathwise_rmsd(self):
+        """Check RMSD to a reference frame and between consecutive frames"""
+        M = self.molecule
+        xyz0 = [x.copy() for x in M.xyzs]
+        self.assertNdArrayEqual(M.ref_rmsd(5), np.array([kabsch_rmsd(M.xyzs[5], x) for x in M.xyzs]), delta=1e-6)
+        self.assertNdArrayEqual(M.pathwise_rmsd(), np.array([kabsch_rmsd(M.xyzs[i], M.xyzs[i+1]) for i in range(len(M)-1)]), delta=1e-6)
+        self.assertNdArrayEqual(M.ref_rmsd(5, align=False), np.array([np.sqrt(3*np.mean((x - M.xyzs[5])**2)) for x in M.xyzs]), delta=1e-10)
+        # The coordinates are not modified.
+        self.assertNdArrayEqual(np.array(M.xyzs), np.array(xyz0), delta=0)
+
+class TestNpyFrameStore(ForceBalanceTestCase):
+    def setUp(self):
+        super(TestNpyFrameStore,self).setUp()
+        os.chdir('test/files')
+        self.molecule = forcebalance.molecule.Molecule('nspe_traj.xtc')
+        self.molecule.write('nspe_traj.npy')
+        self.addCleanup(os.system, 'rm -f nspe_traj.npy nspe_traj_boxes.npy')
+
+    def test_read_npy(self):
+        """Check coordinates and boxes read from memory-mapped .npy file"""
+        mol = forcebalance.molecule.Molecule('nspe_traj.npy')
+        self.assertEqual(len(mol), 25)
+        self.assertNdArrayEqual(np.array(mol.xyzs), np.array(self.molecule.xyzs), delta=1e-10)
+        self.assertEqual([b.a for b in mol.boxes], [b.a for b in self.molecule.boxes])
+
+    def test_npy_views(self):
+        """Check that slicing memory-mapped frames does not copy them"""
+        mol = forcebalance.molecule.Molecule('nspe_traj.npy')
+        sub = mol[2:10]
+        self.assertTrue(np.may_share_memory(sub.xyzs[0], mol.xyzs[2]))
+        self.assertTrue(all([frame.xyzs is xyz for frame, xyz in zip(mol, mol.xyzs)]))
+        sel = mol.atom_select(range(5, 10), build_topology=False)
+        self.assertTrue(np.may_share_memory(sel.xyzs[3], mol.xyzs[3]))
+        self.assertNdArrayEqual(sel.xyzs[3], self.molecule.xyzs[3][5:10], delta=1e-10)
+        # Frames that are not memory-mapped are still copied.
+        self.assertFalse(np.may_share_memory(self.molecule[2:10].xyzs[0], self.molecule.xyzs[2]))
+        # Modifying the coordinates does not change the file.
+        mol.xyzs[0][0] += 1.0
+        self.assertNdArrayEqual(np.load('nspe_traj.npy')[0], self.molecule.xyzs[0], delta=1e-10)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,8 +1,8 @@
 from __init__ import ForceBalanceTestCase
 import unittest
 import numpy
-import os, re
-import subprocess
+import os, re, shutil, tempfile
+import subprocess, time
 import forcebalance
 from forcebalance.nifty import *
 from forcebalance.nifty import _exec
@@ -124,6 +124,97 @@ class TestNifty(ForceBalanceTestCase):
         
         # Destroy the Work Queue object so it doesn't interfere with the rest of the tests.
         destroyWorkQueue()
-        
+
+    def test_local_queue(self):
+        """Check running tasks with the local task queue in place of Work Queue"""
+        cwd = os.getcwd()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        os.chdir(tmpdir)
+        try:
+            createLocalQueue(2, scratch=tmpdir, max_retries=1)
+            wq = getWorkQueue()
+            self.assertTrue(isinstance(wq, LocalQueue))
+            for i in range(4):
+                with open('input%i.txt' % i, 'w') as f: print >> f, i
+                queue_up(wq, "cat input%i.txt input%i.txt > output%i.txt" % (i, i, i), ['input%i.txt' % i], ['output%i.txt' % i], verbose=False)
+            # This task only succeeds the second time it is run.
+            queue_up(wq, "if [ -f %s/flag ]; then echo ok > output4.txt; else touch %s/flag; fi" % (tmpdir, tmpdir), [], ['output4.txt'], verbose=False)
+            self.assertFalse(wq.empty())
+            wq_wait(wq, wait_time=1, wait_intvl=1)
+            self.assertTrue(wq.empty())
+            self.assertEqual(wq.stats.total_tasks_complete, 5)
+            for i in range(4):
+                self.assertEqual(open('output%i.txt' % i).read().split(), [str(i), str(i)])
+            self.assertEqual(open('output4.txt').read().strip(), 'ok')
+            self.assertEqual(len(getWQIds()["None"]), 0)
+            # The scratch directories are removed.
+            self.assertEqual(len([d for d in os.listdir(tmpdir) if d.startswith('task')]), 0)
+            # A task that keeps failing stops the calculation.
+            queue_up(wq, "true", [], ['missing.txt'], verbose=False)
+            self.assertRaises(RuntimeError, wq_wait, wq, wait_time=1, wait_intvl=1)
+        finally:
+            os.chdir(cwd)
+            destroyWorkQueue()
+
+    def test_cached_input(self):
+        """Check content-addressed copies of cached Work Queue input files"""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        fnm = os.path.join(tmpdir, 'input.txt')
+        with open(fnm, 'w') as f: print >> f, "first"
+        cf1 = cached_input(fnm)
+        self.assertEqual(os.path.basename(cf1).split('-')[-1], 'input.txt')
+        self.assertEqual(open(cf1).read(), open(fnm).read())
+        self.assertEqual(cached_input(fnm), cf1)
+        # A file with the same contents has the same copy.
+        fnm2 = os.path.join(tmpdir, 'copy', 'input.txt')
+        os.makedirs(os.path.dirname(fnm2))
+        shutil.copy(fnm, fnm2)
+        self.assertEqual(cached_input(fnm2), cf1)
+        # Changing the file creates a new copy and keeps the old one.
+        with open(fnm, 'w') as f: print >> f, "second"
+        os.utime(fnm, (time.time()+10, time.time()+10))
+        cf2 = cached_input(fnm)
+        self.assertNotEqual(cf2, cf1)
+        self.assertEqual(open(cf2).read().strip(), "second")
+        self.assertEqual(open(cf1).read().strip(), "first")
+
+    def test_statistical_inefficiency(self):
+        """Check FFT statistical inefficiency against the correlation function loop"""
+        def reference(A_n, B_n, fast=False, mintime=3):
+            # Loop over correlation times as it was done previously.
+            N = len(A_n)
+            dA_n = A_n - A_n.mean()
+            dB_n = B_n - B_n.mean()
+            sigma2_AB = (dA_n * dB_n).mean()
+            g = 1.0
+            t = 1
+            increment = 1
+            while (t < N-1):
+                C = sum(dA_n[0:(N-t)]*dB_n[t:N] + dB_n[0:(N-t)]*dA_n[t:N]) / (2.0 * float(N-t) * sigma2_AB)
+                if (C <= 0.0) and (t > mintime):
+                    break
+                g += 2.0 * C * (1.0 - float(t)/float(N)) * float(increment)
+                t += increment
+                if fast: increment += 1
+            return max(g, 1.0)
+        rng = numpy.random.RandomState(0)
+        # Correlated timeseries from an AR(1) process with different correlation times.
+        A_n = numpy.zeros((2000, 3))
+        noise = rng.normal(size=A_n.shape)
+        for n in range(1, len(A_n)):
+            A_n[n] = numpy.array([0.0, 0.8, 0.95])*A_n[n-1] + noise[n]
+        B_n = A_n + rng.normal(size=A_n.shape)
+        for fast in [False, True]:
+            g_2d = statisticalInefficiency(A_n, fast=fast)
+            for col in range(A_n.shape[1]):
+                ref = reference(A_n[:,col], A_n[:,col], fast=fast)
+                self.assertAlmostEqual(statisticalInefficiency(A_n[:,col], fast=fast), ref, places=8)
+                self.assertAlmostEqual(g_2d[col], ref, places=8)
+                self.assertAlmostEqual(statisticalInefficiency(A_n[:,col], B_n[:,col], fast=fast), reference(A_n[:,col], B_n[:,col], fast=fast), places=8)
+        self.assertEqual(statisticalInefficiency(numpy.ones(100), warn=False), 1.0)
+        self.assertEqual(multiD_statisticalInefficiency(A_n).shape, A_n.shape)
+
 if __name__ == '__main__':           
     unittest.main()
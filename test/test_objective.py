@@ -3,6 +3,7 @@ import sys, os, re
 import forcebalance
 import abc
 import numpy
+import tempfile
 from __init__ import ForceBalanceTestCase
 
 class TestImplemented(ForceBalanceTestCase):
@@ -157,5 +158,60 @@ class TestBromineObjective(ForceBalanceTestCase, ObjectiveTests):
     def shortDescription(self):
         return super(TestBromineObjective, self).shortDescription() + " (Liquid_GMX target)"
 
+class TestAsyncObjective(ForceBalanceTestCase):
+    def setUp(self):
+        self.options=forcebalance.parser.gen_opts_defaults.copy()
+        self.options.update({
+                'root': os.getcwd() + '/test/files',
+                'penalty_additive': 0.01,
+                'jobtype': 'NEWTON',
+                'forcefield': ['water.itp']})
+        os.chdir(self.options['root'])
+
+        self.tgt_opts = []
+        for name in ["cluster-02", "cluster-06"]:
+            self.tgt_opts.append(forcebalance.parser.tgt_opts_defaults.copy())
+            self.tgt_opts[-1].update({"type" : "ABINITIO_GMX", "name" : name})
+        self.ff = forcebalance.forcefield.FF(self.options)
+
+    def test_async_target_terms(self):
+        """Check target terms evaluated in worker processes against serial evaluation"""
+        mvals = numpy.array([.5]*self.ff.np)
+        objective = forcebalance.objective.Objective(self.options, self.tgt_opts, self.ff)
+        ref = objective.Target_Terms(mvals, Order=1)
+        self.options.update({'asynchronous': True, 'async_workers': 2})
+        objective = forcebalance.objective.Objective(self.options, self.tgt_opts, self.ff)
+        obj = objective.Target_Terms(mvals, Order=1, verbose=True)
+        for key in ["X", "G", "H"]:
+            self.assertNdArrayEqual(numpy.array(obj[key]), numpy.array(ref[key]), msg="\nAsynchronous %s does not match serial evaluation" % key, delta=1e-8)
+        # Attributes changed in the worker processes are copied back to the targets.
+        for Tgt in objective.Targets:
+            self.assertEqual(Tgt.gct, 1)
+            self.assertTrue(Tgt.evaluated)
+
+    def test_target_state(self):
+        """Check the attributes that are compared to find changes made in worker processes"""
+        objective = forcebalance.objective.Objective(self.options, self.tgt_opts, self.ff)
+        Tgt = objective.Targets[0]
+        Tgt.test_array = numpy.zeros((4, 3))
+        Tgt.test_memmap = numpy.memmap(tempfile.TemporaryFile(), dtype=float, mode='w+', shape=(4, 3))
+        Tgt.invdists = numpy.zeros((2, 4, 3))
+        state = forcebalance.objective.target_state(Tgt)
+        self.assertTrue('test_array' in state)
+        self.assertFalse('test_memmap' in state)
+        self.assertFalse('invdists' in state)
+        self.assertFalse('FF' in state)
+        Tgt.test_array[1, 2] = 1.0
+        self.assertNotEqual(forcebalance.objective.target_state(Tgt)['test_array'], state['test_array'])
+        Tgt.test_array = numpy.zeros((3, 4))
+        self.assertNotEqual(forcebalance.objective.target_state(Tgt)['test_array'], state['test_array'])
+
+    def test_ff_inmemory_unsupported(self):
+        """Check that keeping the force field in memory is refused for targets that read files"""
+        self.ff.ff_inmemory = True
+        self.assertRaises(RuntimeError, forcebalance.objective.Objective, self.options, self.tgt_opts, self.ff)
+        self.assertTrue(forcebalance.objective.Implemented_Targets['ABINITIO_OPENMM'].supports_ff_inmemory)
+        self.assertFalse(forcebalance.objective.Implemented_Targets['LIQUID_OPENMM'].supports_ff_inmemory)
+
 if __name__ == '__main__':           
     unittest.main()
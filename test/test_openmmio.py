@@ -3,6 +3,9 @@ import sys, os, re
 import forcebalance
 import abc
 import numpy
+import time
+import shutil
+import itertools
 from __init__ import ForceBalanceTestCase
 from test_target import TargetTests # general targets tests defined in test_target.py
 import logging
@@ -59,5 +62,184 @@ class TestInteraction_OpenMM(ForceBalanceTestCase, TargetTests):
         """@override ForceBalanceTestCase.shortDescription()"""
         return super(TestInteraction_OpenMM,self).shortDescription() + " (Interaction_OpenMM)"
 
+    def test_update_slots(self):
+        """Check that setting parameters in place matches creating a new system"""
+        os.chdir(self.target.tempdir)
+        engine = self.target.engine
+        self.ff.make(numpy.zeros(self.ff.np))
+        engine.energy()
+        self.ff.make(numpy.array(self.mvals))
+        E1 = engine.energy()
+        # Force the engine to create a new system.
+        del engine.simulation
+        engine.slotmap = None
+        E2 = engine.energy()
+        self.assertNdArrayEqual(E1, E2, msg="\nEnergies from parameters set in place do not match a new system", delta=1e-6)
+        os.chdir('../..')
+
+    def test_slotmap_after_make(self):
+        """Check that the slot map is built once the force field has been created"""
+        os.chdir(self.target.tempdir)
+        engine = self.target.engine
+        self.ff.make(numpy.array(self.mvals))
+        # An engine that creates its system before FF.make() has been called.
+        fftemplate = self.ff.fftemplate
+        self.ff.fftemplate = None
+        if hasattr(engine, 'simulation'): del engine.simulation
+        engine.__dict__.pop('slotmap', None)
+        engine.update_simulation()
+        self.assertFalse(hasattr(engine, 'slotmap'))
+        self.ff.fftemplate = fftemplate
+        self.ff.make(numpy.array(self.mvals))
+        engine.energy()
+        self.assertTrue(engine.slotmap is not None)
+        os.chdir('../..')
+
+    def test_xyz_arrays(self):
+        """Check that the cached coordinate arrays follow the stored frames"""
+        engine = self.target.engine
+        xyzs, boxes = engine.xyz_arrays()
+        self.assertEqual(len(xyzs), len(engine.xyz_omms))
+        self.assertTrue(engine.xyz_arrays()[0] is xyzs)
+        engine.xyz_omms = engine.xyz_omms[:1]
+        self.assertEqual(len(engine.xyz_arrays()[0]), 1)
+        self.assertNdArrayEqual(engine.xyz_arrays()[0][0], xyzs[0], msg="\nCoordinate arrays do not match the stored frames", delta=1e-12)
+
+    def test_analytic_energy_derivatives(self):
+        """Check analytic energy derivatives of linear parameters against finite difference"""
+        # This force field also parameterizes the bond, angle and torsion force constants.
+        self.options['forcefield'] = ['dms-bonded.xml']
+        ff = forcebalance.forcefield.FF(self.options)
+        target = forcebalance.openmmio.Interaction_OpenMM(self.options, self.tgt_opt, ff)
+        os.chdir(target.tempdir)
+        engine = target.engine
+        mvals = numpy.array([.5]*ff.np)
+        h = 1e-3
+        G, pfd = engine.analytic_energy_derivatives(mvals, range(ff.np), h)
+        self.assertTrue(len(G) > 0)
+        self.assertEqual(len(G) + len(pfd), ff.np)
+        def energy_driver(mvals_):
+            ff.make(mvals_)
+            return engine.energy()
+        for i, AG in G.items():
+            # The energy is linear in these parameters, so a large step keeps the finite difference free of roundoff error.
+            FDG, _ = forcebalance.finite_difference.f12d3p(forcebalance.finite_difference.fdwrap(energy_driver, mvals, i), 0.1)
+            self.assertNdArrayEqual(AG, FDG, msg="\nAnalytic energy derivative does not match finite difference for %s" % ff.plist[i], delta=1e-3*max(1.0, numpy.max(numpy.abs(FDG))))
+        os.chdir('../..')
+
+    def test_streamed_frames(self):
+        """Check energies and dipoles of frames streamed to disk against frames in memory"""
+        os.chdir(self.target.tempdir)
+        engine = self.target.engine
+        self.ff.make(numpy.array(self.mvals))
+        Result = engine.evaluate_(dipole=True, traj=True)
+        frames = engine.xyz_omms
+        stream = forcebalance.openmmio.StreamedFrames('stream', len(frames), engine.system.getNumParticles(), engine.pbc)
+        for frame in frames:
+            stream.append(frame)
+        engine.xyz_omms = stream
+        self.assertEqual(len(engine.xyz_omms), len(frames))
+        self.assertNdArrayEqual(engine.energy(), Result["Energy"], msg="\nEnergies of streamed frames do not match frames in memory", delta=1e-2)
+        Dips = forcebalance.openmmio.get_dipoles(engine.system, engine.xyz_arrays()[0], batch=2)
+        self.assertNdArrayEqual(Dips, Result["Dipole"], msg="\nBatch dipoles do not match frame-by-frame dipoles", delta=1e-4)
+        engine.xyz_omms = frames
+        os.chdir('../..')
+
+    def test_md_checkpoint(self):
+        """Check that MD resumed from a checkpoint matches an uninterrupted run"""
+        os.chdir(self.target.tempdir)
+        engine = self.target.engine
+        self.ff.make(numpy.array(self.mvals))
+        self.addCleanup(os.system, 'rm -f md.chk md.frames md.chk.saved md.frames.saved')
+        mdopts = dict(nsteps=200, timestep=1.0, temperature=300.0, nequil=40, nsave=20, checkpoint='md', checkpoint_interval=2)
+        # Save copies of the checkpoint files partway through the production run.
+        write_md_checkpoint = engine.write_md_checkpoint
+        ncalls = [0]
+        def save_checkpoint(*args):
+            write_md_checkpoint(*args)
+            ncalls[0] += 1
+            if ncalls[0] == 3:
+                shutil.copy('md.chk', 'md.chk.saved')
+                shutil.copy('md.frames', 'md.frames.saved')
+        engine.write_md_checkpoint = save_checkpoint
+        Ref = engine.molecular_dynamics(**mdopts)
+        xyz_ref = engine.xyz_arrays()[0].copy()
+        engine.write_md_checkpoint = write_md_checkpoint
+        self.assertEqual(len(Ref['Potentials']), 11)
+        # The interrupted run wrote part of another frame after the last checkpoint.
+        shutil.copy('md.chk.saved', 'md.chk')
+        shutil.copy('md.frames.saved', 'md.frames')
+        with open('md.frames', 'ab') as f: f.write('incomplete frame')
+        self.assertEqual(engine.read_md_checkpoint('md', 'another simulation'), None)
+        self.assertFalse(os.path.exists('md.chk'))
+        shutil.copy('md.chk.saved', 'md.chk')
+        shutil.copy('md.frames.saved', 'md.frames')
+        with open('md.frames', 'ab') as f: f.write('incomplete frame')
+        Res = engine.molecular_dynamics(**mdopts)
+        self.assertNdArrayEqual(Res['Potentials'], Ref['Potentials'], msg="\nResumed MD energies do not match an uninterrupted run", delta=1e-4)
+        self.assertNdArrayEqual(engine.xyz_arrays()[0], xyz_ref, msg="\nResumed MD coordinates do not match an uninterrupted run", delta=1e-4)
+        # A checkpoint for different force field parameters is not used.
+        self.ff.make(numpy.zeros(self.ff.np))
+        engine.update_simulation()
+        Res0 = engine.molecular_dynamics(**dict(mdopts, nequil=0))
+        self.assertEqual(len(Res0['Potentials']), 11)
+        os.chdir('../..')
+
+    def test_energy_sweep_benchmark(self):
+        """Benchmark the OpenMM energy sweep over parameter displacements against calling FF.make() for each one"""
+        os.chdir(self.target.tempdir)
+        engine = self.target.engine
+        mvals = numpy.array(self.mvals)
+        self.ff.make(mvals)
+        engine.update_simulation()
+        h = 0.01
+        mvals_list = [mvals]
+        for i in range(self.ff.np):
+            for d in [-h, h]:
+                mvals_list.append(mvals + d*numpy.eye(self.ff.np)[i])
+        # Displacement by displacement, as in energy_driver.
+        t0 = time.time()
+        E_ref = []
+        for mvals_ in mvals_list:
+            self.ff.make(mvals_)
+            E_ref.append(engine.energy())
+        t1 = time.time()
+        E = engine.energy_sweep(mvals_list)
+        t2 = time.time()
+        self.logger.info("\nOpenMM energies of %i frames for %i parameter sets: %.3f s with FF.make, %.3f s with energy_sweep\n" %
+                         (len(E_ref[0]), len(mvals_list), t1-t0, t2-t1))
+        self.assertNdArrayEqual(numpy.array(E_ref), E, msg="\nEnergy sweep does not match energies computed for each displacement", delta=1e-6)
+        os.chdir('../..')
+
+    def test_evaluate_benchmark(self):
+        """Benchmark batch OpenMM energy / force evaluation against a frame-by-frame loop"""
+        from simtk.unit import kilojoules_per_mole, nanometer
+        os.chdir(self.target.tempdir)
+        engine = self.target.engine
+        self.ff.make(numpy.array(self.mvals))
+        engine.update_simulation()
+        nframes = len(engine.xyz_omms)
+        # Frame-by-frame evaluation as it was done previously.
+        t0 = time.time()
+        E_ref = []
+        F_ref = []
+        for I in range(nframes):
+            if engine.pbc:
+                engine.simulation.context.setPeriodicBoxVectors(*engine.xyz_omms[I][1])
+            engine.simulation.context.setPositions(engine.xyz_omms[I][0])
+            engine.simulation.context.computeVirtualSites()
+            State = engine.simulation.context.getState(getEnergy=True, getForces=True)
+            E_ref.append(State.getPotentialEnergy() / kilojoules_per_mole)
+            Force = list(numpy.array(State.getForces() / kilojoules_per_mole * nanometer).flatten())
+            F_ref.append(list(itertools.chain(*[Force[3*i:3*i+3] for i in range(len(Force)/3) if engine.AtomMask[i]])))
+        t1 = time.time()
+        Result = engine.evaluate_(force=True, traj=True)
+        t2 = time.time()
+        self.logger.info("\nOpenMM evaluation of %i frames: %.1f frames/s frame-by-frame, %.1f frames/s batch\n" %
+                         (nframes, nframes/max(t1-t0, 1e-6), nframes/max(t2-t1, 1e-6)))
+        self.assertNdArrayEqual(numpy.array(E_ref), Result["Energy"], msg="\nBatch energies do not match frame-by-frame energies", delta=1e-6)
+        self.assertNdArrayEqual(numpy.array(F_ref), Result["Force"], msg="\nBatch forces do not match frame-by-frame forces", delta=1e-6)
+        os.chdir('../..')
+
 if __name__ == '__main__':           
     unittest.main()
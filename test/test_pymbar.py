@@ -0,0 +1,74 @@
+from __init__ import ForceBalanceTestCase
+import unittest
+import numpy
+import time
+import forcebalance
+from forcebalance.pymbar import pymbar, testsystems
+
+def reference_log_weights(mbar, u_kn):
+    """ Unnormalized log weights computed with the per-sample loop that pymbar used previously. """
+    log_w_kn = numpy.zeros([mbar.K,mbar.N_max], dtype=numpy.float64)
+    for k in range(0,mbar.K):
+        for n in range(0,mbar.N_k[k]):
+            log_w_kn[k,n] = - pymbar.logsum(numpy.log(mbar.N_k[mbar.nonzero_N_k_indices]) + mbar.f_k[mbar.nonzero_N_k_indices] - (mbar.u_kln[k,mbar.nonzero_N_k_indices,n] - u_kn[k,n]))
+    return log_w_kn
+
+def reference_weights(mbar):
+    """ Normalized log weights and free energies computed with the per-state loop that pymbar used previously. """
+    log_weight_denom = reference_log_weights(mbar, numpy.zeros([mbar.K,mbar.N_max]))
+    Log_W_nk = numpy.zeros([mbar.N, mbar.K], dtype=numpy.float64)
+    f_k_out = numpy.zeros([mbar.K], dtype=numpy.float64)
+    for l in range(mbar.K):
+        log_w_kn = -mbar.u_kln[:,l,:] + log_weight_denom + mbar.f_k[l]
+        f_k_out[l] = mbar.f_k[l] - pymbar.logsum(log_w_kn[mbar.indices])
+        log_w_kn[mbar.indices] += (f_k_out[l]-mbar.f_k[l])
+        Log_W_nk[:,l] = log_w_kn[mbar.indices]
+    return Log_W_nk, f_k_out - f_k_out[0]
+
+class TestPyMBAR(ForceBalanceTestCase):
+    def setUp(self):
+        N_k = [300, 200, 0, 250, 400]
+        O_k = [0.0, 0.5, 1.0, 1.5, 2.0]
+        K_k = [1.0, 2.0, 4.0, 2.0, 1.0]
+        self.x_kn, self.u_kln, self.N_k = testsystems.HarmonicOscillatorsSample(N_k=N_k, O_k=O_k, K_k=K_k, seed=1)
+        # Analytical free energies of the harmonic oscillators.
+        self.f_k = -numpy.log(numpy.sqrt(2*numpy.pi/numpy.array(K_k)))
+        self.f_k -= self.f_k[0]
+
+    def test_log_weights(self):
+        """Check vectorized MBAR log weights against the previous loop implementation"""
+        mbar = pymbar.MBAR(self.u_kln, self.N_k, relative_tolerance=1.0e-10)
+        mbar.use_embedded_helper_code = False
+        u_kn = numpy.random.RandomState(2).normal(size=(mbar.K, mbar.N_max))
+        self.assertNdArrayEqual(mbar._computeUnnormalizedLogWeights(u_kn), reference_log_weights(mbar, u_kn), delta=1e-10)
+        Log_W_nk, f_k = mbar._computeWeights(logform=True, include_nonzero=True, return_f_k=True)
+        Ref_W_nk, ref_f_k = reference_weights(mbar)
+        self.assertNdArrayEqual(Log_W_nk, Ref_W_nk, delta=1e-10)
+        self.assertNdArrayEqual(f_k, ref_f_k, delta=1e-10)
+
+    def test_free_energies(self):
+        """Check MBAR free energies of harmonic oscillators for both solvers"""
+        for method in ['self-consistent-iteration', 'adaptive']:
+            mbar = pymbar.MBAR(self.u_kln, self.N_k, method=method, relative_tolerance=1.0e-10)
+            self.assertNdArrayEqual(mbar.f_k, self.f_k, delta=0.1)
+            # Warm start from the converged free energies.
+            mbar1 = pymbar.MBAR(self.u_kln, self.N_k, method=method, relative_tolerance=1.0e-10, initial_f_k=mbar.f_k)
+            self.assertNdArrayEqual(mbar1.f_k, mbar.f_k, delta=1e-6)
+            self.assertNdArrayEqual(numpy.sum(mbar.getWeights(), axis=0), numpy.ones(mbar.K), delta=1e-8)
+
+    def test_log_weights_benchmark(self):
+        """Benchmark vectorized MBAR log weights against the previous loop implementation"""
+        x_kn, u_kln, N_k = testsystems.HarmonicOscillatorsSample(N_k=[2000]*20, O_k=numpy.linspace(0, 4, 20), K_k=[1.0]*20, seed=3)
+        mbar = pymbar.MBAR(u_kln, N_k, maximum_iterations=0)
+        mbar.use_embedded_helper_code = False
+        u_kn = numpy.zeros([mbar.K, mbar.N_max])
+        t0 = time.time()
+        ref = reference_log_weights(mbar, u_kn)
+        t1 = time.time()
+        new = mbar._computeUnnormalizedLogWeights(u_kn)
+        t2 = time.time()
+        self.logger.info("\nMBAR log weights for %i states x %i samples: %.3f s loop, %.3f s vectorized\n" % (mbar.K, mbar.N_max, t1-t0, t2-t1))
+        self.assertNdArrayEqual(new, ref, delta=1e-10)
+
+if __name__ == '__main__':
+    unittest.main()